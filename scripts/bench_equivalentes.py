@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Benchmark de la búsqueda de equivalentes: bucle por ítem (cosine_similarity +
+argsort completo) contra la búsqueda en lote de MaterialIndex.top_k.
+
+Uso: python scripts/bench_equivalentes.py [--materiales 100000] [--items 50]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+# Agregar el directorio src al path
+script_dir = os.path.dirname(__file__)
+parent_dir = os.path.dirname(script_dir)
+sys.path.insert(0, os.path.join(parent_dir, 'src'))
+
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics.pairwise import cosine_similarity
+
+from backend.material_index import MaterialIndex
+
+PALABRAS = (
+    "valvula bomba junta brida tornillo tuerca arandela rodamiento sello filtro cable motor "
+    "correa cadena engranaje eje buje manguera acople niple codo tee reduccion acero inox "
+    "bronce pvc galvanizado teflon nitrilo 1/4 1/2 3/4 1 2 3 4 pulgada alta baja presion "
+    "rosca soldable bridada clase 150 300 600 sch40 sch80 electrico neumatico hidraulico"
+).split()
+UNIDADES = ["UN", "KG", "M", "L"]
+
+
+def _catalogo(n, seed):
+    rnd = random.Random(seed)
+    codigos = [f"M{i:07d}" for i in range(n)]
+    textos = [" ".join(rnd.sample(PALABRAS, rnd.randint(4, 9))) for _ in range(n)]
+    unidades = [rnd.choice(UNIDADES) for _ in range(n)]
+    return codigos, textos, unidades
+
+
+def _bucle(vectorizer, matrix, textos, unidades, objetivos, k):
+    """Reproduce el algoritmo anterior: una similitud y un argsort completo por ítem."""
+    out = []
+    for pos in objetivos:
+        sims = cosine_similarity(vectorizer.transform([textos[pos]]), matrix).flatten()
+        orden = np.argsort(sims)[::-1]
+        elegidos = [i for i in orden[: k + 1] if i != pos and unidades[i] == unidades[pos]][:k]
+        out.append(elegidos)
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--materiales", type=int, default=100_000)
+    parser.add_argument("--items", type=int, default=50)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--repeticiones", type=int, default=3)
+    args = parser.parse_args()
+
+    codigos, textos, unidades = _catalogo(args.materiales, seed=7)
+    t0 = time.perf_counter()
+    vectorizer = TfidfVectorizer(max_features=20000, strip_accents="unicode", sublinear_tf=True, dtype=np.float32)
+    matrix = vectorizer.fit_transform(textos)
+    index = MaterialIndex(1, codigos, unidades, textos, vectorizer, matrix)
+    print(f"Índice: {args.materiales} materiales, {matrix.shape[1]} términos, {time.perf_counter() - t0:.2f}s")
+
+    objetivos = random.Random(11).sample(range(args.materiales), args.items)
+    consultas = [(codigos[p], textos[p], unidades[p]) for p in objetivos]
+
+    def medir(fn):
+        mejores = []
+        for _ in range(args.repeticiones):
+            t = time.perf_counter()
+            fn()
+            mejores.append(time.perf_counter() - t)
+        return min(mejores)
+
+    t_bucle = medir(lambda: _bucle(vectorizer, matrix, textos, unidades, objetivos, args.k))
+    t_lote = medir(lambda: index.top_k(consultas, args.k))
+    print(f"Bucle por ítem : {t_bucle * 1000:8.1f} ms")
+    print(f"Lote (top_k)   : {t_lote * 1000:8.1f} ms  ({t_bucle / t_lote:.1f}x)")
+
+    # El lote filtra por unidad antes de elegir, así que su mejor candidato
+    # nunca puede ser peor que el del bucle.
+    bucle = _bucle(vectorizer, matrix, textos, unidades, objetivos, args.k)
+    for pos, elegidos, coincidencias in zip(objetivos, bucle, index.top_k(consultas, args.k)):
+        if elegidos:
+            esperado = float(matrix[pos].multiply(matrix[elegidos[0]]).sum())
+            assert coincidencias and coincidencias[0][1] >= esperado - 1e-4, (codigos[pos], esperado, coincidencias)
+    print("Resultados consistentes")
+
+
+if __name__ == "__main__":
+    main()
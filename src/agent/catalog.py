@@ -1,25 +1,119 @@
-import pandas as pd
+import math
+import re
+import unicodedata
+from collections import Counter, defaultdict
 from pathlib import Path
 
+import numpy as np
+import pandas as pd
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+_COLUMNS = ["codigo", "descripcion", "uom", "planta", "equivalentes"]
+_STOPWORDS = {"de", "del", "la", "el", "los", "las", "para", "con", "en", "por", "un", "una", "tipo"}
+
+
+def fold(texto: str) -> str:
+    texto = unicodedata.normalize("NFKD", str(texto or "")).encode("ascii", "ignore").decode()
+    return texto.lower()
+
+
+def tokenize(texto: str) -> list[str]:
+    # Single letters are noise; single digits ("2" in 2 pulgadas) are not.
+    return [t for t in _TOKEN.findall(fold(texto)) if (len(t) > 1 or t.isdigit()) and t not in _STOPWORDS]
+
+
 class Catalog:
+    """BM25 search over the catalog with an inverted index built once at load time.
+
+    A query only touches the postings of its own tokens, so its cost follows
+    how many items share those tokens, not the size of the catalog.
+    """
+
+    K1 = 1.2
+    B = 0.75
+
     def __init__(self, csv_path: str = "data/catalogo.csv"):
         p = Path(csv_path)
         if not p.exists():
-            self.df = pd.DataFrame(columns=["codigo", "descripcion", "uom", "planta", "equivalentes"])
+            self.df = pd.DataFrame(columns=_COLUMNS)
         else:
-            self.df = pd.read_csv(p)
-        self.df["desc_norm"] = self.df["descripcion"].str.lower()
+            # Everything as text: numeric codes stay strings and empty cells are "".
+            self.df = pd.read_csv(p, dtype=str, keep_default_na=False)
+        self.df["desc_norm"] = self.df["descripcion"].fillna("").map(fold)
+        self.rows = [
+            {k: (v or None) for k, v in row.items()}
+            for row in self.df.drop(columns=["desc_norm"]).to_dict("records")
+        ]
+        self._build_index()
+        self._build_plantas()
+
+    def _build_index(self):
+        postings: dict[str, tuple[list[int], list[int]]] = defaultdict(lambda: ([], []))
+        lengths = np.zeros(len(self.rows), dtype=np.float32)
+        for doc_id, desc in enumerate(self.df["desc_norm"]):
+            tokens = tokenize(desc)
+            lengths[doc_id] = len(tokens)
+            for token, tf in Counter(tokens).items():
+                ids, tfs = postings[token]
+                ids.append(doc_id)
+                tfs.append(tf)
+        n_docs = len(self.rows)
+        avgdl = float(lengths.mean()) if n_docs and lengths.any() else 1.0
+        # Length normalization does not depend on the query, so it is folded in here.
+        norm = self.K1 * (1 - self.B + self.B * lengths / avgdl)
+        self._postings: dict[str, tuple[np.ndarray, np.ndarray, float]] = {}
+        for token, (ids, tfs) in postings.items():
+            ids_arr = np.asarray(ids, dtype=np.int32)
+            tf_arr = np.asarray(tfs, dtype=np.float32)
+            idf = math.log(1 + (n_docs - len(ids) + 0.5) / (len(ids) + 0.5))
+            weights = idf * tf_arr * (self.K1 + 1) / (tf_arr + norm[ids_arr])
+            self._postings[token] = (ids_arr, weights.astype(np.float32), idf)
+
+    def _build_plantas(self):
+        plantas = self.df["planta"].fillna("").astype(str).str.strip().str.lower().to_numpy()
+        todos = plantas == "todos"
+        self._todos = todos
+        self._plantas = {p: (plantas == p) | todos for p in set(plantas) if p and p != "todos"}
+
+    def _allowed(self, planta: str | None) -> np.ndarray | None:
+        key = (planta or "").strip().lower()
+        if not key or key == "todos":
+            return None
+        return self._plantas.get(key, self._todos)
+
+    def rank(self, texto: str, planta: str | None = None, k: int = 5) -> list[tuple[dict, float]]:
+        """Best ``k`` items for ``texto`` with a 0–1 confidence, best first."""
+        tokens = list(dict.fromkeys(tokenize(texto)))
+        known = [self._postings[t] for t in tokens if t in self._postings]
+        if not known or k <= 0:
+            return []
+        ids = np.concatenate([p[0] for p in known])
+        weights = np.concatenate([p[1] for p in known])
+        allowed = self._allowed(planta)
+        if allowed is not None:
+            keep = allowed[ids]
+            ids, weights = ids[keep], weights[keep]
+            if not len(ids):
+                return []
+        candidates, inverse = np.unique(ids, return_inverse=True)
+        scores = np.bincount(inverse, weights=weights)
+        if len(scores) > k:
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top], kind="stable")]
+        else:
+            top = np.argsort(-scores, kind="stable")
+        # Reference score: an average-length item containing every query token once
+        # scores the sum of their idf. Tokens the catalog has never seen lower the
+        # confidence proportionally.
+        bound = sum(p[2] for p in known)
+        coverage = len(known) / len(tokens)
+        return [
+            (self.rows[int(candidates[i])], round(min(float(scores[i]) / bound, 1.0) * coverage, 3))
+            for i in top
+        ]
 
     def search(self, texto: str, planta: str | None = None):
-        t = (texto or "").lower()
-        df = self.df
-        if planta and planta.lower() != "todos":
-            df = df[(df["planta"].str.lower() == planta.lower()) | (df["planta"].str.lower() == "todos")]
-        hits = df[df["desc_norm"].str.contains("|".join([w for w in t.split() if len(w) > 2]), na=False, regex=True)]
-        if hits.empty and len(df):
-            return df.iloc[0].to_dict(), 0.2
-        if hits.empty:
+        ranked = self.rank(texto, planta, k=1)
+        if not ranked:
             return None, 0.0
-        row = hits.iloc[0].to_dict()
-        return row, 0.7
-
+        return ranked[0]
@@ -1,5 +1,5 @@
 from fastapi import FastAPI
-from agent.models import SuggestRequest, SuggestResponse, ValidateRequest, ValidateResponse, PriorityRequest, PriorityResponse
+from agent.models import Alternativa, SuggestRequest, SuggestResponse, ValidateRequest, ValidateResponse, PriorityRequest, PriorityResponse
 from agent.catalog import Catalog
 from agent.rules import validate, prioritize
 from agent.llm import normalize_description
@@ -10,15 +10,20 @@ CAT = Catalog()
 @app.post("/agent/suggest_line", response_model=SuggestResponse)
 async def suggest_line(req: SuggestRequest):
     norm = await normalize_description(req.texto)
-    row, conf = CAT.search(norm, req.planta)
-    if not row:
-        return SuggestResponse(codigo=None, descripcion_normalizada=norm, uom=None, confianza=conf, explicacion="Sin match en catálogo; revisar manualmente")
+    ranked = CAT.rank(norm, req.planta, k=5)
+    if not ranked:
+        return SuggestResponse(codigo=None, descripcion_normalizada=norm, uom=None, confianza=0.0, explicacion="Sin match en catálogo; revisar manualmente")
+    row, conf = ranked[0]
     return SuggestResponse(
         codigo=row.get("codigo"),
         descripcion_normalizada=norm,
         uom=row.get("uom"),
         confianza=conf,
-        explicacion=f"Match por texto normalizado y planta '{req.planta or 'cualquiera'}'"
+        explicacion=f"Match BM25 por texto normalizado y planta '{req.planta or 'cualquiera'}'",
+        alternativas=[
+            Alternativa(codigo=r.get("codigo"), descripcion=r.get("descripcion"), uom=r.get("uom"), confianza=c)
+            for r, c in ranked[1:]
+        ],
     )
 
 @app.post("/agent/validate", response_model=ValidateResponse)
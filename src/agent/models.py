@@ -5,12 +5,19 @@ class SuggestRequest(BaseModel):
     texto: str = Field(..., description="Texto libre del usuario")
     planta: Optional[str] = None
 
+class Alternativa(BaseModel):
+    codigo: Optional[str]
+    descripcion: Optional[str]
+    uom: Optional[str]
+    confianza: float
+
 class SuggestResponse(BaseModel):
     codigo: Optional[str]
     descripcion_normalizada: str
     uom: Optional[str]
     confianza: float
     explicacion: str
+    alternativas: list[Alternativa] = []
 
 class ValidateRequest(BaseModel):
     codigo: str
@@ -1,60 +1,169 @@
 from __future__ import annotations
 
+import hashlib
 import json
+import logging
+import math
 import os
-import pickle
 import sqlite3
-from typing import Any, Dict, List, Optional
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from typing import Any, Dict, List, Optional, Set
 
 import numpy as np
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
 
+from .catalog_cache import MATERIALES_VERSION_KEY, get_catalog_version
 from .config import Settings
 from .db import get_connection
+from .leadtime import FUENTE_COMPRA, FUENTE_TRASLADO, load_leadtime_stats, pick_stats, route_key, stats_version
+from .material_index import MaterialIndexHolder
+from .price_stats import get_price_stats
+from .stock import active_snapshot, availability_for
+
+logger = logging.getLogger(__name__)
+
+# Shared by every AIService instance of the worker.
+material_index = MaterialIndexHolder()
 
 
 class AIService:
     def __init__(self):
-        self.cache_dir = os.path.join(Settings.DATA_DIR, "ai_cache")
-        os.makedirs(self.cache_dir, exist_ok=True)
-        self.tfidf_cache = os.path.join(self.cache_dir, "tfidf.pkl")
-        self.materiales_cache = os.path.join(self.cache_dir, "materiales.pkl")
+        self.material_index = material_index
 
     def get_suggestions_for_solicitud(self, solicitud_id: int) -> List[Dict[str, Any]]:
         """Genera sugerencias IA para todos los ítems de una solicitud."""
         with get_connection() as con:
-            # Obtener solicitud e ítems
-            sol_row = con.execute(
-                "SELECT id, centro_solicitante, criticidad, fecha_necesidad FROM solicitudes WHERE id = ?",
-                (solicitud_id,)
-            ).fetchone()
+            sol_row = self._fetch_solicitud(con, solicitud_id)
             if not sol_row:
                 return []
+            return self._compute_suggestions(con, sol_row, self._load_items(sol_row))
+
+    def get_cached_suggestions(self, solicitud_id: int) -> Optional[Dict[str, Any]]:
+        """Sugerencias desde ai_suggestions_cache; recalcula solo si cambiaron las entradas.
 
-            items = con.execute(
-                "SELECT item_index, material, um, cantidad, precio_unitario_est FROM solicitud_items WHERE solicitud_id = ?",
+        Devuelve None si la solicitud no existe.
+        """
+        with get_connection() as con:
+            sol_row = self._fetch_solicitud(con, solicitud_id)
+            if not sol_row:
+                return None
+            items = self._load_items(sol_row)
+            input_hash = self._input_hash(con, sol_row, items)
+            cached = con.execute(
+                "SELECT input_hash, suggestions_json, computed_at FROM ai_suggestions_cache WHERE solicitud_id = ?",
                 (solicitud_id,)
-            ).fetchall()
+            ).fetchone()
+            if cached and cached["input_hash"] == input_hash:
+                return {
+                    "suggestions": json.loads(cached["suggestions_json"]),
+                    "computed_at": cached["computed_at"],
+                    "cached": True,
+                }
+
+            suggestions = self._compute_suggestions(con, sol_row, items)
+            computed_at = con.execute(
+                """
+                INSERT INTO ai_suggestions_cache (solicitud_id, input_hash, suggestions_json, computed_at)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(solicitud_id) DO UPDATE SET
+                    input_hash=excluded.input_hash,
+                    suggestions_json=excluded.suggestions_json,
+                    computed_at=excluded.computed_at
+                RETURNING computed_at
+                """,
+                (solicitud_id, input_hash, json.dumps(suggestions, ensure_ascii=False, default=str))
+            ).fetchall()[0]["computed_at"]
+            con.commit()
+            return {"suggestions": suggestions, "computed_at": computed_at, "cached": False}
+
+    @staticmethod
+    def _fetch_solicitud(con: sqlite3.Connection, solicitud_id: int) -> Optional[sqlite3.Row]:
+        return con.execute(
+            "SELECT id, centro AS centro_solicitante, criticidad, fecha_necesidad, data_json FROM solicitudes WHERE id = ?",
+            (solicitud_id,)
+        ).fetchone()
+
+    def _input_hash(self, con: sqlite3.Connection, sol_row: sqlite3.Row, items: List[Dict[str, Any]]) -> str:
+        """Huella de todo lo que alimenta las sugerencias: ítems, catálogo, precios, compras, stock, lead times y fecha."""
+        codigos = [item["material"] for item in items]
+        precios = get_price_stats(con, codigos)
+        marcas = ",".join("?" * len(codigos))
+        # Historial de compras que lee _suggest_proveedor: una OC nueva cambia la huella.
+        compras = con.execute(
+            f"""
+            SELECT s.material, MAX(po.id) AS ultima, COUNT(*) AS n
+            FROM purchase_orders po JOIN solpeds s ON s.id = po.solped_id
+            WHERE s.material IN ({marcas})
+            GROUP BY s.material
+            """,
+            codigos,
+        ).fetchall() if codigos else []
+        huella = {
+            "items": items,
+            "centro": sol_row["centro_solicitante"],
+            "criticidad": sol_row["criticidad"],
+            "fecha_necesidad": sol_row["fecha_necesidad"],
+            # El riesgo de SLA se calcula contra la fecha de hoy.
+            "hoy": date.today().isoformat(),
+            "materiales": get_catalog_version(con, MATERIALES_VERSION_KEY),
+            "stock": (active_snapshot(con) or {}).get("id"),
+            "leadtime": stats_version(con),
+            "compras": sorted((row["material"], row["ultima"], row["n"]) for row in compras),
+            "precios": sorted((codigo, stats["updated_at"], stats["n"]) for codigo, stats in precios.items()),
+        }
+        raw = json.dumps(huella, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
 
-            suggestions = []
-            for item in items:
-                item_sugs = self._get_suggestions_for_item(con, solicitud_id, sol_row, item)
-                suggestions.extend(item_sugs)
+    def _compute_suggestions(self, con: sqlite3.Connection, sol_row: sqlite3.Row, items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        equivalentes = self._suggest_equivalentes_batch(con, items)
+        codigos = [item["material"] for item in items]
+        stock = availability_for(con, codigos, sol_row["centro_solicitante"])
+        leadtimes = load_leadtime_stats(con, codigos)
 
-            return suggestions
+        suggestions = []
+        for item in items:
+            item_sugs = self._get_suggestions_for_item(
+                con, sol_row["id"], sol_row, item,
+                equivalentes.get(item["item_index"], []),
+                stock.get(item["material"], []),
+                leadtimes,
+            )
+            suggestions.extend(item_sugs)
+
+        return suggestions
+
+    @staticmethod
+    def _load_items(sol_row: sqlite3.Row) -> List[Dict[str, Any]]:
+        """Ítems de la solicitud tal como quedan guardados en data_json."""
+        try:
+            data = json.loads(sol_row["data_json"] or "{}")
+        except (TypeError, ValueError):
+            return []
+        items = []
+        for index, raw in enumerate(data.get("items") or []):
+            if not isinstance(raw, dict) or not raw.get("codigo"):
+                continue
+            items.append({
+                "item_index": index,
+                "material": str(raw["codigo"]),
+                "descripcion": raw.get("descripcion") or "",
+                "um": raw.get("unidad"),
+                "cantidad": raw.get("cantidad") or 0,
+                "precio_unitario_est": raw.get("precio_unitario") or 0,
+            })
+        return items
 
-    def _get_suggestions_for_item(self, con: sqlite3.Connection, solicitud_id: int, sol_row: sqlite3.Row, item: sqlite3.Row) -> List[Dict[str, Any]]:
+    def _get_suggestions_for_item(self, con: sqlite3.Connection, solicitud_id: int, sol_row: sqlite3.Row, item: Dict[str, Any], equiv_sugs: List[Dict[str, Any]], disponible: List[Dict[str, Any]], leadtimes: Dict[Any, Dict[str, Any]]) -> List[Dict[str, Any]]:
         """Genera sugerencias para un ítem específico."""
         suggestions = []
 
         # Stock split
-        stock_sug = self._suggest_stock_split(con, item, sol_row["centro_solicitante"])
+        stock_sug = self._suggest_stock_split(item, sol_row["centro_solicitante"], disponible)
         if stock_sug:
             suggestions.append(stock_sug)
 
         # Equivalentes
-        equiv_sugs = self._suggest_equivalentes(con, item["material"], item["um"])
         suggestions.extend(equiv_sugs[:Settings.AI_MAX_SUGGESTIONS])
 
         # Proveedor
@@ -68,12 +177,12 @@ class AIService:
             suggestions.append(price_sug)
 
         # Lead time
-        lt_sug = self._suggest_leadtime(con, item["material"], sol_row["centro_solicitante"])
+        lt_sug = self._suggest_leadtime(item, sol_row["centro_solicitante"], stock_sug, prov_sug, leadtimes)
         if lt_sug:
             suggestions.append(lt_sug)
 
         # SLA risk
-        sla_sug = self._suggest_sla_risk(con, solicitud_id, sol_row, item)
+        sla_sug = self._suggest_sla_risk(sol_row, lt_sug)
         if sla_sug:
             suggestions.append(sla_sug)
 
@@ -82,93 +191,74 @@ class AIService:
         if text_sug:
             suggestions.append(text_sug)
 
+        for sug in suggestions:
+            sug.setdefault("item_index", item["item_index"])
+
         return suggestions
 
-    def _suggest_stock_split(self, con: sqlite3.Connection, item: sqlite3.Row, centro: str) -> Optional[Dict[str, Any]]:
-        """Sugiere split stock/compra basado en stock disponible."""
-        # Simular stock_disponible - en realidad, necesitarías una tabla stock_disponible
-        # Por ahora, asumir stock aleatorio para demo
-        import random
-        stock_total = random.randint(0, int(item["cantidad"]) * 2)
-        if stock_total == 0:
+    def _suggest_stock_split(self, item: Dict[str, Any], centro: str, disponible: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """Sugiere split stock/compra con el stock de la última foto (mismo centro primero)."""
+        stock_total = sum(row["cantidad"] for row in disponible)
+        if stock_total <= 0:
             return None
 
-        stock_qty = min(item["cantidad"], stock_total)
-        compra_qty = item["cantidad"] - stock_qty
-
+        pendiente = float(item["cantidad"] or 0)
+        asignado = []
+        for row in disponible:
+            if pendiente <= 0:
+                break
+            cantidad = min(pendiente, row["cantidad"])
+            asignado.append({"centro": row["centro"], "almacen_virtual": row["almacen"], "lote": row["lote"], "cantidad": cantidad})
+            pendiente -= cantidad
+        stock_qty = float(item["cantidad"] or 0) - pendiente
+        compra_qty = pendiente
+
+        payload: Dict[str, Any] = {"stock": asignado}
         if compra_qty > 0:
-            payload = {
-                "stock": [{"centro": centro, "almacen_virtual": "0001", "lote": None, "cantidad": stock_qty}],
-                "compra": {"cantidad": compra_qty}
-            }
-        else:
-            payload = {"stock": [{"centro": centro, "almacen_virtual": "0001", "lote": None, "cantidad": stock_qty}]}
+            payload["compra"] = {"cantidad": compra_qty}
+        mismo_centro = all(a["centro"] == centro for a in asignado)
 
         return {
             "item_index": item["item_index"],
-            "suggestions": [{
-                "type": "stock_split",
-                "title": f"Usar stock {stock_qty} UN + comprar {compra_qty} UN" if compra_qty > 0 else f"Usar stock {stock_qty} UN (100%)",
-                "payload": payload,
-                "reason": f"Stock disponible {stock_total} UN detectado (prioridad mismo centro).",
-                "confidence": 0.86 if stock_qty > 0 else 0.95,
-                "sources": ["stock_disponible"]
-            }]
+            "type": "stock_split",
+            "title": f"Usar stock {stock_qty:g} UN + comprar {compra_qty:g} UN" if compra_qty > 0 else f"Usar stock {stock_qty:g} UN (100%)",
+            "payload": payload,
+            "reason": f"Stock disponible {stock_total:g} UN detectado ({'mismo centro' if mismo_centro else 'incluye otros centros'}).",
+            "confidence": 0.95 if compra_qty <= 0 and mismo_centro else 0.86,
+            "sources": ["stock_disponible"]
         }
 
-    def _suggest_equivalentes(self, con: sqlite3.Connection, material: str, um: str) -> List[Dict[str, Any]]:
-        """Sugiere materiales equivalentes usando TF-IDF."""
-        materiales = con.execute(
-            "SELECT codigo, descripcion, descripcion_larga, unidad_medida, precio_usd FROM materiales WHERE activo = 1"
-        ).fetchall()
-
-        if not materiales:
-            return []
-
-        # Cargar o calcular TF-IDF
-        if os.path.exists(self.tfidf_cache) and os.path.exists(self.materiales_cache):
-            with open(self.tfidf_cache, 'rb') as f:
-                vectorizer, tfidf_matrix = pickle.load(f)
-            with open(self.materiales_cache, 'rb') as f:
-                mat_list = pickle.load(f)
-        else:
-            mat_list = [f"{m['descripcion']} {m['descripcion_larga']}" for m in materiales]
-            vectorizer = TfidfVectorizer(max_features=1000, stop_words='english')
-            tfidf_matrix = vectorizer.fit_transform(mat_list)
-            with open(self.tfidf_cache, 'wb') as f:
-                pickle.dump((vectorizer, tfidf_matrix), f)
-            with open(self.materiales_cache, 'wb') as f:
-                pickle.dump(mat_list, f)
-
-        # Buscar material actual
-        target_desc = next((f"{m['descripcion']} {m['descripcion_larga']}" for m in materiales if m['codigo'] == material), "")
-        if not target_desc:
-            return []
-
-        target_vec = vectorizer.transform([target_desc])
-        similarities = cosine_similarity(target_vec, tfidf_matrix).flatten()
-
-        # Top similares (excluyendo el mismo)
-        top_indices = np.argsort(similarities)[::-1][1:4]  # top 3
-
-        suggestions = []
-        for idx in top_indices:
-            mat = materiales[idx]
-            if mat['codigo'] == material or mat['unidad_medida'] != um:
-                continue
-            sim = similarities[idx]
-            if sim < 0.5:  # umbral mínimo
-                continue
-            suggestions.append({
-                "type": "equivalente",
-                "title": f"Equivalente: {mat['codigo']} (similaridad {sim:.2f})",
-                "payload": {"material": mat['codigo'], "unidad_medida": mat['unidad_medida']},
-                "reason": "Descripción similar (TF-IDF) y unidad compatible.",
-                "confidence": min(sim, 0.9),
-                "sources": ["materiales"]
-            })
-
-        return suggestions
+    def _suggest_equivalentes_batch(self, con: sqlite3.Connection, items: List[Dict[str, Any]]) -> Dict[int, List[Dict[str, Any]]]:
+        """Sugiere materiales equivalentes (TF-IDF) para todos los ítems en una sola pasada."""
+        if not items:
+            return {}
+        index = self.material_index.get(con)
+        queries = []
+        for item in items:
+            row = index.row_of(item["material"])
+            # Sin unidad en el ítem se usa la del material catalogado.
+            um = item["um"] or (index.unidades[row] if row is not None else None)
+            queries.append((item["material"], item["descripcion"], um))
+        matches = index.top_k(
+            queries,
+            3,  # top 3
+            min_score=0.5,  # umbral mínimo
+        )
+
+        out: Dict[int, List[Dict[str, Any]]] = {}
+        for item, item_matches in zip(items, matches):
+            out[item["item_index"]] = [
+                {
+                    "type": "equivalente",
+                    "title": f"Equivalente: {index.codigos[row]} (similaridad {sim:.2f})",
+                    "payload": {"material": index.codigos[row], "unidad_medida": index.unidades[row]},
+                    "reason": "Descripción similar (TF-IDF) y unidad compatible.",
+                    "confidence": min(sim, 0.9),
+                    "sources": ["materiales"]
+                }
+                for row, sim in item_matches
+            ]
+        return out
 
     def _suggest_proveedor(self, con: sqlite3.Connection, material: str) -> Optional[Dict[str, Any]]:
         """Sugiere proveedor basado en histórico de PO."""
@@ -194,68 +284,135 @@ class AIService:
         """Sugiere precio basado en histórico y CSV."""
         # Precio de materiales
         mat_row = con.execute("SELECT precio_usd FROM materiales WHERE codigo = ?", (material,)).fetchone()
-        precio_csv = mat_row['precio_usd'] if mat_row else 0
+        precio_csv = (mat_row['precio_usd'] or 0) if mat_row else 0
 
-        # Mediana de PO
-        po_prices = con.execute(
-            "SELECT subtotal / (SELECT cantidad FROM solpeds WHERE id = po.solped_id) as precio FROM purchase_orders po WHERE po.solped_id IN (SELECT id FROM solpeds WHERE material = ?)",
-            (material,)
-        ).fetchall()
-        if po_prices:
-            prices = [p['precio'] for p in po_prices if p['precio']]
-            mediana_po = np.median(prices) if prices else 0
-        else:
-            mediana_po = 0
+        # Mediana de PO, precalculada en material_price_stats
+        stats = get_price_stats(con, [material]).get(material)
+        mediana_po = stats["mediana"] if stats else 0
 
         if precio_csv == 0 and mediana_po == 0:
             return None
 
-        # Suavizar
-        precio_est = Settings.AI_PRICE_SMOOTHING * mediana_po + (1 - Settings.AI_PRICE_SMOOTHING) * precio_csv
-        if precio_est == 0:
-            return None
+        # Suavizar (si falta una de las fuentes se usa la otra)
+        if precio_csv and mediana_po:
+            precio_est = Settings.AI_PRICE_SMOOTHING * mediana_po + (1 - Settings.AI_PRICE_SMOOTHING) * precio_csv
+        else:
+            precio_est = mediana_po or precio_csv
+
+        payload: Dict[str, Any] = {"precio_unitario_est": precio_est}
+        reason = "Precio de catálogo (sin PO previas)."
+        if stats:
+            payload.update({"p10": stats["p10"], "p90": stats["p90"], "ultimo_precio": stats["ultimo_precio"]})
+            reason = f"Mediana de {stats['n']} PO (p10 {stats['p10']:.2f} – p90 {stats['p90']:.2f}) + precio de catálogo."
 
         return {
             "type": "precio",
             "title": f"Precio est. USD {precio_est:.2f}",
-            "payload": {"precio_unitario_est": precio_est},
-            "reason": "Mediana de PO + CSV stock.",
-            "confidence": 0.74,
-            "sources": ["purchase_orders", "stock_disponible", "materiales"]
+            "payload": payload,
+            "reason": reason,
+            "confidence": 0.74 if stats else 0.5,
+            "sources": ["material_price_stats", "materiales"] if stats else ["materiales"]
         }
 
-    def _suggest_leadtime(self, con: sqlite3.Connection, material: str, centro: str) -> Optional[Dict[str, Any]]:
-        """Sugiere lead time basado en heurísticas."""
-        # Heurística simple
-        min_days, max_days = 7, 15  # nacional
-        # Si hay histórico de traslados, usar mediana
-        # Por ahora, heurística
+    def _suggest_leadtime(self, item: Dict[str, Any], centro: str, stock_sug: Optional[Dict[str, Any]], prov_sug: Optional[Dict[str, Any]], leadtimes: Dict[Any, Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """Sugiere lead time con los percentiles históricos de compras y traslados (leadtime_stats)."""
+        material = item["material"]
+        split = stock_sug["payload"] if stock_sug else {}
+        tramos = []
+        if not stock_sug or split.get("compra"):
+            proveedor = None
+            if prov_sug:
+                proveedor = (prov_sug["payload"].get("proveedor_nombre") or "").strip() or prov_sug["payload"].get("proveedor_email")
+            tramos.append((FUENTE_COMPRA, proveedor, pick_stats(leadtimes, FUENTE_COMPRA, material, proveedor)))
+        for origen in sorted({a["centro"] for a in split.get("stock", []) if a["centro"] != centro}):
+            ruta = route_key(origen, centro)
+            tramos.append((FUENTE_TRASLADO, ruta, pick_stats(leadtimes, FUENTE_TRASLADO, material, ruta)))
+
+        if not tramos:
+            return {
+                "type": "leadtime",
+                "title": "Lead time estimado: inmediato (stock en el centro)",
+                "payload": {"min": 0, "max": 0, "p50": 0, "p80": 0, "p90": 0, "tramos": []},
+                "reason": "Todo el ítem se cubre con stock del mismo centro.",
+                "confidence": 0.9,
+                "sources": ["stock_disponible"]
+            }
+
+        conocidos = [(fuente, clave, stats) for fuente, clave, stats in tramos if stats]
+        if not conocidos:
+            # Sin histórico suficiente: heurística de proveedor nacional
+            min_days, max_days = 7, 15
+            return {
+                "type": "leadtime",
+                "title": f"Lead time estimado: {min_days}–{max_days} días",
+                "payload": {"min": min_days, "max": max_days, "p50": min_days, "p80": max_days, "p90": max_days, "tramos": []},
+                "reason": "Sin histórico suficiente; heurística de proveedor nacional.",
+                "confidence": 0.4,
+                "sources": []
+            }
+
+        # El ítem está completo cuando llega el tramo más lento.
+        p50 = max(stats["p50"] for _, _, stats in conocidos)
+        p80 = max(stats["p80"] for _, _, stats in conocidos)
+        p90 = max(stats["p90"] for _, _, stats in conocidos)
+        n = min(stats["n"] for _, _, stats in conocidos)
+        especifico = all(stats["nivel"] == "material" for _, _, stats in conocidos)
+        detalle = [
+            {"fuente": fuente, "clave": clave, "nivel": stats["nivel"], "n": stats["n"],
+             "p50": stats["p50"], "p80": stats["p80"], "p90": stats["p90"]}
+            for fuente, clave, stats in conocidos
+        ]
+        origen = " + ".join(
+            f"{'compras' if t['fuente'] == FUENTE_COMPRA else 'traslados'} ({t['n']}, {'material' if t['nivel'] == 'material' else 'general'})"
+            for t in detalle
+        )
+        min_days, max_days = int(round(p50)), int(math.ceil(p90))
 
         return {
             "type": "leadtime",
             "title": f"Lead time estimado: {min_days}–{max_days} días",
-            "payload": {"min": min_days, "max": max_days},
-            "reason": "Proveedor nacional; histórico similar.",
-            "confidence": 0.6,
-            "sources": ["purchase_orders", "traslados"]
+            "payload": {"min": min_days, "max": max_days, "p50": p50, "p80": p80, "p90": p90, "tramos": detalle},
+            "reason": f"Percentiles 50–90 del histórico de {origen}.",
+            "confidence": round(min(0.5 + n / 40.0, 0.9) - (0 if especifico else 0.1), 2),
+            "sources": ["leadtime_stats"]
         }
 
-    def _suggest_sla_risk(self, con: sqlite3.Connection, solicitud_id: int, sol_row: sqlite3.Row, item: sqlite3.Row) -> Optional[Dict[str, Any]]:
-        """Sugiere riesgo SLA."""
-        # Lógica simplificada
+    @staticmethod
+    def _dias_restantes(fecha_necesidad: Optional[str]) -> Optional[int]:
+        if not fecha_necesidad:
+            return None
+        try:
+            return (date.fromisoformat(str(fecha_necesidad)[:10]) - date.today()).days
+        except ValueError:
+            return None
+
+    def _suggest_sla_risk(self, sol_row: sqlite3.Row, lt_sug: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """Sugiere riesgo SLA comparando el lead time estimado con la fecha de necesidad."""
         criticidad = sol_row["criticidad"] or "Normal"
-        # Asumir lead time estimado
-        lead_est = 10  # días
-        # Plazo restante - simplificar
-        prob = "medio" if criticidad == "Alta" and lead_est > 5 else "bajo"
+        lead = lt_sug["payload"] if lt_sug else {}
+        p50 = lead.get("p50", 10)
+        p90 = lead.get("p90", 10)
+        restantes = self._dias_restantes(sol_row["fecha_necesidad"])
+
+        if restantes is None:
+            prob = "medio" if criticidad == "Alta" and p50 > 5 else "bajo"
+            reason = f"Criticidad {criticidad}; lead time esperado {p50:g} días (sin fecha de necesidad)."
+        else:
+            if p90 <= restantes:
+                prob = "bajo"
+            elif p50 <= restantes:
+                prob = "medio"
+            else:
+                prob = "alto"
+            reason = f"Quedan {restantes} días para la fecha de necesidad; lead time p50 {p50:g} / p90 {p90:g} días."
 
         return {
             "type": "sla_risk",
             "title": f"Riesgo SLA: {prob.upper()}",
-            "payload": {"etapa": "po_emision", "prob": prob},
-            "reason": f"Criticidad {criticidad}; lead time esperado {lead_est} días.",
-            "confidence": 0.65,
-            "sources": ["sla_rules", "solicitud_tratamiento_log"]
+            "payload": {"etapa": "po_emision", "prob": prob, "dias_restantes": restantes, "lead_p50": p50, "lead_p90": p90},
+            "reason": reason,
+            "confidence": 0.8 if restantes is not None and lt_sug and "leadtime_stats" in lt_sug["sources"] else 0.6,
+            "sources": ["leadtime_stats", "solicitudes"]
         }
 
     def _suggest_texto_justif(self, con: sqlite3.Connection, item: sqlite3.Row, suggestions: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
@@ -282,60 +439,152 @@ class AIService:
             "sources": ["*resumen interno*"]
         }
 
-    def apply_suggestion(self, solicitud_id: int, item_index: int, suggestion_type: str, payload: Dict[str, Any], actor_id: str) -> bool:
-        """Aplica una sugerencia al sistema."""
+    # Sugerencias que al aceptarse escriben una columna de solicitud_items_tratamiento:
+    # tipo -> (columna, clave del payload, decisión si el ítem aún no tiene fila)
+    _TRATAMIENTO_FIELDS = {
+        "equivalente": ("codigo_equivalente", "material", "equivalente"),
+        "proveedor": ("proveedor_sugerido", "proveedor_nombre", "compra"),
+        "precio": ("precio_unitario_estimado", "precio_unitario_est", "compra"),
+    }
+
+    def apply_decisions(self, solicitud_id: int, decisions: List[Dict[str, Any]], actor_id: str) -> Dict[str, int]:
+        """Acepta o rechaza varias sugerencias en una sola transacción.
+
+        Cada decisión es ``{item_index, type, accepted, payload, confidence}``.
+        Lanza LookupError si la solicitud no existe y ValueError si un ítem o
+        un valor es inválido; en ambos casos no se escribe nada.
+        """
+        actor = actor_id.lower()
         with get_connection() as con:
+            con.execute("BEGIN IMMEDIATE")
             try:
-                # Aplicar según tipo
-                if suggestion_type == "stock_split":
-                    # Guardar en solicitud_items_stock (asumir tabla existe o crear)
-                    # Por ahora, solo log
-                    pass
-                elif suggestion_type == "equivalente":
-                    con.execute(
-                        "UPDATE solicitud_items_tratamiento SET codigo_equivalente = ? WHERE solicitud_id = ? AND item_index = ?",
-                        (payload["material"], solicitud_id, item_index)
-                    )
-                elif suggestion_type == "proveedor":
-                    # Asumir que se guarda en tratamiento
-                    pass
-                elif suggestion_type == "precio":
-                    con.execute(
-                        "UPDATE solicitud_items_tratamiento SET precio_unitario_estimado = ? WHERE solicitud_id = ? AND item_index = ?",
-                        (payload["precio_unitario_est"], solicitud_id, item_index)
+                sol_row = self._fetch_solicitud(con, solicitud_id)
+                if not sol_row:
+                    raise LookupError("Solicitud no encontrada")
+                cantidades = {item["item_index"]: item["cantidad"] for item in self._load_items(sol_row)}
+
+                upserts: Dict[str, List[tuple]] = {}
+                ai_log = []
+                trat_log = []
+                for decision in decisions:
+                    idx = decision["item_index"]
+                    if idx not in cantidades:
+                        raise ValueError(f"Ítem {idx} inválido")
+                    tipo = decision["type"]
+                    payload = decision.get("payload") or {}
+                    accepted = bool(decision.get("accepted", True))
+                    field = self._TRATAMIENTO_FIELDS.get(tipo)
+                    if accepted and field:
+                        column, key, default_decision = field
+                        value = payload.get(key)
+                        if column == "precio_unitario_estimado":
+                            try:
+                                value = float(value)
+                            except (TypeError, ValueError):
+                                raise ValueError(f"Precio inválido en el ítem {idx}")
+                        upserts.setdefault(column, []).append(
+                            (solicitud_id, idx, default_decision, cantidades[idx] or 1, value, actor)
+                        )
+                    confidence = decision.get("confidence")
+                    ai_log.append((
+                        solicitud_id, idx, tipo,
+                        json.dumps(payload if accepted else {}, ensure_ascii=False),
+                        0.8 if confidence is None else confidence,
+                        1 if accepted else 0,
+                        actor,
+                    ))
+                    trat_log.append((
+                        solicitud_id, idx, actor,
+                        "ia_aceptada" if accepted else "ia_rechazada",
+                        json.dumps({"type": tipo, "payload": payload} if accepted else {"type": tipo}, ensure_ascii=False),
+                    ))
+
+                for column, rows in upserts.items():
+                    con.executemany(
+                        f"""
+                        INSERT INTO solicitud_items_tratamiento
+                            (solicitud_id, item_index, decision, cantidad_aprobada, {column}, updated_by, updated_at)
+                        VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                        ON CONFLICT(solicitud_id, item_index) DO UPDATE SET
+                            {column}=excluded.{column},
+                            updated_by=excluded.updated_by,
+                            updated_at=excluded.updated_at
+                        """,
+                        rows,
                     )
-                elif suggestion_type == "texto_justif":
-                    # Actualizar justificación
-                    pass
-
-                # Log
-                con.execute(
-                    "INSERT INTO ai_suggestions_log (solicitud_id, item_index, suggestion_type, payload_json, confidence, accepted, actor_id) VALUES (?, ?, ?, ?, 0.8, 1, ?)",
-                    (solicitud_id, item_index, suggestion_type, json.dumps(payload), actor_id)
+                con.executemany(
+                    "INSERT INTO ai_suggestions_log (solicitud_id, item_index, suggestion_type, payload_json, confidence, accepted, actor_id) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    ai_log,
                 )
-
-                # Log en solicitud_tratamiento_log
-                con.execute(
-                    "INSERT INTO solicitud_tratamiento_log (solicitud_id, actor_id, tipo, payload) VALUES (?, ?, 'IA_aplicada', ?)",
-                    (solicitud_id, actor_id, json.dumps({"type": suggestion_type, "item_index": item_index}))
+                con.executemany(
+                    "INSERT INTO solicitud_tratamiento_log (solicitud_id, item_index, actor_id, tipo, payload_json) VALUES (?, ?, ?, ?, ?)",
+                    trat_log,
                 )
-
                 con.commit()
-                return True
             except Exception:
                 con.rollback()
-                return False
+                raise
+        aceptadas = sum(1 for row in ai_log if row[5])
+        return {"aceptadas": aceptadas, "rechazadas": len(ai_log) - aceptadas}
+
+    def apply_suggestion(self, solicitud_id: int, item_index: int, suggestion_type: str, payload: Dict[str, Any], actor_id: str) -> bool:
+        """Aplica una sugerencia al sistema."""
+        try:
+            self.apply_decisions(solicitud_id, [{"item_index": item_index, "type": suggestion_type, "accepted": True, "payload": payload}], actor_id)
+            return True
+        except Exception:
+            logger.exception("No se pudo aplicar la sugerencia %s de la solicitud %s", suggestion_type, solicitud_id)
+            return False
 
     def reject_suggestion(self, solicitud_id: int, item_index: int, suggestion_type: str, actor_id: str) -> bool:
         """Rechaza una sugerencia."""
-        with get_connection() as con:
-            try:
-                con.execute(
-                    "INSERT INTO ai_suggestions_log (solicitud_id, item_index, suggestion_type, payload_json, confidence, accepted, actor_id) VALUES (?, ?, ?, ?, 0.8, 0, ?)",
-                    (solicitud_id, item_index, suggestion_type, "{}", actor_id)
-                )
-                con.commit()
+        try:
+            self.apply_decisions(solicitud_id, [{"item_index": item_index, "type": suggestion_type, "accepted": False}], actor_id)
+            return True
+        except Exception:
+            logger.exception("No se pudo rechazar la sugerencia %s de la solicitud %s", suggestion_type, solicitud_id)
+            return False
+
+
+class SuggestionPrecomputer:
+    """Calcula en segundo plano las sugerencias de las solicitudes que entran en tratamiento."""
+
+    def __init__(self, service: AIService, workers: int = 1):
+        self._service = service
+        self._workers = max(1, int(workers))
+        self._lock = threading.Lock()
+        self._executor: ThreadPoolExecutor | None = None
+        self._pid: int | None = None
+        self._in_flight: Set[int] = set()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # Created lazily and per process so forked gunicorn workers get their own threads.
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="ai-suggestions")
+            self._pid = os.getpid()
+            self._in_flight = set()
+        return self._executor
+
+    def submit(self, solicitud_id: int) -> bool:
+        if not Settings.AI_ENABLE:
+            return False
+        with self._lock:
+            executor = self._get_executor()
+            if solicitud_id in self._in_flight:
                 return True
-            except Exception:
-                con.rollback()
-                return False
\ No newline at end of file
+            self._in_flight.add(solicitud_id)
+            executor.submit(self._run, solicitud_id)
+        return True
+
+    def _run(self, solicitud_id: int) -> None:
+        try:
+            self._service.get_cached_suggestions(solicitud_id)
+        except Exception:
+            logger.exception("No se pudieron precalcular las sugerencias de la solicitud %s", solicitud_id)
+        finally:
+            with self._lock:
+                self._in_flight.discard(solicitud_id)
+
+
+ai_service = AIService()
+suggestion_precomputer = SuggestionPrecomputer(ai_service)
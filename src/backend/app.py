@@ -16,12 +16,14 @@ from backend.routes.solicitudes import bp as sol_bp
 from backend.routes.notificaciones import bp as notif_bp
 from backend.routes.admin import bp as admin_bp
 from backend.routes.presupuestos import bp as presup_bp
-# from backend.routes.chatbot import bp as chatbot_bp  # Temporalmente comentado para testing
+from backend.routes.chatbot import bp as chatbot_bp
 from backend.routes.catalogos import bp as catalogos_bp
 from backend.routes.archivos import bp as archivos_bp
 from backend.routes.planificador import bp as planner_bp
 from backend.routes.abastecimiento import bp as abastecimiento_bp
-# from backend.routes.ai import bp as ai_bp
+from backend.routes.ai import bp as ai_bp
+from backend.outbox import outbox_dispatcher
+from backend.leadtime import start_refresher as start_leadtime_refresher
 
 def _setup_logging(app: Flask) -> None:
     Settings.ensure_dirs()
@@ -79,11 +81,16 @@ def create_app() -> Flask:
     app.register_blueprint(admin_bp)
     app.register_blueprint(presup_bp)
     app.register_blueprint(planner_bp)
-    # app.register_blueprint(chatbot_bp)  # Temporalmente comentado para testing
+    app.register_blueprint(chatbot_bp)
     app.register_blueprint(catalogos_bp)
     app.register_blueprint(archivos_bp)
     app.register_blueprint(abastecimiento_bp)
-    # app.register_blueprint(ai_bp)
+    app.register_blueprint(ai_bp)
+
+    if Settings.BACKGROUND_JOBS:
+        # create_app corre en cada worker de gunicorn (sin --preload), así los hilos quedan en el worker
+        outbox_dispatcher.start()
+        start_leadtime_refresher()
 
     @app.get("/api/health")
     def health():
@@ -0,0 +1,252 @@
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from .attachment_store import BLOBS_DIRNAME, THUMB_SUFFIX, TMP_DIRNAME
+from .config import Settings
+from .db import get_connection
+
+logger = logging.getLogger(__name__)
+
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+_CHUNKED_RE = re.compile(r"^chunked-([0-9a-f]{32})\.part$")
+# Flat uploads written before hash storage: uuid4().hex plus the original extension
+_LEGACY_RE = re.compile(r"^[0-9a-f]{32}(\.[a-z0-9]+)?$")
+
+KIND_BLOB = "blob"
+KIND_THUMB = "thumb"
+KIND_CHUNKED = "chunked"
+KIND_LEGACY = "legacy"
+KIND_TEMP = "temp"
+KIND_SKIP = "skip"
+
+# (path, kind, key, size)
+Candidate = Tuple[str, str, Optional[str], int]
+
+
+def _iter_files(root: str) -> Iterator[os.DirEntry]:
+    """Depth-first walk with os.scandir; only the directory stack is kept in memory."""
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        yield entry
+        except FileNotFoundError:
+            continue
+
+
+def _classify(root: str, entry: os.DirEntry) -> Tuple[str, Optional[str]]:
+    relative = os.path.relpath(entry.path, root)
+    top = relative.split(os.sep, 1)[0]
+    name = entry.name
+    if top == BLOBS_DIRNAME:
+        if _SHA256_RE.match(name):
+            return KIND_BLOB, name
+        if name.endswith(THUMB_SUFFIX) and _SHA256_RE.match(name[: -len(THUMB_SUFFIX)]):
+            return KIND_THUMB, name[: -len(THUMB_SUFFIX)]
+        return KIND_TEMP, None
+    if top == TMP_DIRNAME:
+        match = _CHUNKED_RE.match(name)
+        if match:
+            return KIND_CHUNKED, match.group(1)
+        return KIND_TEMP, None
+    if os.sep not in relative and _LEGACY_RE.match(name):
+        # Archivos planos anteriores al almacenamiento por hash
+        return KIND_LEGACY, name
+    # Anything else was not written by the attachment store: never delete it.
+    return KIND_SKIP, None
+
+
+def _referenced(con, batch: List[Candidate]) -> set[Tuple[str, str]]:
+    keys: Dict[str, set[str]] = {}
+    for _, kind, key, _ in batch:
+        if key is None:
+            continue
+        group = KIND_BLOB if kind == KIND_THUMB else kind
+        keys.setdefault(group, set()).add(key)
+    queries = {
+        KIND_BLOB: "SELECT DISTINCT sha256 AS k FROM archivos_adjuntos WHERE sha256 IN ({})",
+        KIND_LEGACY: "SELECT DISTINCT nombre_archivo AS k FROM archivos_adjuntos WHERE nombre_archivo IN ({})",
+        KIND_CHUNKED: "SELECT id AS k FROM archivos_uploads WHERE id IN ({})",
+    }
+    found: set[Tuple[str, str]] = set()
+    for group, values in keys.items():
+        params = list(values)
+        sql = queries[group].format(",".join("?" * len(params)))
+        found.update((group, row["k"]) for row in con.execute(sql, params).fetchall())
+    return found
+
+
+def _sweep_batch(batch: List[Candidate], *, dry_run: bool) -> Tuple[int, int]:
+    """Delete the unreferenced files of a batch; returns (files, bytes) removed."""
+    removed = 0
+    freed = 0
+    with get_connection() as con:
+        # Under the write lock uploads cannot place or reference a blob between
+        # the check and the unlink (they do both inside their own transaction).
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            referenced = _referenced(con, batch)
+            for path, kind, key, size in batch:
+                group = KIND_BLOB if kind == KIND_THUMB else kind
+                if key is not None and (group, key) in referenced:
+                    continue
+                if not dry_run:
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        continue
+                    except OSError:
+                        logger.exception("No se pudo eliminar el huérfano %s", path)
+                        continue
+                removed += 1
+                freed += size
+        finally:
+            con.rollback()
+    return removed, freed
+
+
+def _expire_upload_sessions(ttl_seconds: float, *, dry_run: bool) -> int:
+    cutoff = (datetime.utcnow() - timedelta(seconds=ttl_seconds)).strftime("%Y-%m-%d %H:%M:%S")
+    with get_connection() as con:
+        if dry_run:
+            row = con.execute(
+                "SELECT COUNT(*) AS total FROM archivos_uploads WHERE updated_at < ?",
+                (cutoff,),
+            ).fetchone()
+            return int(row["total"])
+        cur = con.execute("DELETE FROM archivos_uploads WHERE updated_at < ?", (cutoff,))
+        con.commit()
+        return cur.rowcount
+
+
+def collect_orphans(
+    *,
+    grace_seconds: Optional[float] = None,
+    session_ttl_seconds: Optional[float] = None,
+    batch_size: int = 500,
+    dry_run: bool = False,
+) -> Dict[str, Any]:
+    """Reconcile ``Settings.UPLOADS_DIR`` against the database and remove what nothing references.
+
+    Files younger than the grace period are never touched, which covers uploads
+    that are still between writing the file and committing their row. Abandoned
+    chunked upload sessions expire first so their parts are swept in the same run.
+    """
+    grace = Settings.ATTACHMENTS_GC_GRACE_SECONDS if grace_seconds is None else grace_seconds
+    ttl = Settings.UPLOAD_SESSION_TTL_SECONDS if session_ttl_seconds is None else session_ttl_seconds
+    started_at = datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
+    stats = {
+        "dry_run": dry_run,
+        "escaneados": 0,
+        "huerfanos": 0,
+        "bytes_liberados": 0,
+        "bytes_fisicos": 0,
+        "sesiones_expiradas": _expire_upload_sessions(ttl, dry_run=dry_run),
+        "started_at": started_at,
+    }
+    root = Settings.UPLOADS_DIR
+    cutoff = time.time() - grace
+    batch: List[Candidate] = []
+
+    def flush() -> None:
+        removed, freed = _sweep_batch(batch, dry_run=dry_run)
+        stats["huerfanos"] += removed
+        stats["bytes_liberados"] += freed
+        batch.clear()
+
+    if os.path.isdir(root):
+        for entry in _iter_files(root):
+            try:
+                info = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            stats["escaneados"] += 1
+            stats["bytes_fisicos"] += info.st_size
+            if info.st_mtime > cutoff:
+                continue
+            kind, key = _classify(root, entry)
+            if kind == KIND_SKIP:
+                continue
+            batch.append((entry.path, kind, key, info.st_size))
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+
+    if not dry_run:
+        stats["bytes_fisicos"] -= stats["bytes_liberados"]
+    with get_connection() as con:
+        con.execute(
+            """
+            INSERT INTO archivos_gc_ejecuciones
+            (dry_run, escaneados, huerfanos, bytes_liberados, bytes_fisicos, sesiones_expiradas, started_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                int(dry_run),
+                stats["escaneados"],
+                stats["huerfanos"],
+                stats["bytes_liberados"],
+                stats["bytes_fisicos"],
+                stats["sesiones_expiradas"],
+                started_at,
+            ),
+        )
+        con.commit()
+    return stats
+
+
+_background_lock = threading.Lock()
+
+
+def start_background(*, dry_run: bool = False) -> bool:
+    """Run ``collect_orphans`` in a daemon thread; False if one is already running in this process.
+
+    The result is recorded in ``archivos_gc_ejecuciones`` like any other run.
+    """
+    if not _background_lock.acquire(blocking=False):
+        return False
+
+    def run() -> None:
+        try:
+            stats = collect_orphans(dry_run=dry_run)
+            logger.info("GC de adjuntos: %s", stats)
+        except Exception:
+            logger.exception("Error en el GC de adjuntos")
+        finally:
+            _background_lock.release()
+
+    try:
+        threading.Thread(target=run, name="attachment-gc", daemon=True).start()
+    except BaseException:
+        _background_lock.release()
+        raise
+    return True
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Elimina adjuntos huérfanos del directorio de uploads")
+    parser.add_argument("--dry-run", action="store_true", help="Solo informar, sin borrar")
+    parser.add_argument("--grace", type=float, default=None, help="Antigüedad mínima en segundos")
+    parser.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args(argv)
+    stats = collect_orphans(grace_seconds=args.grace, batch_size=args.batch_size, dry_run=args.dry_run)
+    print(json.dumps(stats, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import tempfile
+from typing import BinaryIO, Optional, Tuple
+
+from .config import Settings
+
+logger = logging.getLogger(__name__)
+
+BLOBS_DIRNAME = "blobs"
+TMP_DIRNAME = "tmp"
+THUMB_SUFFIX = ".thumb.jpg"
+CHUNK_SIZE = 1024 * 1024
+
+
+def blobs_root() -> str:
+    return os.path.join(Settings.UPLOADS_DIR, BLOBS_DIRNAME)
+
+
+def tmp_root() -> str:
+    return os.path.join(Settings.UPLOADS_DIR, TMP_DIRNAME)
+
+
+def blob_path(sha256: str) -> str:
+    """Blobs fan out over two directory levels so no directory grows unbounded."""
+    return os.path.join(blobs_root(), sha256[:2], sha256[2:4], sha256)
+
+
+def stream_to_temp(stream: BinaryIO, *, chunk_size: int = CHUNK_SIZE) -> Tuple[str, str, int]:
+    """Copy ``stream`` to a temp file inside the uploads volume while hashing it.
+
+    Returns ``(tmp_path, sha256, size)``; memory use is bounded by ``chunk_size``.
+    """
+    directory = tmp_root()
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix="upload-", suffix=".part", dir=directory)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as handle:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                handle.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        discard_temp(tmp_path)
+        raise
+    return tmp_path, digest.hexdigest(), size
+
+
+def chunked_upload_path(upload_id: str) -> str:
+    return os.path.join(tmp_root(), f"chunked-{upload_id}.part")
+
+
+def write_chunk(path: str, offset: int, stream: BinaryIO, *, limit: int, chunk_size: int = 64 * 1024) -> int:
+    """Write up to ``limit`` bytes from ``stream`` at ``offset`` and drop anything past it.
+
+    Retrying the same offset simply overwrites the previous attempt. Returns the
+    number of bytes written.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    mode = "r+b" if os.path.exists(path) else "w+b"
+    written = 0
+    with open(path, mode) as handle:
+        handle.seek(offset)
+        while written < limit:
+            chunk = stream.read(min(chunk_size, limit - written))
+            if not chunk:
+                break
+            handle.write(chunk)
+            written += len(chunk)
+        handle.truncate(offset + written)
+    return written
+
+
+def hash_file(path: str, *, chunk_size: int = CHUNK_SIZE) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def discard_temp(tmp_path: Optional[str]) -> None:
+    if not tmp_path:
+        return
+    try:
+        os.unlink(tmp_path)
+    except FileNotFoundError:
+        pass
+
+
+def store_blob(tmp_path: str, sha256: str) -> str:
+    """Move a hashed temp file into the store, or drop it if the blob already exists.
+
+    Call it after inserting the referencing row and before committing, so it
+    runs under the same write lock as :func:`release_blob`.
+    """
+    path = blob_path(sha256)
+    if os.path.exists(path):
+        discard_temp(tmp_path)
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(tmp_path, path)
+    return path
+
+
+def quota_exceeded(con, user_id: str, extra_bytes: int) -> bool:
+    """True when ``extra_bytes`` more would exceed the per-user quota (``SPM_UPLOAD_QUOTA_BYTES``)."""
+    quota = Settings.UPLOAD_QUOTA_BYTES
+    if quota <= 0:
+        return False
+    row = con.execute(
+        "SELECT bytes FROM archivos_uso WHERE ambito='usuario' AND clave=?",
+        (user_id.lower(),),
+    ).fetchone()
+    used = int(row["bytes"]) if row else 0
+    return used + int(extra_bytes) > quota
+
+
+def release_blob(con, sha256: Optional[str], path: Optional[str]) -> bool:
+    """Unlink the physical file once no row references it; returns True if it was removed.
+
+    Runs after the caller deleted its row and before it commits. Rows from before
+    content addressing have no hash and own their file outright.
+    """
+    if sha256:
+        row = con.execute(
+            "SELECT COUNT(*) AS refs FROM archivos_adjuntos WHERE sha256=?",
+            (sha256,),
+        ).fetchone()
+        if row and row["refs"]:
+            return False
+        path = blob_path(sha256)
+    if not path:
+        return False
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        return False
+    except OSError:
+        logger.exception("No se pudo eliminar el archivo %s", path)
+        return False
+    if sha256:
+        discard_temp(path + THUMB_SUFFIX)
+    return True
@@ -0,0 +1,226 @@
+from __future__ import annotations
+
+import sqlite3
+from typing import Any, Dict, Optional
+
+MOV_APERTURA = "apertura"
+MOV_COMPROMISO = "compromiso"
+MOV_LIBERACION = "liberacion"
+MOV_INCREMENTO = "incremento"
+
+
+def record_movement(
+    con: sqlite3.Connection,
+    *,
+    centro: str,
+    sector: Optional[str],
+    tipo: str,
+    monto: float,
+    saldo_resultante: float,
+    solicitud_id: Optional[int] = None,
+    incorporacion_id: Optional[int] = None,
+    actor_id: Optional[str] = None,
+    detalle: Optional[str] = None,
+) -> int:
+    """Append a movement to the ledger; ``saldo_resultante`` is the balance right after it."""
+    cur = con.execute(
+        """
+        INSERT INTO presupuesto_movimientos
+            (centro, sector, tipo, monto, saldo_resultante, solicitud_id, incorporacion_id, actor_id, detalle)
+        VALUES (?,?,?,?,?,?,?,?,?)
+        """,
+        (
+            centro,
+            sector,
+            tipo,
+            float(monto),
+            float(saldo_resultante),
+            solicitud_id,
+            incorporacion_id,
+            (actor_id or "").lower() or None,
+            detalle,
+        ),
+    )
+    return int(cur.lastrowid)
+
+
+def seed_opening_balances(con: sqlite3.Connection) -> None:
+    """Give every budget without movements an opening entry so running balances start from it."""
+    con.execute(
+        """
+        INSERT INTO presupuesto_movimientos (centro, sector, tipo, monto, saldo_resultante, detalle)
+        SELECT p.centro, p.sector, ?, COALESCE(p.monto_usd, 0), COALESCE(p.saldo_usd, 0), 'Saldo inicial'
+          FROM presupuestos p
+         WHERE NOT EXISTS (
+                SELECT 1 FROM presupuesto_movimientos m
+                 WHERE m.centro = p.centro AND COALESCE(m.sector, '') = COALESCE(p.sector, '')
+         )
+        """,
+        (MOV_APERTURA,),
+    )
+
+
+def _sector_key(sector: Optional[str]) -> str:
+    return (sector or "").strip()
+
+
+def release_budget(
+    con: sqlite3.Connection,
+    *,
+    solicitud_id: int,
+    actor_id: Optional[str] = None,
+    detalle: Optional[str] = None,
+) -> float:
+    """Return to the budget whatever the solicitud still has committed; returns the amount released.
+
+    Idempotent: the outstanding amount comes from the ledger itself, so callers
+    should run it after their own write so it is evaluated under the write lock.
+    """
+    pending_rows = con.execute(
+        """
+        SELECT centro, sector,
+               SUM(CASE WHEN tipo=? THEN monto ELSE -monto END) AS pendiente
+          FROM presupuesto_movimientos
+         WHERE solicitud_id=? AND tipo IN (?, ?)
+      GROUP BY centro, COALESCE(sector, '')
+        """,
+        (MOV_COMPROMISO, solicitud_id, MOV_COMPROMISO, MOV_LIBERACION),
+    ).fetchall()
+    released = 0.0
+    for pending in pending_rows:
+        amount = round(float(pending.get("pendiente") or 0.0), 2)
+        if amount <= 0:
+            continue
+        rows = con.execute(
+            """
+            UPDATE presupuestos SET saldo_usd = saldo_usd + ?
+             WHERE centro=? AND COALESCE(sector, '')=?
+            RETURNING saldo_usd
+            """,
+            (amount, pending["centro"], _sector_key(pending.get("sector"))),
+        ).fetchall()
+        if not rows:
+            continue
+        record_movement(
+            con,
+            centro=pending["centro"],
+            sector=pending.get("sector"),
+            tipo=MOV_LIBERACION,
+            monto=amount,
+            saldo_resultante=float(rows[0].get("saldo_usd") or 0.0),
+            solicitud_id=solicitud_id,
+            actor_id=actor_id,
+            detalle=detalle,
+        )
+        released += amount
+    return released
+
+
+def reserve_budget(
+    con: sqlite3.Connection,
+    *,
+    centro: str,
+    sector: Optional[str],
+    monto: float,
+    solicitud_id: int,
+    actor_id: Optional[str] = None,
+) -> bool:
+    """Commit ``monto`` of the centro/sector budget to a solicitud.
+
+    The balance check and the decrement are one conditional UPDATE, so two
+    approvals racing in different workers can never overdraw the budget. Any
+    earlier commitment of the same solicitud is released first. Returns False
+    when the budget exists but cannot cover the amount; centros/sectores
+    without a budget row are not tracked and always succeed.
+    """
+    release_budget(con, solicitud_id=solicitud_id, actor_id=actor_id, detalle="Reemplazo de compromiso")
+    monto = round(float(monto or 0.0), 2)
+    if monto <= 0:
+        return True
+    key = _sector_key(sector)
+    rows = con.execute(
+        """
+        UPDATE presupuestos SET saldo_usd = saldo_usd - ?
+         WHERE centro=? AND COALESCE(sector, '')=? AND saldo_usd >= ?
+        RETURNING sector, saldo_usd
+        """,
+        (monto, centro, key, monto),
+    ).fetchall()
+    if not rows:
+        exists = con.execute(
+            "SELECT 1 FROM presupuestos WHERE centro=? AND COALESCE(sector, '')=?",
+            (centro, key),
+        ).fetchone()
+        return not exists
+    record_movement(
+        con,
+        centro=centro,
+        sector=rows[0].get("sector"),
+        tipo=MOV_COMPROMISO,
+        monto=monto,
+        saldo_resultante=float(rows[0].get("saldo_usd") or 0.0),
+        solicitud_id=solicitud_id,
+        actor_id=actor_id,
+    )
+    return True
+
+
+def increase_budget(
+    con: sqlite3.Connection,
+    *,
+    centro: str,
+    sector: Optional[str],
+    monto: float,
+    incorporacion_id: Optional[int] = None,
+    actor_id: Optional[str] = None,
+    detalle: Optional[str] = None,
+) -> float:
+    """Add ``monto`` to both the total and the balance, creating the budget if needed; returns the new balance."""
+    key = _sector_key(sector)
+    rows = con.execute(
+        """
+        UPDATE presupuestos SET monto_usd = monto_usd + ?, saldo_usd = saldo_usd + ?
+         WHERE centro=? AND COALESCE(sector, '')=?
+        RETURNING sector, saldo_usd
+        """,
+        (monto, monto, centro, key),
+    ).fetchall()
+    if not rows:
+        rows = con.execute(
+            """
+            INSERT INTO presupuestos (centro, sector, monto_usd, saldo_usd) VALUES (?,?,?,?)
+            ON CONFLICT(centro, sector) DO UPDATE
+               SET monto_usd = monto_usd + excluded.monto_usd, saldo_usd = saldo_usd + excluded.saldo_usd
+            RETURNING sector, saldo_usd
+            """,
+            (centro, key, monto, monto),
+        ).fetchall()
+    saldo = float(rows[0].get("saldo_usd") or 0.0)
+    record_movement(
+        con,
+        centro=centro,
+        sector=rows[0].get("sector"),
+        tipo=MOV_INCREMENTO,
+        monto=monto,
+        saldo_resultante=saldo,
+        incorporacion_id=incorporacion_id,
+        actor_id=actor_id,
+        detalle=detalle,
+    )
+    return saldo
+
+
+def serialize_movement(row: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": row.get("id"),
+        "centro": row.get("centro"),
+        "sector": row.get("sector"),
+        "tipo": row.get("tipo"),
+        "monto": float(row.get("monto") or 0.0),
+        "saldo_resultante": float(row.get("saldo_resultante") or 0.0),
+        "solicitud_id": row.get("solicitud_id"),
+        "incorporacion_id": row.get("incorporacion_id"),
+        "actor_id": row.get("actor_id"),
+        "detalle": row.get("detalle"),
+        "created_at": row.get("created_at"),
+    }
@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import json
+import threading
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+from flask import current_app, request
+
+CATALOG_VERSION_KEY = "catalogos"
+MATERIALES_VERSION_KEY = "materiales"
+CHATBOT_CACHE_VERSION_KEY = "chatbot_cache"
+ALL_SCOPE = "all"
+
+
+def get_catalog_version(con, nombre: str = CATALOG_VERSION_KEY) -> int:
+    row = con.execute(
+        "SELECT version FROM catalog_versions WHERE nombre=?",
+        (nombre,),
+    ).fetchone()
+    return int(row["version"]) if row else 0
+
+
+def bump_catalog_version(con, nombre: str = CATALOG_VERSION_KEY) -> None:
+    """Invalidate every worker's catalog cache; runs inside the caller's transaction."""
+    con.execute(
+        """
+        INSERT INTO catalog_versions (nombre, version) VALUES (?, 1)
+        ON CONFLICT(nombre) DO UPDATE SET version=version+1, updated_at=CURRENT_TIMESTAMP
+        """,
+        (nombre,),
+    )
+
+
+def _row_to_item(meta: Dict[str, Any], row: Dict[str, Any]) -> Dict[str, Any]:
+    item = dict(row)
+    for boolean_field in meta.get("bools", ()):  # type: ignore[arg-type]
+        if boolean_field in item:
+            item[boolean_field] = bool(item[boolean_field])
+    return item
+
+
+class CatalogCache:
+    """Serialized catalog payloads kept per worker and keyed by the catalog version.
+
+    The version lives in ``catalog_versions`` so a write in any gunicorn worker
+    invalidates the copies held by the others on their next request.
+    """
+
+    def __init__(self, resources: Mapping[str, Dict[str, Any]]):
+        self._resources = resources
+        self._lock = threading.Lock()
+        self._entries: Dict[Tuple[str, bool], Tuple[int, bytes]] = {}
+
+    def fetch_items(self, con, resource: str, *, include_inactive: bool = False) -> Optional[List[Dict[str, Any]]]:
+        meta = self._resources.get(resource)
+        if not meta:
+            return None
+        table = meta["table"]
+        order_by = meta.get("order_by") or "id"
+        where = ""
+        if not include_inactive and "activo" in meta.get("fields", ()):  # type: ignore[arg-type]
+            where = "WHERE activo=1"
+        rows = con.execute(f"SELECT * FROM {table} {where} ORDER BY {order_by}").fetchall()
+        return [_row_to_item(meta, row) for row in rows]
+
+    def _build_body(self, con, scope: str, include_inactive: bool) -> Optional[bytes]:
+        if scope == ALL_SCOPE:
+            data = {
+                resource: self.fetch_items(con, resource, include_inactive=include_inactive) or []
+                for resource in self._resources
+            }
+            payload: Dict[str, Any] = {"ok": True, "data": data}
+        else:
+            items = self.fetch_items(con, scope, include_inactive=include_inactive)
+            if items is None:
+                return None
+            payload = {"ok": True, "items": items}
+        return json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+    def get(self, con, scope: str, *, include_inactive: bool) -> Optional[Tuple[int, bytes]]:
+        if scope != ALL_SCOPE and scope not in self._resources:
+            return None
+        version = get_catalog_version(con)
+        key = (scope, include_inactive)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry and entry[0] == version:
+            return entry
+        body = self._build_body(con, scope, include_inactive)
+        if body is None:
+            return None
+        entry = (version, body)
+        with self._lock:
+            self._entries[key] = entry
+        return entry
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def response(self, con, scope: str, *, include_inactive: bool):
+        """Return a conditional JSON response (304 when the client ETag matches) or None if unknown."""
+        entry = self.get(con, scope, include_inactive=include_inactive)
+        if entry is None:
+            return None
+        version, body = entry
+        etag = f"catalogos-{version}-{scope}-{int(include_inactive)}"
+        if request.if_none_match.contains_weak(etag):
+            resp = current_app.response_class(status=304)
+        else:
+            resp = current_app.response_class(body, mimetype="application/json")
+        resp.set_etag(etag)
+        resp.headers["Cache-Control"] = "private, no-cache"
+        return resp
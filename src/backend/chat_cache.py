@@ -0,0 +1,125 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from .catalog_cache import CHATBOT_CACHE_VERSION_KEY, bump_catalog_version, get_catalog_version
+from .config import Settings
+
+_SPACES = re.compile(r"\s+")
+_EDGE_PUNCTUATION = "¿?¡!.,;: "
+
+
+def normalize_message(message: str) -> str:
+    """Lowercase, accent-free, single-spaced text without surrounding punctuation."""
+    text = unicodedata.normalize("NFKD", message).encode("ascii", "ignore").decode()
+    return _SPACES.sub(" ", text.lower()).strip(_EDGE_PUNCTUATION)
+
+
+class ChatResponseCache:
+    """Per-worker LRU+TTL cache of chatbot answers.
+
+    Entries are keyed by model, normalized question and a hash of the preceding
+    (sanitized) conversation, so the same question in a different context is a
+    different entry. Invalidation bumps a version in ``catalog_versions``; every
+    worker compares it on lookup and drops its entries when it changed.
+    """
+
+    def __init__(
+        self,
+        max_entries: Optional[int] = None,
+        ttl: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self._max_entries = int(max_entries if max_entries is not None else Settings.CHATBOT_CACHE_MAX_ENTRIES)
+        self._ttl = float(ttl if ttl is not None else Settings.CHATBOT_CACHE_TTL)
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._version: Optional[int] = None
+        self._pid: Optional[int] = None
+        self._counters = {"aciertos": 0, "fallos": 0, "expiradas": 0, "desalojadas": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self._max_entries > 0 and self._ttl > 0
+
+    @staticmethod
+    def key(model: str, history: List[Dict[str, str]]) -> str:
+        """``history`` ends with the user's question, as sent to the model."""
+        *context, question = history
+        raw = json.dumps(
+            {"model": model, "context": context, "question": normalize_message(question["content"])},
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _sync(self, con) -> None:
+        # Called with the lock held.
+        if self._pid != os.getpid():
+            # Entries stored before a fork belong to the parent; start the worker clean.
+            if self._pid is not None:
+                self._entries.clear()
+                self._version = None
+            self._pid = os.getpid()
+        version = get_catalog_version(con, CHATBOT_CACHE_VERSION_KEY)
+        if self._version is not None and version != self._version:
+            self._entries.clear()
+        self._version = version
+
+    def get(self, con, key: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            self._sync(con)
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= self._clock():
+                del self._entries[key]
+                self._counters["expiradas"] += 1
+                entry = None
+            if entry is None:
+                self._counters["fallos"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counters["aciertos"] += 1
+            return entry[1]
+
+    def put(self, key: str, answer: str) -> None:
+        if not self.enabled or not answer:
+            return
+        with self._lock:
+            self._entries[key] = (self._clock() + self._ttl, answer)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+                self._counters["desalojadas"] += 1
+
+    def invalidate(self, con) -> None:
+        """Drop every worker's entries; runs inside the caller's transaction."""
+        bump_catalog_version(con, CHATBOT_CACHE_VERSION_KEY)
+        with self._lock:
+            self._entries.clear()
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            consultas = self._counters["aciertos"] + self._counters["fallos"]
+            return {
+                "pid": self._pid,
+                "habilitada": self.enabled,
+                "entradas": len(self._entries),
+                "max_entradas": self._max_entries,
+                "ttl_s": self._ttl,
+                **self._counters,
+                "tasa_aciertos": round(self._counters["aciertos"] / consultas, 3) if consultas else 0.0,
+            }
+
+
+chat_cache = ChatResponseCache()
@@ -20,16 +20,71 @@ class Settings:
     ENV = os.getenv("SPM_ENV", "production")
     OLLAMA_ENDPOINT = os.getenv("SPM_OLLAMA_URL", "http://127.0.0.1:11434")
     OLLAMA_MODEL = os.getenv("SPM_OLLAMA_MODEL", "mistral")
+    # Conexiones keep-alive por worker y timeouts (el de lectura es entre fragmentos del stream)
+    OLLAMA_POOL_SIZE = int(os.getenv("SPM_OLLAMA_POOL_SIZE", "8"))
+    OLLAMA_CONNECT_TIMEOUT = float(os.getenv("SPM_OLLAMA_CONNECT_TIMEOUT", "5"))
+    OLLAMA_READ_TIMEOUT = float(os.getenv("SPM_OLLAMA_READ_TIMEOUT", "120"))
+    # Carril acotado de llamadas al LLM, por worker: el resto de los hilos sigue atendiendo la API
+    LLM_MAX_IN_FLIGHT = int(os.getenv("SPM_LLM_MAX_IN_FLIGHT", "2"))
+    LLM_MAX_QUEUE = int(os.getenv("SPM_LLM_MAX_QUEUE", "2"))
+    LLM_QUEUE_TIMEOUT = float(os.getenv("SPM_LLM_QUEUE_TIMEOUT", "15"))
+    LLM_BREAKER_THRESHOLD = int(os.getenv("SPM_LLM_BREAKER_THRESHOLD", "5"))
+    LLM_BREAKER_COOLDOWN = float(os.getenv("SPM_LLM_BREAKER_COOLDOWN", "30"))
+    # Caché de respuestas del chatbot por worker; 0 entradas o TTL 0 = deshabilitada
+    CHATBOT_CACHE_MAX_ENTRIES = int(os.getenv("SPM_CHATBOT_CACHE_MAX_ENTRIES", "500"))
+    CHATBOT_CACHE_TTL = float(os.getenv("SPM_CHATBOT_CACHE_TTL", str(6 * 3600)))
+    # Materiales del catálogo que se agregan al prompt; 0 = sin contexto de catálogo
+    CHATBOT_RAG_TOP_K = int(os.getenv("SPM_CHATBOT_RAG_TOP_K", "5"))
+    CHATBOT_RAG_MIN_SCORE = float(os.getenv("SPM_CHATBOT_RAG_MIN_SCORE", "0.15"))
+    CATALOG_CSV_SYNC_INTERVAL = float(os.getenv("SPM_CATALOG_CSV_SYNC_INTERVAL", "5"))
     
     # Configuración de IA
     AI_ENABLE: bool = bool(int(os.getenv("AI_ENABLE", "1")))
     AI_EMBED_MODEL: str = os.getenv("AI_EMBED_MODEL", "sentence-transformers/all-MiniLM-L6-v2")  # si se usa local
     AI_PRICE_SMOOTHING: float = float(os.getenv("AI_PRICE_SMOOTHING", "0.5"))
     AI_MAX_SUGGESTIONS: int = int(os.getenv("AI_MAX_SUGGESTIONS", "5"))
+    AI_INDEX_MAX_FEATURES: int = int(os.getenv("AI_INDEX_MAX_FEATURES", "20000"))
+    # Muestras mínimas de un grupo de lead time antes de caer al agregado más general
+    AI_LEADTIME_MIN_SAMPLES: int = int(os.getenv("AI_LEADTIME_MIN_SAMPLES", "3"))
+    LEADTIME_REFRESH_INTERVAL = float(os.getenv("SPM_LEADTIME_REFRESH_INTERVAL", "3600"))
     
     # Configuración de archivos adjuntos
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB máximo por archivo
     ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'doc', 'docx', 'xls', 'xlsx', 'csv'}
+    # Subidas por partes: cada PUT queda por debajo de MAX_CONTENT_LENGTH
+    UPLOAD_CHUNK_SIZE = int(os.getenv("SPM_UPLOAD_CHUNK_SIZE", str(4 * 1024 * 1024)))
+    MAX_UPLOAD_SIZE = int(os.getenv("SPM_MAX_UPLOAD_SIZE", str(512 * 1024 * 1024)))
+    UPLOAD_SESSION_TTL_SECONDS = float(os.getenv("SPM_UPLOAD_SESSION_TTL", str(48 * 3600)))
+    # Cuota de almacenamiento por usuario en bytes; 0 = sin límite
+    UPLOAD_QUOTA_BYTES = int(os.getenv("SPM_UPLOAD_QUOTA_BYTES", "0"))
+    ATTACHMENTS_GC_GRACE_SECONDS = float(os.getenv("SPM_ATTACHMENTS_GC_GRACE", str(24 * 3600)))
+    THUMBNAIL_WORKERS = int(os.getenv("SPM_THUMBNAIL_WORKERS", "2"))
+    THUMBNAIL_MAX_PX = int(os.getenv("SPM_THUMBNAIL_MAX_PX", "320"))
+    # Prefijo de la location interna de nginx; vacío = Flask envía los bytes
+    ATTACHMENTS_ACCEL_PREFIX = os.getenv("SPM_ATTACHMENTS_ACCEL_PREFIX", "")
+
+    # Envío de correos de la outbox
+    SMTP_HOST = os.getenv("SPM_SMTP_HOST", "localhost")
+    SMTP_PORT = int(os.getenv("SPM_SMTP_PORT", "25"))
+    SMTP_USER = os.getenv("SPM_SMTP_USER", "")
+    SMTP_PASSWORD = os.getenv("SPM_SMTP_PASSWORD", "")
+    SMTP_FROM = os.getenv("SPM_SMTP_FROM", "spm@localhost")
+    SMTP_STARTTLS = os.getenv("SPM_SMTP_STARTTLS", "0") == "1"
+    SMTP_SSL = os.getenv("SPM_SMTP_SSL", "0") == "1"
+    SMTP_TIMEOUT = float(os.getenv("SPM_SMTP_TIMEOUT", "30"))
+    # Hilos de fondo (outbox, lead time) dentro de cada worker web; 0 si corren como servicios aparte
+    BACKGROUND_JOBS = os.getenv("SPM_BACKGROUND_JOBS", "1") == "1"
+    OUTBOX_POLL_INTERVAL = float(os.getenv("SPM_OUTBOX_POLL_INTERVAL", "5"))
+    OUTBOX_WORKERS = int(os.getenv("SPM_OUTBOX_WORKERS", "2"))
+    OUTBOX_BATCH_SIZE = int(os.getenv("SPM_OUTBOX_BATCH_SIZE", "20"))
+    # Mensajes por segundo entre todos los hilos; 0 = sin límite
+    OUTBOX_RATE_PER_SECOND = float(os.getenv("SPM_OUTBOX_RATE", "5"))
+    OUTBOX_MAX_ATTEMPTS = int(os.getenv("SPM_OUTBOX_MAX_ATTEMPTS", "6"))
+    OUTBOX_BACKOFF_BASE = float(os.getenv("SPM_OUTBOX_BACKOFF_BASE", "60"))
+    OUTBOX_BACKOFF_MAX = float(os.getenv("SPM_OUTBOX_BACKOFF_MAX", str(6 * 3600)))
+    OUTBOX_CLAIM_TIMEOUT = float(os.getenv("SPM_OUTBOX_CLAIM_TIMEOUT", "600"))
+    # Lotes que despacha POST /admin/outbox/send_all dentro de la petición; el resto queda para el worker
+    OUTBOX_REQUEST_MAX_BATCHES = int(os.getenv("SPM_OUTBOX_REQUEST_MAX_BATCHES", "2"))
 
     @classmethod
     def ensure_dirs(cls) -> None:
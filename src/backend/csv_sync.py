@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+import atexit
+import csv
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Dict
+
+from .config import Settings
+from .db import get_connection
+
+logger = logging.getLogger(__name__)
+
+# Minimum pause before retrying a failed rewrite, so interval 0 cannot spin.
+_RETRY_DELAY = 5.0
+
+
+def write_catalog_csv(con, meta: Dict[str, Any]) -> None:
+    """Rewrite the CSV mirror of a catalog table atomically (temp file + rename)."""
+    csv_meta = meta.get("csv")
+    if not csv_meta:
+        return
+    filename = csv_meta.get("filename")
+    columns = csv_meta.get("columns") or meta.get("fields") or ()
+    if not filename or not columns:
+        return
+    path = os.path.join(Settings.DATA_DIR, filename)
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    table = meta["table"]
+    order_by = meta.get("order_by") or columns[0]
+    column_clause = ", ".join(columns)
+    rows = con.execute(f"SELECT {column_clause} FROM {table} ORDER BY {order_by}").fetchall()
+    bool_columns = set(meta.get("bools", ()))  # type: ignore[arg-type]
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{filename}.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8", newline="") as handle:
+            writer = csv.writer(handle)
+            writer.writerow(columns)
+            for row in rows:
+                writer.writerow(
+                    [
+                        "" if row[col] is None else (1 if col in bool_columns and bool(row[col]) else row[col])
+                        for col in columns
+                    ]
+                )
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class CatalogCsvWriter:
+    """Write-behind CSV sync: edits mark a catalog dirty and a background thread
+    rewrites each dirty file at most once per ``interval`` seconds."""
+
+    def __init__(self, interval: float):
+        self._interval = max(0.0, float(interval))
+        self._lock = threading.Lock()
+        self._pending = threading.Event()
+        self._dirty: Dict[str, Dict[str, Any]] = {}
+        self._thread: threading.Thread | None = None
+        atexit.register(self.flush)
+
+    def mark_dirty(self, meta: Dict[str, Any]) -> None:
+        if not meta.get("csv"):
+            return
+        with self._lock:
+            self._dirty[meta["table"]] = meta
+            self._pending.set()
+            if self._thread is None or not self._thread.is_alive():
+                # Started lazily so it lives in the worker process, not a pre-fork parent.
+                self._thread = threading.Thread(target=self._run, name="catalog-csv-sync", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            self._pending.wait()
+            # Coalescing window: every edit that lands while we sleep shares one rewrite.
+            time.sleep(self._interval)
+            if not self.flush():
+                time.sleep(_RETRY_DELAY)
+
+    def flush(self) -> bool:
+        """Rewrite every dirty catalog; False if any of them failed and stays dirty."""
+        with self._lock:
+            pending = self._dirty
+            self._dirty = {}
+            self._pending.clear()
+        ok = True
+        for table, meta in pending.items():
+            try:
+                with get_connection() as con:
+                    write_catalog_csv(con, meta)
+            except Exception:
+                logger.exception("No se pudo sincronizar el CSV de %s", table)
+                ok = False
+                with self._lock:
+                    self._dirty.setdefault(table, meta)
+                    self._pending.set()
+        return ok
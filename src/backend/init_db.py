@@ -6,8 +6,12 @@ import sqlite3
 import unicodedata
 from typing import Callable, Iterable, Sequence
 
+from .budget_ledger import seed_opening_balances
+from .catalog_cache import MATERIALES_VERSION_KEY, bump_catalog_version
 from .config import Settings
 from .db import get_connection
+from .leadtime import refresh_leadtime_stats
+from .price_stats import backfill_price_stats
 from .security import hash_password
 
 MigrationFn = Callable[[sqlite3.Connection], None]
@@ -353,6 +357,58 @@ def _backfill_catalog_tables(con: sqlite3.Connection) -> None:
     _insert_ignore_many(con, "catalog_sectores", ("nombre", "descripcion", "activo"), sector_rows)
 
 
+def _sync_usuarios_fts(con: sqlite3.Connection) -> None:
+    """Rebuild the user search index when it drifted (e.g. created on an existing database).
+
+    Entries must share their rowid with the user row, which indexes built
+    before the rowid-keyed triggers do not.
+    """
+    indexed = con.execute("SELECT COUNT(*) AS total FROM usuarios_fts").fetchone()["total"]
+    aligned = con.execute(
+        "SELECT COUNT(*) AS total FROM usuarios_fts f JOIN usuarios u ON u.rowid = f.rowid AND u.id_spm = f.id_spm"
+    ).fetchone()["total"]
+    total = con.execute("SELECT COUNT(*) AS total FROM usuarios").fetchone()["total"]
+    if indexed == total == aligned:
+        return
+    con.execute("DELETE FROM usuarios_fts")
+    con.execute(
+        """
+        INSERT INTO usuarios_fts (rowid, id_spm, nombre, apellido, rol, centros)
+        SELECT rowid, id_spm, nombre, apellido, rol, centros FROM usuarios
+        """
+    )
+
+
+def _sync_archivos_uso(con: sqlite3.Connection) -> None:
+    """Recompute storage totals when they disagree with archivos_adjuntos (e.g. on an existing database)."""
+    expected = con.execute(
+        "SELECT COUNT(*) AS total, COALESCE(SUM(tamano_bytes), 0) AS bytes FROM archivos_adjuntos"
+    ).fetchone()
+    tracked = con.execute(
+        """
+        SELECT COALESCE(SUM(archivos), 0) AS total, COALESCE(SUM(bytes), 0) AS bytes
+          FROM archivos_uso WHERE ambito='usuario'
+        """
+    ).fetchone()
+    if expected["total"] == tracked["total"] and expected["bytes"] == tracked["bytes"]:
+        return
+    con.execute("DELETE FROM archivos_uso")
+    con.execute(
+        """
+        INSERT INTO archivos_uso (ambito, clave, archivos, bytes)
+        SELECT 'usuario', lower(usuario_id), COUNT(*), COALESCE(SUM(tamano_bytes), 0)
+          FROM archivos_adjuntos GROUP BY lower(usuario_id)
+        """
+    )
+    con.execute(
+        """
+        INSERT INTO archivos_uso (ambito, clave, archivos, bytes)
+        SELECT 'solicitud', CAST(solicitud_id AS TEXT), COUNT(*), COALESCE(SUM(tamano_bytes), 0)
+          FROM archivos_adjuntos GROUP BY solicitud_id
+        """
+    )
+
+
 def build_db(force: bool = False) -> None:
     Settings.ensure_dirs()
     if force and os.path.exists(Settings.DB_PATH):
@@ -387,6 +443,28 @@ def build_db(force: bool = False) -> None:
                 updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY(usuario_id) REFERENCES usuarios(id_spm)
             );
+            CREATE VIRTUAL TABLE IF NOT EXISTS usuarios_fts USING fts5(
+                id_spm, nombre, apellido, rol, centros,
+                tokenize = "unicode61 remove_diacritics 2"
+            );
+            -- The index shares rowids with usuarios so the triggers delete by rowid
+            -- (a direct lookup) instead of scanning the FTS table for id_spm.
+            -- Dropped first so databases with the older triggers pick these up.
+            DROP TRIGGER IF EXISTS usuarios_fts_ai;
+            DROP TRIGGER IF EXISTS usuarios_fts_ad;
+            DROP TRIGGER IF EXISTS usuarios_fts_au;
+            CREATE TRIGGER usuarios_fts_ai AFTER INSERT ON usuarios BEGIN
+                INSERT INTO usuarios_fts (rowid, id_spm, nombre, apellido, rol, centros)
+                VALUES (new.rowid, new.id_spm, new.nombre, new.apellido, new.rol, new.centros);
+            END;
+            CREATE TRIGGER usuarios_fts_ad AFTER DELETE ON usuarios BEGIN
+                DELETE FROM usuarios_fts WHERE rowid = old.rowid;
+            END;
+            CREATE TRIGGER usuarios_fts_au AFTER UPDATE OF id_spm, nombre, apellido, rol, centros ON usuarios BEGIN
+                DELETE FROM usuarios_fts WHERE rowid = old.rowid;
+                INSERT INTO usuarios_fts (rowid, id_spm, nombre, apellido, rol, centros)
+                VALUES (new.rowid, new.id_spm, new.nombre, new.apellido, new.rol, new.centros);
+            END;
             CREATE INDEX IF NOT EXISTS idx_profile_request_user ON user_profile_requests(usuario_id);
             CREATE INDEX IF NOT EXISTS idx_profile_request_estado ON user_profile_requests(estado);
             CREATE TABLE IF NOT EXISTS materiales(
@@ -475,6 +553,24 @@ def build_db(force: bool = False) -> None:
             );
             CREATE INDEX IF NOT EXISTS idx_inc_estado ON presupuesto_incorporaciones(estado);
             CREATE INDEX IF NOT EXISTS idx_inc_centro ON presupuesto_incorporaciones(centro);
+            CREATE TABLE IF NOT EXISTS presupuesto_movimientos(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                centro TEXT NOT NULL,
+                sector TEXT,
+                tipo TEXT NOT NULL,
+                monto REAL NOT NULL,
+                saldo_resultante REAL NOT NULL,
+                solicitud_id INTEGER,
+                incorporacion_id INTEGER,
+                actor_id TEXT,
+                detalle TEXT,
+                created_at TEXT NOT NULL DEFAULT (strftime('%Y-%m-%dT%H:%M:%S', 'now')),
+                FOREIGN KEY(solicitud_id) REFERENCES solicitudes(id),
+                FOREIGN KEY(incorporacion_id) REFERENCES presupuesto_incorporaciones(id)
+            );
+            CREATE INDEX IF NOT EXISTS idx_mov_centro_sector ON presupuesto_movimientos(centro, sector, created_at);
+            CREATE INDEX IF NOT EXISTS idx_mov_solicitud ON presupuesto_movimientos(solicitud_id);
+            CREATE INDEX IF NOT EXISTS idx_sol_centro_sector ON solicitudes(centro, sector, created_at);
             CREATE TABLE IF NOT EXISTS catalog_centros(
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 codigo TEXT NOT NULL UNIQUE,
@@ -524,6 +620,11 @@ def build_db(force: bool = False) -> None:
             CREATE INDEX IF NOT EXISTS idx_catalog_roles_nombre ON catalog_roles(nombre);
             CREATE INDEX IF NOT EXISTS idx_catalog_puestos_nombre ON catalog_puestos(nombre);
             CREATE INDEX IF NOT EXISTS idx_catalog_sectores_nombre ON catalog_sectores(nombre);
+            CREATE TABLE IF NOT EXISTS catalog_versions(
+                nombre TEXT PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0,
+                updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+            );
             CREATE TABLE IF NOT EXISTS archivos_adjuntos(
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 solicitud_id INTEGER NOT NULL,
@@ -539,6 +640,59 @@ def build_db(force: bool = False) -> None:
             );
             CREATE INDEX IF NOT EXISTS idx_archivos_solicitud ON archivos_adjuntos(solicitud_id);
             CREATE INDEX IF NOT EXISTS idx_archivos_usuario ON archivos_adjuntos(usuario_id);
+            CREATE TABLE IF NOT EXISTS archivos_uploads(
+                id TEXT PRIMARY KEY,
+                solicitud_id INTEGER NOT NULL,
+                usuario_id TEXT NOT NULL,
+                nombre_original TEXT NOT NULL,
+                tipo_mime TEXT,
+                tamano_total INTEGER NOT NULL,
+                recibido_bytes INTEGER NOT NULL DEFAULT 0,
+                sha256_esperado TEXT,
+                escritura_token TEXT,
+                escritura_at TEXT,
+                created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY(solicitud_id) REFERENCES solicitudes(id) ON DELETE CASCADE,
+                FOREIGN KEY(usuario_id) REFERENCES usuarios(id_spm)
+            );
+            CREATE INDEX IF NOT EXISTS idx_archivos_uploads_updated ON archivos_uploads(updated_at);
+            CREATE TABLE IF NOT EXISTS archivos_uso(
+                ambito TEXT NOT NULL,
+                clave TEXT NOT NULL,
+                archivos INTEGER NOT NULL DEFAULT 0,
+                bytes INTEGER NOT NULL DEFAULT 0,
+                updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY(ambito, clave)
+            );
+            CREATE INDEX IF NOT EXISTS idx_archivos_uso_bytes ON archivos_uso(ambito, bytes);
+            CREATE TRIGGER IF NOT EXISTS archivos_uso_ai AFTER INSERT ON archivos_adjuntos BEGIN
+                INSERT INTO archivos_uso(ambito, clave, archivos, bytes)
+                VALUES ('usuario', lower(new.usuario_id), 1, COALESCE(new.tamano_bytes, 0))
+                ON CONFLICT(ambito, clave) DO UPDATE
+                   SET archivos = archivos + 1, bytes = bytes + excluded.bytes, updated_at = CURRENT_TIMESTAMP;
+                INSERT INTO archivos_uso(ambito, clave, archivos, bytes)
+                VALUES ('solicitud', CAST(new.solicitud_id AS TEXT), 1, COALESCE(new.tamano_bytes, 0))
+                ON CONFLICT(ambito, clave) DO UPDATE
+                   SET archivos = archivos + 1, bytes = bytes + excluded.bytes, updated_at = CURRENT_TIMESTAMP;
+            END;
+            CREATE TRIGGER IF NOT EXISTS archivos_uso_ad AFTER DELETE ON archivos_adjuntos BEGIN
+                UPDATE archivos_uso
+                   SET archivos = archivos - 1, bytes = bytes - COALESCE(old.tamano_bytes, 0), updated_at = CURRENT_TIMESTAMP
+                 WHERE (ambito = 'usuario' AND clave = lower(old.usuario_id))
+                    OR (ambito = 'solicitud' AND clave = CAST(old.solicitud_id AS TEXT));
+            END;
+            CREATE TABLE IF NOT EXISTS archivos_gc_ejecuciones(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                dry_run INTEGER NOT NULL DEFAULT 0,
+                escaneados INTEGER NOT NULL DEFAULT 0,
+                huerfanos INTEGER NOT NULL DEFAULT 0,
+                bytes_liberados INTEGER NOT NULL DEFAULT 0,
+                bytes_fisicos INTEGER NOT NULL DEFAULT 0,
+                sesiones_expiradas INTEGER NOT NULL DEFAULT 0,
+                started_at TEXT NOT NULL,
+                finished_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+            );
             CREATE TABLE IF NOT EXISTS solicitud_items_tratamiento(
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 solicitud_id INTEGER NOT NULL,
@@ -564,7 +718,8 @@ def build_db(force: bool = False) -> None:
                 created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
                 FOREIGN KEY(solicitud_id) REFERENCES solicitudes(id) ON DELETE CASCADE
             );
-            CREATE INDEX IF NOT EXISTS idx_trat_eventos_sol ON solicitud_tratamiento_eventos(solicitud_id);
+            DROP INDEX IF EXISTS idx_trat_eventos_sol;
+            CREATE INDEX IF NOT EXISTS idx_trat_eventos_sol_ts ON solicitud_tratamiento_eventos(solicitud_id, created_at);
             CREATE TABLE IF NOT EXISTS solicitud_tratamiento_log(
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 solicitud_id INTEGER NOT NULL,
@@ -613,6 +768,7 @@ def build_db(force: bool = False) -> None:
                 FOREIGN KEY(solicitud_id) REFERENCES solicitudes(id) ON DELETE CASCADE
             );
             CREATE INDEX IF NOT EXISTS idx_solped_sol ON solpeds(solicitud_id);
+            CREATE INDEX IF NOT EXISTS idx_solped_material ON solpeds(material);
             CREATE TABLE IF NOT EXISTS purchase_orders(
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 solped_id INTEGER NOT NULL,
@@ -630,6 +786,48 @@ def build_db(force: bool = False) -> None:
                 FOREIGN KEY(solicitud_id) REFERENCES solicitudes(id) ON DELETE CASCADE
             );
             CREATE INDEX IF NOT EXISTS idx_po_sol ON purchase_orders(solicitud_id);
+            CREATE INDEX IF NOT EXISTS idx_po_solped ON purchase_orders(solped_id);
+            CREATE TABLE IF NOT EXISTS stock_snapshots(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                origen TEXT,
+                estado TEXT NOT NULL DEFAULT 'cargando',
+                filas INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                snapshot_at TEXT NOT NULL,
+                created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                finished_at TEXT
+            );
+            CREATE TABLE IF NOT EXISTS stock_disponible(
+                snapshot_id INTEGER NOT NULL,
+                material TEXT NOT NULL,
+                centro TEXT NOT NULL,
+                almacen TEXT NOT NULL DEFAULT '',
+                lote TEXT,
+                cantidad REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_stock_material_centro ON stock_disponible(snapshot_id, material, centro);
+            CREATE TABLE IF NOT EXISTS material_price_stats(
+                material TEXT PRIMARY KEY,
+                n INTEGER NOT NULL,
+                mediana REAL NOT NULL,
+                p10 REAL NOT NULL,
+                p90 REAL NOT NULL,
+                ultimo_precio REAL NOT NULL,
+                ultimo_po_id INTEGER,
+                updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+            );
+            CREATE TABLE IF NOT EXISTS leadtime_stats(
+                fuente TEXT NOT NULL,
+                material TEXT NOT NULL,
+                clave TEXT NOT NULL,
+                n INTEGER NOT NULL,
+                media REAL NOT NULL,
+                p50 REAL NOT NULL,
+                p80 REAL NOT NULL,
+                p90 REAL NOT NULL,
+                updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY(fuente, material, clave)
+            );
             CREATE TABLE IF NOT EXISTS outbox_emails(
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 to_email TEXT NOT NULL,
@@ -641,6 +839,16 @@ def build_db(force: bool = False) -> None:
                 created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
                 sent_at TEXT
             );
+            CREATE TABLE IF NOT EXISTS outbox_email_attempts(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                email_id INTEGER NOT NULL,
+                attempt INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                error TEXT,
+                created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY(email_id) REFERENCES outbox_emails(id) ON DELETE CASCADE
+            );
+            CREATE INDEX IF NOT EXISTS idx_outbox_attempts_email ON outbox_email_attempts(email_id);
             CREATE TABLE IF NOT EXISTS ai_suggestions_log (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 solicitud_id INTEGER NOT NULL,
@@ -652,7 +860,15 @@ def build_db(force: bool = False) -> None:
                 actor_id TEXT,
                 created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
             );
-            CREATE INDEX IF NOT EXISTS idx_ai_sol ON ai_suggestions_log(solicitud_id);
+            DROP INDEX IF EXISTS idx_ai_sol;
+            CREATE INDEX IF NOT EXISTS idx_ai_sol_ts ON ai_suggestions_log(solicitud_id, created_at);
+            CREATE TABLE IF NOT EXISTS ai_suggestions_cache (
+                solicitud_id INTEGER PRIMARY KEY,
+                input_hash TEXT NOT NULL,
+                suggestions_json TEXT NOT NULL,
+                computed_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY(solicitud_id) REFERENCES solicitudes(id) ON DELETE CASCADE
+            );
             """
         )
 
@@ -672,6 +888,33 @@ def build_db(force: bool = False) -> None:
         if "fecha_necesidad" not in sol_cols:
             con.execute("ALTER TABLE solicitudes ADD COLUMN fecha_necesidad TEXT")
 
+        archivo_cols = {row["name"] for row in con.execute("PRAGMA table_info(archivos_adjuntos)")}
+        if "sha256" not in archivo_cols:
+            con.execute("ALTER TABLE archivos_adjuntos ADD COLUMN sha256 TEXT")
+        con.execute("CREATE INDEX IF NOT EXISTS idx_archivos_sha256 ON archivos_adjuntos(sha256)")
+        upload_cols = {row["name"] for row in con.execute("PRAGMA table_info(archivos_uploads)")}
+        for column in ("escritura_token", "escritura_at"):
+            if column not in upload_cols:
+                con.execute(f"ALTER TABLE archivos_uploads ADD COLUMN {column} TEXT")
+        _sync_archivos_uso(con)
+
+        po_cols = {row["name"] for row in con.execute("PRAGMA table_info(purchase_orders)")}
+        if "entregada_at" not in po_cols:
+            con.execute("ALTER TABLE purchase_orders ADD COLUMN entregada_at TEXT")
+        traslado_cols = {row["name"] for row in con.execute("PRAGMA table_info(traslados)")}
+        if "recibido_at" not in traslado_cols:
+            con.execute("ALTER TABLE traslados ADD COLUMN recibido_at TEXT")
+
+        outbox_cols = {row["name"] for row in con.execute("PRAGMA table_info(outbox_emails)")}
+        if "attempts" not in outbox_cols:
+            con.execute("ALTER TABLE outbox_emails ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+        for column in ("next_attempt_at", "last_attempt_at", "claimed_at", "claimed_by"):
+            if column not in outbox_cols:
+                con.execute(f"ALTER TABLE outbox_emails ADD COLUMN {column} TEXT")
+        con.execute(
+            "CREATE INDEX IF NOT EXISTS idx_outbox_status_next ON outbox_emails(status, next_attempt_at)"
+        )
+
         _apply_migrations(con)
 
         data_dir = Settings.DATA_DIR
@@ -789,6 +1032,8 @@ def build_db(force: bool = False) -> None:
                     updates,
                 )
 
+        _sync_usuarios_fts(con)
+
         # Procesar planificadores
         planificadores_inserts = []
         asignaciones_inserts = []
@@ -923,7 +1168,12 @@ def build_db(force: bool = False) -> None:
                     presupuesto_values,
                 )
 
+        seed_opening_balances(con)
+        backfill_price_stats(con)
+        refresh_leadtime_stats(con)
         _backfill_catalog_tables(con)
+        bump_catalog_version(con)
+        bump_catalog_version(con, MATERIALES_VERSION_KEY)
         con.commit()
 
 
@@ -0,0 +1,271 @@
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from .config import Settings
+from .db import get_connection
+
+logger = logging.getLogger(__name__)
+
+FUENTE_COMPRA = "compra"
+FUENTE_TRASLADO = "traslado"
+# Comodín de los agregados: todos los materiales, todos los proveedores o todas las rutas.
+TODOS = "*"
+
+QUANTILES = (50, 80, 90)
+
+# Días entre la emisión de la PO y la entrega total (o el cierre si no se registró la entrega).
+_COMPRA_SQL = """
+    SELECT sol.material,
+           COALESCE(NULLIF(TRIM(po.proveedor_nombre), ''), NULLIF(TRIM(po.proveedor_email), ''), '?') AS clave,
+           julianday(COALESCE(po.entregada_at, po.updated_at)) - julianday(po.created_at) AS dias
+    FROM purchase_orders po
+    JOIN solpeds sol ON sol.id = po.solped_id
+    WHERE po.status IN ('entregada_total', 'cerrada')
+"""
+
+# Días entre la creación del traslado y su recepción, por ruta origen>destino.
+_TRASLADO_SQL = """
+    SELECT material,
+           origen_centro || '>' || destino_centro AS clave,
+           julianday(COALESCE(recibido_at, updated_at)) - julianday(created_at) AS dias
+    FROM traslados
+    WHERE status = 'recibido'
+"""
+
+
+def route_key(origen: Optional[str], destino: Optional[str]) -> str:
+    return f"{origen or ''}>{destino or ''}"
+
+
+def _grouped_percentiles(
+    labels: np.ndarray, values: np.ndarray, quantiles: Sequence[float]
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Percentiles of ``values`` per distinct label without a Python loop over groups.
+
+    Sorting by ``(group, value)`` leaves every group as a contiguous sorted run,
+    so each percentile is a linear interpolation between two indexed positions
+    (the same definition ``np.percentile`` uses by default).
+    Returns ``(labels, counts, means, percentiles[group, quantile])``.
+    """
+    uniques, inverse = np.unique(labels, return_inverse=True)
+    order = np.lexsort((values, inverse))
+    ordered = values[order]
+    counts = np.bincount(inverse, minlength=len(uniques))
+    starts = np.cumsum(counts) - counts
+    positions = starts[:, None] + (counts[:, None] - 1) * (np.asarray(quantiles, dtype=float) / 100.0)[None, :]
+    lower = np.floor(positions).astype(np.int64)
+    upper = np.ceil(positions).astype(np.int64)
+    weight = positions - lower
+    percentiles = ordered[lower] + (ordered[upper] - ordered[lower]) * weight
+    means = np.bincount(inverse, weights=values, minlength=len(uniques)) / counts
+    return uniques, counts, means, percentiles
+
+
+def _stats_rows(fuente: str, materiales: np.ndarray, claves: np.ndarray, dias: np.ndarray) -> List[Tuple[Any, ...]]:
+    """Rows for every level: material+clave, material, clave and the global aggregate."""
+    if dias.size == 0:
+        return []
+    todos = np.full(dias.shape, TODOS, dtype=object)
+    levels = (
+        (materiales, claves),
+        (materiales, todos),
+        (todos, claves),
+        (todos, todos),
+    )
+    rows: List[Tuple[Any, ...]] = []
+    for material_col, clave_col in levels:
+        # "\x1f" no aparece en códigos ni en nombres, así que separa sin ambigüedad.
+        labels = np.char.add(np.char.add(material_col.astype(str), "\x1f"), clave_col.astype(str))
+        uniques, counts, means, percentiles = _grouped_percentiles(labels, dias, QUANTILES)
+        parts = np.char.partition(uniques, "\x1f")
+        rows.extend(
+            zip(
+                [fuente] * len(uniques),
+                parts[:, 0].tolist(),
+                parts[:, 2].tolist(),
+                counts.tolist(),
+                np.round(means, 2).tolist(),
+                *(np.round(percentiles[:, i], 2).tolist() for i in range(len(QUANTILES))),
+            )
+        )
+    return rows
+
+
+def _load_durations(con, sql: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    cur = con.cursor()
+    cur.row_factory = None  # tuplas: se transponen de una vez con zip
+    rows = cur.execute(f"SELECT material, clave, dias FROM ({sql}) WHERE dias IS NOT NULL AND dias >= 0").fetchall()
+    if not rows:
+        empty = np.empty(0, dtype=object)
+        return empty, empty, np.empty(0, dtype=float)
+    materiales, claves, dias = zip(*rows)
+    return (
+        np.asarray(materiales, dtype=object),
+        np.asarray(claves, dtype=object),
+        np.asarray(dias, dtype=float),
+    )
+
+
+def refresh_leadtime_stats(con) -> Dict[str, int]:
+    """Recompute ``leadtime_stats`` from the whole PO and traslado history; the caller commits.
+
+    The table is replaced in one transaction, so readers see either the previous
+    run or the new one.
+    """
+    counts: Dict[str, int] = {}
+    rows: List[Tuple[Any, ...]] = []
+    for fuente, sql in ((FUENTE_COMPRA, _COMPRA_SQL), (FUENTE_TRASLADO, _TRASLADO_SQL)):
+        materiales, claves, dias = _load_durations(con, sql)
+        counts[fuente] = int(dias.size)
+        rows.extend(_stats_rows(fuente, materiales, claves, dias))
+    con.execute("DELETE FROM leadtime_stats")
+    con.executemany(
+        """
+        INSERT INTO leadtime_stats (fuente, material, clave, n, media, p50, p80, p90, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        """,
+        rows,
+    )
+    counts["grupos"] = len(rows)
+    return counts
+
+
+def load_leadtime_stats(con, materiales: Iterable[Optional[str]]) -> Dict[Tuple[str, str, str], Dict[str, Any]]:
+    """Every stored row for ``materiales`` plus the cross-material aggregates, keyed by ``(fuente, material, clave)``."""
+    codes = sorted({m for m in materiales if m} | {TODOS})
+    out: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+    for start in range(0, len(codes), 500):
+        chunk = codes[start:start + 500]
+        for row in con.execute(
+            f"""
+            SELECT fuente, material, clave, n, media, p50, p80, p90, updated_at
+            FROM leadtime_stats
+            WHERE material IN ({','.join('?' * len(chunk))})
+            """,
+            chunk,
+        ):
+            out[(row["fuente"], row["material"], row["clave"])] = row
+    return out
+
+
+def pick_stats(
+    stats: Dict[Tuple[str, str, str], Dict[str, Any]],
+    fuente: str,
+    material: str,
+    clave: Optional[str],
+    min_samples: Optional[int] = None,
+) -> Optional[Dict[str, Any]]:
+    """Most specific row with enough samples: material+clave, material, clave, global."""
+    min_samples = Settings.AI_LEADTIME_MIN_SAMPLES if min_samples is None else min_samples
+    candidates = [(material, clave), (material, TODOS), (TODOS, clave), (TODOS, TODOS)]
+    for cand_material, cand_clave in candidates:
+        if cand_clave is None:
+            continue
+        row = stats.get((fuente, cand_material, cand_clave))
+        if row and row["n"] >= min_samples:
+            return {**row, "nivel": "material" if cand_material != TODOS else "general"}
+    return None
+
+
+def stats_version(con) -> Optional[str]:
+    row = con.execute("SELECT MAX(updated_at) AS version FROM leadtime_stats").fetchone()
+    return row["version"] if row else None
+
+
+def run_once() -> Dict[str, int]:
+    started = time.monotonic()
+    with get_connection() as con:
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            counts = refresh_leadtime_stats(con)
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+    counts["ms"] = int((time.monotonic() - started) * 1000)
+    logger.info("leadtime_stats actualizada: %s", counts)
+    return counts
+
+
+def refresh_if_stale(max_age: Optional[float] = None) -> Optional[Dict[str, int]]:
+    """Refresh unless another process already did within ``max_age`` seconds.
+
+    The check runs under the write lock, so several workers polling the same
+    database refresh once per interval between them.
+    """
+    max_age = Settings.LEADTIME_REFRESH_INTERVAL if max_age is None else max_age
+    started = time.monotonic()
+    with get_connection() as con:
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            last = stats_version(con)
+            if last and (datetime.utcnow() - datetime.fromisoformat(str(last))).total_seconds() < max_age:
+                con.rollback()
+                return None
+            counts = refresh_leadtime_stats(con)
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+    counts["ms"] = int((time.monotonic() - started) * 1000)
+    logger.info("leadtime_stats actualizada: %s", counts)
+    return counts
+
+
+_refresher_lock = threading.Lock()
+_refresher_pid: Optional[int] = None
+
+
+def start_refresher(interval: Optional[float] = None) -> bool:
+    """Keep ``leadtime_stats`` fresh from a daemon thread of this process; False if it already runs here."""
+    global _refresher_pid
+    interval = Settings.LEADTIME_REFRESH_INTERVAL if interval is None else interval
+    with _refresher_lock:
+        if _refresher_pid == os.getpid():
+            return False
+        _refresher_pid = os.getpid()
+
+    def run() -> None:
+        while True:
+            try:
+                refresh_if_stale(interval)
+            except Exception:
+                logger.exception("Falló el recálculo de lead time")
+            # Checking more often than the interval keeps the gap close to it
+            # when another worker did the last refresh.
+            time.sleep(max(1.0, interval / 4))
+
+    threading.Thread(target=run, name="leadtime-refresh", daemon=True).start()
+    return True
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Recalcula las distribuciones de lead time")
+    parser.add_argument("--loop", action="store_true", help="Repetir cada --interval segundos")
+    parser.add_argument("--interval", type=float, default=Settings.LEADTIME_REFRESH_INTERVAL)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    while True:
+        try:
+            print(json.dumps(run_once(), ensure_ascii=False))
+        except Exception:
+            if not args.loop:
+                raise
+            logger.exception("Falló el recálculo de lead time")
+        if not args.loop:
+            return
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
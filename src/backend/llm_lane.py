@@ -0,0 +1,217 @@
+from __future__ import annotations
+
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Iterator, Optional
+
+from .config import Settings
+from .ollama_client import OllamaError
+
+logger = logging.getLogger(__name__)
+
+BREAKER_CLOSED = "cerrado"
+BREAKER_OPEN = "abierto"
+BREAKER_HALF_OPEN = "semiabierto"
+
+
+class LaneRejected(OllamaError):
+    """The lane refused the call; ``status`` is the HTTP status to answer with."""
+
+    def __init__(self, status: int, code: str, message: str, retry_after: float):
+        super().__init__(code, message)
+        self.status = status
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+
+class LaneSlot:
+    """One admitted LLM call; ``release`` must be called exactly once."""
+
+    def __init__(self, lane: "LLMLane", probe: bool):
+        self._lane = lane
+        self._probe = probe
+        self._released = False
+
+    def release(self, ok: Optional[bool]) -> None:
+        """``ok`` is True/False for the outcome, None when the client went away."""
+        if not self._released:
+            self._released = True
+            self._lane._release(ok, self._probe)
+
+
+class LLMLane:
+    """Bounded execution lane for LLM calls inside one worker process.
+
+    At most ``max_in_flight`` calls talk to Ollama at once and at most
+    ``max_queue`` more wait for a slot, each for up to ``queue_timeout``
+    seconds. Everything beyond that is refused right away (429 when the queue
+    is full, 503 when the wait times out), so slow generations can only hold a
+    fixed number of the worker's threads and the rest keep serving the API.
+    After ``breaker_threshold`` consecutive failures the circuit opens and calls
+    fail fast with 503 for ``breaker_cooldown`` seconds; then one probe call
+    decides whether it closes again.
+    """
+
+    def __init__(
+        self,
+        max_in_flight: Optional[int] = None,
+        max_queue: Optional[int] = None,
+        queue_timeout: Optional[float] = None,
+        breaker_threshold: Optional[int] = None,
+        breaker_cooldown: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self._max_in_flight = max(1, int(max_in_flight if max_in_flight is not None else Settings.LLM_MAX_IN_FLIGHT))
+        self._max_queue = max(0, int(max_queue if max_queue is not None else Settings.LLM_MAX_QUEUE))
+        self._queue_timeout = float(queue_timeout if queue_timeout is not None else Settings.LLM_QUEUE_TIMEOUT)
+        self._breaker_threshold = max(1, int(breaker_threshold if breaker_threshold is not None else Settings.LLM_BREAKER_THRESHOLD))
+        self._breaker_cooldown = float(breaker_cooldown if breaker_cooldown is not None else Settings.LLM_BREAKER_COOLDOWN)
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._pid: Optional[int] = None
+        self._reset()
+
+    def _reset(self) -> None:
+        self._in_flight = 0
+        self._waiting = 0
+        self._probe_in_flight = False
+        self._breaker = BREAKER_CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._counters = {
+            "admitidas": 0,
+            "exitos": 0,
+            "fallos": 0,
+            "canceladas": 0,
+            "rechazadas_cola_llena": 0,
+            "rechazadas_timeout": 0,
+            "rechazadas_circuito": 0,
+        }
+        self._waits: Deque[float] = deque(maxlen=1000)
+        self._wait_max = 0.0
+
+    def _ensure_process(self) -> None:
+        # Counters and slots belong to the process; a forked worker starts clean.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._reset()
+
+    def _check_breaker(self, now: float) -> bool:
+        """Raise while the circuit is open; return True if this call is the half-open probe."""
+        if self._breaker == BREAKER_OPEN:
+            remaining = self._opened_at + self._breaker_cooldown - now
+            if remaining > 0:
+                self._counters["rechazadas_circuito"] += 1
+                raise LaneRejected(503, "LLM_UNAVAILABLE", "El asistente no está disponible por el momento", remaining)
+            self._breaker = BREAKER_HALF_OPEN
+        if self._breaker == BREAKER_HALF_OPEN:
+            if self._probe_in_flight:
+                self._counters["rechazadas_circuito"] += 1
+                raise LaneRejected(503, "LLM_UNAVAILABLE", "El asistente no está disponible por el momento", self._breaker_cooldown)
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def acquire(self) -> LaneSlot:
+        with self._cond:
+            self._ensure_process()
+            start = self._clock()
+            probe = self._check_breaker(start)
+            try:
+                if self._in_flight >= self._max_in_flight:
+                    if self._waiting >= self._max_queue:
+                        self._counters["rechazadas_cola_llena"] += 1
+                        raise LaneRejected(429, "LLM_BUSY", "El asistente está ocupado, reintentá en unos segundos", self._queue_timeout)
+                    self._waiting += 1
+                    try:
+                        deadline = start + self._queue_timeout
+                        while self._in_flight >= self._max_in_flight:
+                            remaining = deadline - self._clock()
+                            if remaining <= 0:
+                                self._counters["rechazadas_timeout"] += 1
+                                raise LaneRejected(503, "LLM_QUEUE_TIMEOUT", "El asistente está saturado, reintentá en unos segundos", self._queue_timeout)
+                            self._cond.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+            except LaneRejected:
+                if probe:
+                    self._probe_in_flight = False
+                raise
+            self._in_flight += 1
+            self._counters["admitidas"] += 1
+            waited = self._clock() - start
+            self._waits.append(waited)
+            self._wait_max = max(self._wait_max, waited)
+            return LaneSlot(self, probe)
+
+    def _release(self, ok: Optional[bool], probe: bool) -> None:
+        with self._cond:
+            self._in_flight = max(0, self._in_flight - 1)
+            if probe:
+                self._probe_in_flight = False
+            if ok is True:
+                self._counters["exitos"] += 1
+                self._failures = 0
+                if self._breaker != BREAKER_CLOSED:
+                    logger.info("Circuito LLM cerrado")
+                self._breaker = BREAKER_CLOSED
+            elif ok is False:
+                self._counters["fallos"] += 1
+                self._failures += 1
+                if self._breaker == BREAKER_HALF_OPEN or self._failures >= self._breaker_threshold:
+                    if self._breaker != BREAKER_OPEN:
+                        logger.warning("Circuito LLM abierto tras %s fallos", self._failures)
+                    self._breaker = BREAKER_OPEN
+                    self._opened_at = self._clock()
+            else:
+                # A cancelled call proves nothing; in half-open the next call probes again.
+                self._counters["canceladas"] += 1
+            self._cond.notify()
+
+    @contextmanager
+    def slot(self) -> Iterator[LaneSlot]:
+        """Hold a slot for a call that finishes inside the block; OllamaError counts as a failure."""
+        lane_slot = self.acquire()
+        try:
+            yield lane_slot
+        except OllamaError:
+            lane_slot.release(False)
+            raise
+        except BaseException:
+            lane_slot.release(None)
+            raise
+        lane_slot.release(True)
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._cond:
+            self._ensure_process()
+            waits = sorted(self._waits)
+
+            def pct(q: float) -> float:
+                if not waits:
+                    return 0.0
+                return round(waits[min(len(waits) - 1, int(q * len(waits)))] * 1000, 1)
+
+            return {
+                "pid": self._pid,
+                "circuito": self._breaker,
+                "fallos_consecutivos": self._failures,
+                "en_curso": self._in_flight,
+                "en_cola": self._waiting,
+                "max_en_curso": self._max_in_flight,
+                "max_cola": self._max_queue,
+                **self._counters,
+                "espera_ms": {
+                    "muestras": len(waits),
+                    "p50": pct(0.5),
+                    "p95": pct(0.95),
+                    "max": round(self._wait_max * 1000, 1),
+                },
+            }
+
+
+llm_lane = LLMLane()
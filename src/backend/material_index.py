@@ -0,0 +1,248 @@
+from __future__ import annotations
+
+import logging
+import os
+import pickle
+import tempfile
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from .catalog_cache import MATERIALES_VERSION_KEY, get_catalog_version
+from .config import Settings
+from .db import get_connection
+
+logger = logging.getLogger(__name__)
+
+
+class MaterialIndex:
+    """Immutable TF-IDF snapshot of ``materiales`` at one catalog version.
+
+    The row order of ``matrix`` and ``codigos`` is fixed at build time, so a
+    lookup never mixes vectors from one catalog with codes from another.
+    """
+
+    # Bumped whenever the pickled attributes change, so older pickles are rebuilt.
+    FORMAT = 3
+
+    def __init__(
+        self,
+        version: int,
+        codigos: List[str],
+        unidades: List[Optional[str]],
+        descripciones: List[str],
+        vectorizer: TfidfVectorizer,
+        matrix,
+    ):
+        self.format = self.FORMAT
+        self.version = version
+        # Set by MaterialIndexHolder: identifies the database the shared pickle was built from.
+        self.fingerprint: Optional[Tuple[str, int, int, int]] = None
+        self.codigos = codigos
+        self.descripciones = descripciones
+        self.unidades = np.asarray(unidades, dtype=object)
+        # Units as small integers so masking a whole row is one vectorized comparison.
+        labels, self.unit_codes = np.unique(self.unidades.astype(str), return_inverse=True)
+        self._unit_lookup = {label: code for code, label in enumerate(labels)}
+        self.positions: Dict[str, int] = {codigo: i for i, codigo in enumerate(codigos)}
+        self.vectorizer = vectorizer
+        # TfidfVectorizer L2-normalizes rows, so a dot product is the cosine similarity.
+        self.matrix = matrix.tocsr()
+
+    def __len__(self) -> int:
+        return len(self.codigos)
+
+    def row_of(self, codigo: str) -> Optional[int]:
+        return self.positions.get(codigo)
+
+    def top_k(
+        self,
+        queries: Sequence[Tuple[Optional[str], Optional[str], Optional[str]]],
+        k: int,
+        *,
+        min_score: float = 0.0,
+    ) -> List[List[Tuple[int, float]]]:
+        """Best ``k`` matches for each ``(codigo, descripcion, unidad)`` query.
+
+        Catalogued codes use their indexed vector and everything else is
+        vectorized from the description, so the whole batch is a single sparse
+        product. Each row excludes the query's own material and, when a unit is
+        given, materials in other units. Returns ``(row, score)`` pairs, best first.
+        """
+        results: List[List[Tuple[int, float]]] = [[] for _ in queries]
+        if not queries or len(self) == 0 or self.matrix.shape[1] == 0 or k <= 0:
+            return results
+        from scipy.sparse import vstack
+
+        own_rows = [self.row_of(codigo) if codigo else None for codigo, _, _ in queries]
+        free_text = {i: n for n, i in enumerate(i for i, row in enumerate(own_rows) if row is None)}
+        transformed = self.vectorizer.transform([queries[i][1] or "" for i in free_text]) if free_text else None
+        parts = [
+            self.matrix[row] if row is not None else transformed[free_text[i]]
+            for i, row in enumerate(own_rows)
+        ]
+        scores = (vstack(parts, format="csr") @ self.matrix.T).toarray()
+
+        for i, (_, _, unidad) in enumerate(queries):
+            if unidad:
+                code = self._unit_lookup.get(str(unidad))
+                if code is None:
+                    scores[i, :] = -1.0
+                else:
+                    scores[i, self.unit_codes != code] = -1.0
+            if own_rows[i] is not None:
+                scores[i, own_rows[i]] = -1.0
+
+        k = min(k, scores.shape[1])
+        if k < scores.shape[1]:
+            candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            candidates = np.tile(np.arange(scores.shape[1]), (len(queries), 1))
+        picked = np.take_along_axis(scores, candidates, axis=1)
+        order = np.argsort(-picked, axis=1)
+        candidates = np.take_along_axis(candidates, order, axis=1)
+        picked = np.take_along_axis(picked, order, axis=1)
+        for i in range(len(queries)):
+            results[i] = [
+                (int(row), float(score))
+                for row, score in zip(candidates[i], picked[i])
+                if score >= min_score and score > 0
+            ]
+        return results
+
+    def search(self, text: str, k: int, *, min_score: float = 0.0) -> List[Tuple[int, float]]:
+        """Free-text lookup over the catalog: ``(row, score)`` pairs, best first."""
+        if not text or not text.strip():
+            return []
+        return self.top_k([(None, text, None)], k, min_score=min_score)[0]
+
+    @classmethod
+    def build(cls, con, version: int) -> "MaterialIndex":
+        rows = con.execute(
+            "SELECT codigo, descripcion, descripcion_larga, unidad FROM materiales ORDER BY codigo"
+        ).fetchall()
+        texts = [f"{r['descripcion'] or ''} {r['descripcion_larga'] or ''}".strip() for r in rows]
+        vectorizer = TfidfVectorizer(
+            max_features=Settings.AI_INDEX_MAX_FEATURES,
+            strip_accents="unicode",
+            sublinear_tf=True,
+            dtype=np.float32,
+        )
+        if any(texts):
+            matrix = vectorizer.fit_transform(texts)
+        else:
+            # Nothing to learn a vocabulary from; an empty index still answers lookups.
+            from scipy.sparse import csr_matrix
+
+            matrix = csr_matrix((len(rows), 0), dtype=np.float32)
+        return cls(
+            version,
+            [r["codigo"] for r in rows],
+            [r["unidad"] for r in rows],
+            [r["descripcion"] or "" for r in rows],
+            vectorizer,
+            matrix,
+        )
+
+
+class MaterialIndexHolder:
+    """Per-worker holder of the current :class:`MaterialIndex`.
+
+    Each lookup compares the snapshot with the ``materiales`` version in
+    ``catalog_versions``. A stale snapshot keeps answering while a background
+    thread builds the new one. The first build of a process loads the pickle
+    another worker left for the same database, version and row count, if there is one.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._index: Optional[MaterialIndex] = None
+        self._rebuilding = False
+        self._pid: Optional[int] = None
+
+    def _cache_path(self) -> str:
+        return os.path.join(Settings.DATA_DIR, "ai_cache", "materiales_index.pkl")
+
+    @staticmethod
+    def _fingerprint(con, version: int) -> Tuple[str, int, int, int]:
+        # catalog_versions restarts when the database is recreated, so the version
+        # alone could match a pickle built from another catalog.
+        row = con.execute("SELECT COUNT(*) AS n, COALESCE(MAX(rowid), 0) AS ultimo FROM materiales").fetchone()
+        return os.path.realpath(Settings.DB_PATH), version, int(row["n"]), int(row["ultimo"])
+
+    def _load_cached(self, fingerprint: Tuple[str, int, int, int]) -> Optional[MaterialIndex]:
+        try:
+            with open(self._cache_path(), "rb") as handle:
+                index = pickle.load(handle)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            return None
+        if (
+            isinstance(index, MaterialIndex)
+            and getattr(index, "format", None) == MaterialIndex.FORMAT
+            and getattr(index, "fingerprint", None) == fingerprint
+        ):
+            return index
+        return None
+
+    def _store_cached(self, index: MaterialIndex) -> None:
+        path = self._cache_path()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(prefix=".materiales_index-", dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as handle:
+                pickle.dump(index, handle, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except OSError:
+            logger.exception("No se pudo guardar el índice de materiales")
+
+    def _build(self, con, version: int) -> MaterialIndex:
+        fingerprint = self._fingerprint(con, version)
+        index = self._load_cached(fingerprint)
+        if index is None:
+            index = MaterialIndex.build(con, version)
+            index.fingerprint = fingerprint
+            self._store_cached(index)
+        return index
+
+    def _rebuild_in_background(self) -> None:
+        try:
+            with get_connection() as con:
+                version = get_catalog_version(con, MATERIALES_VERSION_KEY)
+                index = self._build(con, version)
+            with self._lock:
+                if self._index is None or index.version >= self._index.version:
+                    self._index = index
+        except Exception:
+            logger.exception("No se pudo reconstruir el índice de materiales")
+        finally:
+            with self._lock:
+                self._rebuilding = False
+
+    def get(self, con) -> MaterialIndex:
+        version = get_catalog_version(con, MATERIALES_VERSION_KEY)
+        with self._lock:
+            if self._pid != os.getpid():
+                # A rebuild thread does not survive a fork; the snapshot itself is still valid.
+                self._pid = os.getpid()
+                self._rebuilding = False
+            index = self._index
+            if index is not None and index.version != version and not self._rebuilding:
+                self._rebuilding = True
+                threading.Thread(
+                    target=self._rebuild_in_background,
+                    name="materiales-index",
+                    daemon=True,
+                ).start()
+        if index is not None:
+            return index
+        index = self._build(con, version)
+        with self._lock:
+            if self._index is None or index.version >= self._index.version:
+                self._index = index
+            return self._index
+
+    def clear(self) -> None:
+        with self._lock:
+            self._index = None
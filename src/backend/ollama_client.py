@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, Iterator, List, Optional
+from urllib.parse import urljoin
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .config import Settings
+
+logger = logging.getLogger(__name__)
+
+
+class OllamaError(Exception):
+    """Error talking to Ollama; ``code`` is the API error code shown to the client."""
+
+    def __init__(self, code: str, message: str):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class OllamaClient:
+    """Chat client for Ollama over a pooled, per-process ``requests.Session``.
+
+    Keep-alive connections are reused across requests of the same worker, so a
+    message does not pay a new TCP handshake. The session is created lazily and
+    again after a fork, because pooled sockets must not be shared between
+    gunicorn workers.
+    """
+
+    def __init__(
+        self,
+        endpoint: Optional[str] = None,
+        model: Optional[str] = None,
+        *,
+        pool_size: Optional[int] = None,
+        connect_timeout: Optional[float] = None,
+        read_timeout: Optional[float] = None,
+    ):
+        self._endpoint = endpoint
+        self._model = model
+        self._pool_size = max(1, int(pool_size or Settings.OLLAMA_POOL_SIZE))
+        self._connect_timeout = float(connect_timeout or Settings.OLLAMA_CONNECT_TIMEOUT)
+        self._read_timeout = float(read_timeout or Settings.OLLAMA_READ_TIMEOUT)
+        self._lock = threading.Lock()
+        self._session: Optional[requests.Session] = None
+        self._pid: Optional[int] = None
+
+    @property
+    def url(self) -> str:
+        base = (self._endpoint or Settings.OLLAMA_ENDPOINT or "").strip() or "http://127.0.0.1:11434"
+        if "://" not in base:
+            base = f"http://{base}"
+        return urljoin(base.rstrip("/") + "/", "api/chat")
+
+    @property
+    def model(self) -> str:
+        return (self._model or Settings.OLLAMA_MODEL or "").strip() or "llama3.1"
+
+    def _get_session(self) -> requests.Session:
+        with self._lock:
+            if self._session is None or self._pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._pool_size)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._session = session
+                self._pid = os.getpid()
+            return self._session
+
+    def _post(self, messages: List[Dict[str, str]], stream: bool) -> requests.Response:
+        body = {"model": self.model, "messages": messages, "stream": stream}
+        try:
+            response = self._get_session().post(
+                self.url,
+                json=body,
+                stream=stream,
+                timeout=(self._connect_timeout, self._read_timeout),
+            )
+        except requests.RequestException as exc:
+            logger.warning("Ollama unreachable at %s: %s", self.url, exc)
+            raise OllamaError("OLLAMA_UNREACHABLE", "No se pudo conectar con Ollama") from exc
+        if response.status_code >= 400:
+            try:
+                detail = response.json()
+                message = detail.get("error") or detail.get("message") or "Error de Ollama"
+            except ValueError:
+                message = "Error de Ollama"
+            finally:
+                response.close()
+            raise OllamaError("OLLAMA_ERROR", str(message))
+        return response
+
+    def chat(self, messages: List[Dict[str, str]]) -> str:
+        """Full answer in one response (``stream: false``)."""
+        response = self._post(messages, stream=False)
+        try:
+            data = response.json()
+        except ValueError as exc:
+            raise OllamaError("INVALID_RESP", "Respuesta invalida de Ollama") from exc
+        finally:
+            response.close()
+        return str((data.get("message") or {}).get("content", "")).strip()
+
+    def stream_chat(self, messages: List[Dict[str, str]]) -> Iterator[Dict[str, Any]]:
+        """Yield Ollama's NDJSON chunks as they arrive (``stream: true``).
+
+        Closing the generator (the browser went away and the WSGI server closed
+        the response) closes the upstream connection, which makes Ollama stop
+        generating instead of finishing an answer nobody will read.
+        """
+        response = self._post(messages, stream=True)
+        try:
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                try:
+                    chunk = json.loads(line)
+                except ValueError as exc:
+                    raise OllamaError("INVALID_RESP", "Respuesta invalida de Ollama") from exc
+                if chunk.get("error"):
+                    raise OllamaError("OLLAMA_ERROR", str(chunk["error"]))
+                # After the "done" chunk the body ends; reading to the end lets
+                # the connection go back to the pool instead of being dropped.
+                yield chunk
+        except requests.RequestException as exc:
+            raise OllamaError("OLLAMA_UNREACHABLE", "Se interrumpió la conexión con Ollama") from exc
+        finally:
+            response.close()
@@ -0,0 +1,371 @@
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import random
+import smtplib
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from typing import Any, Callable, Dict, List, Optional
+
+from .config import Settings
+from .db import get_connection
+
+logger = logging.getLogger(__name__)
+
+STATUS_QUEUED = "queued"
+STATUS_SENDING = "sending"
+STATUS_SENT = "sent"
+STATUS_DEAD = "dead"
+
+_TS_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def _ts(moment: datetime) -> str:
+    # Same format as CURRENT_TIMESTAMP so SQL comparisons are plain string comparisons.
+    return moment.strftime(_TS_FORMAT)
+
+
+class RateLimiter:
+    """Token bucket shared by all dispatcher threads."""
+
+    def __init__(self, per_second: float, burst: Optional[int] = None):
+        self._rate = max(0.0, float(per_second))
+        self._capacity = float(burst or max(1, int(self._rate) or 1))
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        if self._rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+            time.sleep(wait)
+
+
+def default_smtp_factory() -> smtplib.SMTP:
+    if Settings.SMTP_SSL:
+        client: smtplib.SMTP = smtplib.SMTP_SSL(Settings.SMTP_HOST, Settings.SMTP_PORT, timeout=Settings.SMTP_TIMEOUT)
+    else:
+        client = smtplib.SMTP(Settings.SMTP_HOST, Settings.SMTP_PORT, timeout=Settings.SMTP_TIMEOUT)
+        if Settings.SMTP_STARTTLS:
+            client.starttls()
+    if Settings.SMTP_USER:
+        client.login(Settings.SMTP_USER, Settings.SMTP_PASSWORD)
+    return client
+
+
+class SmtpPool:
+    """Keeps SMTP connections open across messages; one is checked out per send."""
+
+    def __init__(self, factory: Callable[[], smtplib.SMTP], size: int):
+        self._factory = factory
+        self._size = max(1, size)
+        self._idle: List[smtplib.SMTP] = []
+        self._lock = threading.Lock()
+
+    def send(self, message: EmailMessage) -> None:
+        client = self._checkout()
+        try:
+            client.send_message(message)
+        except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError):
+            self._resend(client, message)
+            return
+        except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused):
+            # The session is still usable after a rejected message. Checked
+            # before OSError because every SMTPException subclasses it.
+            self._checkin(client)
+            raise
+        except smtplib.SMTPException:
+            self._discard(client)
+            raise
+        except OSError:
+            self._resend(client, message)
+            return
+        except BaseException:
+            self._discard(client)
+            raise
+        self._checkin(client)
+
+    def _resend(self, stale: smtplib.SMTP, message: EmailMessage) -> None:
+        # A stale pooled connection: retry once on a fresh one.
+        self._discard(stale)
+        client = self._factory()
+        try:
+            client.send_message(message)
+        except BaseException:
+            self._discard(client)
+            raise
+        self._checkin(client)
+
+    def _checkout(self) -> smtplib.SMTP:
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self._factory()
+
+    def _checkin(self, client: smtplib.SMTP) -> None:
+        with self._lock:
+            if len(self._idle) < self._size:
+                self._idle.append(client)
+                return
+        self._discard(client)
+
+    @staticmethod
+    def _discard(client: smtplib.SMTP) -> None:
+        try:
+            client.quit()
+        except Exception:
+            try:
+                client.close()
+            except Exception:
+                pass
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for client in idle:
+            self._discard(client)
+
+
+def _build_message(row: Dict[str, Any]) -> EmailMessage:
+    message = EmailMessage()
+    message["From"] = Settings.SMTP_FROM
+    message["To"] = row["to_email"]
+    message["Subject"] = row["subject"]
+    message["Message-ID"] = f"<outbox-{row['id']}@{Settings.SMTP_FROM.rsplit('@', 1)[-1]}>"
+    message.set_content("Este mensaje requiere un cliente de correo con soporte HTML.")
+    message.add_alternative(row["body"], subtype="html")
+    for attachment in json.loads(row.get("attachments_json") or "[]"):
+        path = attachment.get("path")
+        if not path:
+            continue
+        maintype, _, subtype = (attachment.get("mime") or "application/octet-stream").partition("/")
+        with open(path, "rb") as handle:
+            message.add_attachment(
+                handle.read(),
+                maintype=maintype,
+                subtype=subtype or "octet-stream",
+                filename=attachment.get("filename") or os.path.basename(path),
+            )
+    return message
+
+
+def _is_permanent(exc: BaseException) -> bool:
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in exc.recipients.values())
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return exc.smtp_code >= 500
+    return isinstance(exc, (ValueError, FileNotFoundError))
+
+
+class OutboxDispatcher:
+    """Sends queued ``outbox_emails`` rows.
+
+    Rows are claimed in batches with a single ``UPDATE ... RETURNING`` so two
+    dispatchers (or gunicorn workers) never send the same email. Failures are
+    retried with exponential backoff until ``max_attempts``, then dead-lettered.
+    Claims left in ``sending`` by a crashed process are picked up again after
+    ``claim_timeout`` seconds.
+    """
+
+    def __init__(
+        self,
+        *,
+        smtp_factory: Callable[[], smtplib.SMTP] = default_smtp_factory,
+        workers: Optional[int] = None,
+        batch_size: Optional[int] = None,
+        rate_per_second: Optional[float] = None,
+        max_attempts: Optional[int] = None,
+        backoff_base: Optional[float] = None,
+        backoff_max: Optional[float] = None,
+        claim_timeout: Optional[float] = None,
+    ):
+        self.workers = max(1, workers or Settings.OUTBOX_WORKERS)
+        self.batch_size = max(1, batch_size or Settings.OUTBOX_BATCH_SIZE)
+        self.max_attempts = max(1, max_attempts or Settings.OUTBOX_MAX_ATTEMPTS)
+        self.backoff_base = Settings.OUTBOX_BACKOFF_BASE if backoff_base is None else backoff_base
+        self.backoff_max = Settings.OUTBOX_BACKOFF_MAX if backoff_max is None else backoff_max
+        self.claim_timeout = Settings.OUTBOX_CLAIM_TIMEOUT if claim_timeout is None else claim_timeout
+        self._smtp_factory = smtp_factory
+        self._rate = RateLimiter(Settings.OUTBOX_RATE_PER_SECOND if rate_per_second is None else rate_per_second)
+        self._run_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._thread_pid: Optional[int] = None
+
+    def claim_batch(self, claimer: str) -> List[Dict[str, Any]]:
+        now = datetime.utcnow()
+        with get_connection() as con:
+            rows = con.execute(
+                """
+                UPDATE outbox_emails
+                   SET status=?, claimed_at=?, claimed_by=?
+                 WHERE id IN (
+                        SELECT id FROM outbox_emails
+                         WHERE (status=? AND (next_attempt_at IS NULL OR next_attempt_at <= ?))
+                            OR (status=? AND claimed_at < ?)
+                      ORDER BY id
+                         LIMIT ?
+                 )
+                RETURNING id, to_email, subject, body, attachments_json, attempts
+                """,
+                (
+                    STATUS_SENDING,
+                    _ts(now),
+                    claimer,
+                    STATUS_QUEUED,
+                    _ts(now),
+                    STATUS_SENDING,
+                    _ts(now - timedelta(seconds=self.claim_timeout)),
+                    self.batch_size,
+                ),
+            ).fetchall()
+            con.commit()
+        return rows
+
+    def _backoff(self, attempts: int) -> float:
+        delay = min(self.backoff_max, self.backoff_base * (2 ** max(0, attempts - 1)))
+        return delay * random.uniform(0.8, 1.2)
+
+    def _record(self, row: Dict[str, Any], claimer: str, error: Optional[BaseException]) -> str:
+        attempt = int(row.get("attempts") or 0) + 1
+        now = datetime.utcnow()
+        if error is None:
+            status, next_attempt, message = STATUS_SENT, None, None
+        else:
+            message = f"{type(error).__name__}: {error}"[:1000]
+            if attempt >= self.max_attempts or _is_permanent(error):
+                status, next_attempt = STATUS_DEAD, None
+            else:
+                status, next_attempt = STATUS_QUEUED, _ts(now + timedelta(seconds=self._backoff(attempt)))
+        with get_connection() as con:
+            con.execute(
+                """
+                UPDATE outbox_emails
+                   SET status=?, attempts=?, error=?, next_attempt_at=?, last_attempt_at=?,
+                       sent_at=CASE WHEN ?='sent' THEN ? ELSE sent_at END,
+                       claimed_at=NULL, claimed_by=NULL
+                 WHERE id=? AND claimed_by=?
+                """,
+                (status, attempt, message, next_attempt, _ts(now), status, _ts(now), row["id"], claimer),
+            )
+            con.execute(
+                """
+                INSERT INTO outbox_email_attempts (email_id, attempt, status, error)
+                VALUES (?, ?, ?, ?)
+                """,
+                (row["id"], attempt, "ok" if error is None else "error", message),
+            )
+            con.commit()
+        return status
+
+    def _deliver(self, pool: SmtpPool, row: Dict[str, Any], claimer: str) -> str:
+        error: Optional[BaseException] = None
+        try:
+            message = _build_message(row)
+            self._rate.acquire()
+            pool.send(message)
+        except Exception as exc:
+            logger.warning("Fallo el envío del email %s: %s", row["id"], exc)
+            error = exc
+        return self._record(row, claimer, error)
+
+    def dispatch(self, *, max_batches: Optional[int] = None) -> Dict[str, int]:
+        """Drain what is due now; returns counts by resulting status."""
+        stats = {"enviados": 0, "reintentos": 0, "fallidos": 0, "lotes": 0}
+        if not self._run_lock.acquire(blocking=False):
+            # Another thread of this process is already draining the outbox.
+            return stats
+        pool = SmtpPool(self._smtp_factory, self.workers)
+        claimer = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="outbox") as executor:
+                while max_batches is None or stats["lotes"] < max_batches:
+                    batch = self.claim_batch(claimer)
+                    if not batch:
+                        break
+                    stats["lotes"] += 1
+                    for status in executor.map(lambda row: self._deliver(pool, row, claimer), batch):
+                        if status == STATUS_SENT:
+                            stats["enviados"] += 1
+                        elif status == STATUS_DEAD:
+                            stats["fallidos"] += 1
+                        else:
+                            stats["reintentos"] += 1
+        finally:
+            pool.close()
+            self._run_lock.release()
+        return stats
+
+    def start(self, poll_interval: Optional[float] = None) -> bool:
+        """Run ``run_forever`` in a daemon thread of this process; False if it already runs here.
+
+        Safe with several gunicorn workers: rows are claimed atomically, so each
+        email is still sent by one dispatcher only.
+        """
+        interval = Settings.OUTBOX_POLL_INTERVAL if poll_interval is None else poll_interval
+        with self._start_lock:
+            if self._thread_pid == os.getpid():
+                return False
+            self._thread_pid = os.getpid()
+        threading.Thread(target=self.run_forever, args=(interval,), name="outbox-dispatcher", daemon=True).start()
+        return True
+
+    def run_forever(self, poll_interval: float = 5.0) -> None:
+        while True:
+            try:
+                stats = self.dispatch()
+                if stats["lotes"]:
+                    logger.info("Outbox: %s", stats)
+            except Exception:
+                logger.exception("Error al despachar la outbox")
+            time.sleep(poll_interval)
+
+
+outbox_dispatcher = OutboxDispatcher()
+
+
+def requeue_dead(con, email_ids: Optional[List[int]] = None) -> int:
+    """Give dead-lettered emails a fresh set of attempts; the caller commits."""
+    sql = """
+        UPDATE outbox_emails
+           SET status=?, attempts=0, next_attempt_at=NULL, error=NULL
+         WHERE status=?
+    """
+    params: List[Any] = [STATUS_QUEUED, STATUS_DEAD]
+    if email_ids:
+        sql += f" AND id IN ({','.join('?' * len(email_ids))})"
+        params.extend(email_ids)
+    return con.execute(sql, params).rowcount
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Despacha los emails pendientes de outbox_emails")
+    parser.add_argument("--loop", action="store_true", help="Quedarse escuchando la cola")
+    parser.add_argument("--interval", type=float, default=Settings.OUTBOX_POLL_INTERVAL)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    dispatcher = OutboxDispatcher()
+    if args.loop:
+        dispatcher.run_forever(args.interval)
+    else:
+        print(json.dumps(dispatcher.dispatch(), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+from __future__ import annotations
+
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+
+# Unit price of a PO line; cancelled orders and lines without a price do not count.
+_PRICE_ROWS_SQL = """
+    SELECT po.id AS po_id, po.subtotal / sol.cantidad AS precio
+    FROM solpeds sol
+    JOIN purchase_orders po ON po.solped_id = sol.id
+    WHERE sol.material = ?
+      AND po.status != 'cancelada'
+      AND po.subtotal > 0
+      AND sol.cantidad > 0
+    ORDER BY po.created_at, po.id
+"""
+
+
+def _chunks(values: List[str], size: int = 500) -> Iterable[List[str]]:
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def refresh_material_prices(con, materiales: Iterable[Optional[str]]) -> int:
+    """Recompute ``material_price_stats`` for the given materials; the caller commits.
+
+    Only the materials touched by a PO change are recomputed, each from its own
+    rows through ``idx_solped_material``, so the statistics stay exact (medians
+    cannot be updated incrementally) without rescanning every order.
+    """
+    refreshed = 0
+    for material in sorted({m for m in materiales if m}):
+        rows = con.execute(_PRICE_ROWS_SQL, (material,)).fetchall()
+        if not rows:
+            con.execute("DELETE FROM material_price_stats WHERE material = ?", (material,))
+            continue
+        precios = np.fromiter((r["precio"] for r in rows), dtype=float, count=len(rows))
+        p10, mediana, p90 = np.percentile(precios, [10, 50, 90])
+        con.execute(
+            """
+            INSERT INTO material_price_stats
+                (material, n, mediana, p10, p90, ultimo_precio, ultimo_po_id, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(material) DO UPDATE SET
+                n=excluded.n,
+                mediana=excluded.mediana,
+                p10=excluded.p10,
+                p90=excluded.p90,
+                ultimo_precio=excluded.ultimo_precio,
+                ultimo_po_id=excluded.ultimo_po_id,
+                updated_at=excluded.updated_at
+            """,
+            (
+                material,
+                len(rows),
+                round(float(mediana), 4),
+                round(float(p10), 4),
+                round(float(p90), 4),
+                round(float(precios[-1]), 4),
+                rows[-1]["po_id"],
+            ),
+        )
+        refreshed += 1
+    return refreshed
+
+
+def materials_for_pos(con, po_ids: Iterable[int]) -> List[str]:
+    ids = list(po_ids)
+    out: List[str] = []
+    for chunk in _chunks(ids):
+        out.extend(
+            r["material"]
+            for r in con.execute(
+                f"""
+                SELECT DISTINCT sol.material
+                FROM purchase_orders po JOIN solpeds sol ON sol.id = po.solped_id
+                WHERE po.id IN ({','.join('?' * len(chunk))})
+                """,
+                chunk,
+            )
+        )
+    return out
+
+
+def refresh_for_pos(con, po_ids: Iterable[int]) -> int:
+    """Refresh the statistics of every material referenced by ``po_ids``."""
+    return refresh_material_prices(con, materials_for_pos(con, po_ids))
+
+
+def backfill_price_stats(con) -> int:
+    """Fill the table once for databases that already have purchase orders."""
+    if con.execute("SELECT 1 FROM material_price_stats LIMIT 1").fetchone():
+        return 0
+    materiales = [
+        r["material"]
+        for r in con.execute(
+            "SELECT DISTINCT sol.material FROM solpeds sol JOIN purchase_orders po ON po.solped_id = sol.id"
+        )
+    ]
+    return refresh_material_prices(con, materiales)
+
+
+def get_price_stats(con, materiales: Iterable[Optional[str]]) -> Dict[str, Dict[str, Any]]:
+    codes = sorted({m for m in materiales if m})
+    out: Dict[str, Dict[str, Any]] = {}
+    for chunk in _chunks(codes):
+        for row in con.execute(
+            f"""
+            SELECT material, n, mediana, p10, p90, ultimo_precio, ultimo_po_id, updated_at
+            FROM material_price_stats
+            WHERE material IN ({','.join('?' * len(chunk))})
+            """,
+            chunk,
+        ):
+            out[row["material"]] = row
+    return out
@@ -1,19 +1,26 @@
 from __future__ import annotations
 
 import json
+from datetime import datetime
+from html import escape
 from flask import Blueprint, request, jsonify
+from ..config import Settings
 from ..db import get_connection
-from ..security import verify_access_token
+from ..security import current_user
 from ..roles import has_role
+from ..outbox import STATUS_QUEUED, outbox_dispatcher, requeue_dead
+from ..price_stats import refresh_for_pos
+from ..timeline import fetch_timeline
 from ..schemas import (
     TrasladoCreate, TrasladoUpdate, SolpedCreate, SolpedUpdate,
-    PurchaseOrderCreate, PurchaseOrderUpdate
+    PurchaseOrderCreate, PurchaseOrderUpdate, PurchaseOrderBulkCreate
 )
 
 bp = Blueprint("abastecimiento", __name__, url_prefix="/api/abastecimiento")
 
 def _require_planner():
-    user = verify_access_token(request)
+    with get_connection() as con:
+        user = current_user(con)
     if not user:
         return None, ({"ok": False, "error": {"code": "unauthorized", "message": "Unauthorized"}}, 401)
     if not has_role(user, "planner", "planificador", "admin", "administrador"):
@@ -21,7 +28,8 @@ def _require_planner():
     return user, None
 
 def _require_admin():
-    user = verify_access_token(request)
+    with get_connection() as con:
+        user = current_user(con)
     if not user:
         return None, ({"ok": False, "error": {"code": "unauthorized", "message": "Unauthorized"}}, 401)
     if not has_role(user, "planner", "planificador", "admin", "administrador"):
@@ -34,26 +42,60 @@ def _log(con, sol_id, uid, tipo, item_index=None, estado=None, payload=None):
         VALUES (?, ?, ?, ?, ?, ?)
     """, (sol_id, item_index, uid.lower(), tipo, estado, json.dumps(payload or {}, ensure_ascii=False)))
 
+def _po_email_body(numero, proveedor_nombre, lineas):
+    filas = []
+    total = 0.0
+    for linea in lineas:
+        precio = float(linea["precio_unitario_est"] or 0)
+        importe = float(linea["cantidad"]) * precio
+        total += importe
+        filas.append(f"""
+            <tr>
+                <td>{escape(str(linea['material']))}</td>
+                <td>{escape(str(linea['centro']))} / {escape(str(linea['sector']))}</td>
+                <td>{linea['cantidad']}</td>
+                <td>${precio:.2f}</td>
+                <td>${importe:.2f}</td>
+            </tr>""")
+    return f"""
+            <html><body>
+            <h2>Pedido de Compra #{escape(str(numero or ''))}</h2>
+            <p>Proveedor: {escape(str(proveedor_nombre or ''))}</p>
+            <table border="1">
+            <tr><th>Material</th><th>Centro / Sector</th><th>Cantidad</th><th>Precio Unit.</th><th>Total</th></tr>{''.join(filas)}
+            <tr><td colspan="4"><strong>Total</strong></td><td><strong>${total:.2f}</strong></td></tr>
+            </table>
+            <p>Por favor confirme recepción y términos de entrega.</p>
+            </body></html>
+            """
+
 @bp.get("/timeline/<int:sol_id>")
 def timeline(sol_id):
     user, err = _require_planner()
     if err:
         return err
+    args = request.args
+    fuentes = [f.strip() for f in args.get("fuentes", "").split(",") if f.strip()]
+    tipos = [t.strip() for t in args.get("tipos", "").split(",") if t.strip()]
+    try:
+        limit = int(args.get("limit", 50))
+    except ValueError:
+        limit = 50
     with get_connection() as con:
-        rows = con.execute("""
-            SELECT id, item_index, actor_id, tipo, estado, payload_json, created_at
-            FROM solicitud_tratamiento_log
-            WHERE solicitud_id = ? ORDER BY datetime(created_at)
-        """, (sol_id,)).fetchall()
-        out = []
-        for r in rows:
-            out.append({
-                "id": r["id"], "item_index": r["item_index"],
-                "actor": r["actor_id"], "tipo": r["tipo"], "estado": r["estado"],
-                "payload": json.loads(r["payload_json"] or "{}"),
-                "ts": r["created_at"]
-            })
-        return jsonify({"ok": True, "timeline": out})
+        try:
+            page = fetch_timeline(
+                con,
+                sol_id,
+                limit=limit,
+                cursor=args.get("cursor") or None,
+                fuentes=fuentes or None,
+                tipos=tipos,
+                descending=args.get("orden", "asc").lower() == "desc",
+                include_payload=args.get("payload", "1") != "0",
+            )
+        except ValueError as e:
+            return jsonify({"ok": False, "error": {"code": "invalid_cursor", "message": str(e)}}), 400
+        return jsonify({"ok": True, **page})
 
 @bp.post("/timeline/<int:sol_id>/nota")
 def add_nota(sol_id):
@@ -69,7 +111,7 @@ def add_nota(sol_id):
         return jsonify({"ok": False, "error": {"code": "invalid_data", "message": "item_index debe ser entero o null"}}), 400
 
     with get_connection() as con:
-        _log(con, sol_id, user["uid"], "nota", item_index, None, {"texto": data["texto"].strip()})
+        _log(con, sol_id, user["id_spm"], "nota", item_index, None, {"texto": data["texto"].strip()})
         con.commit()
     return jsonify({"ok": True})
 
@@ -97,10 +139,10 @@ def create_traslado():
                 validated.solicitud_id, validated.item_index, validated.material.upper(),
                 validated.um, validated.cantidad, validated.origen_centro,
                 validated.origen_almacen, validated.origen_lote, validated.destino_centro,
-                validated.destino_almacen, user["uid"]
+                validated.destino_almacen, user["id_spm"]
             ))
             traslado_id = cursor.lastrowid
-            _log(con, validated.solicitud_id, user["uid"], "traslado_creado", validated.item_index, None, {
+            _log(con, validated.solicitud_id, user["id_spm"], "traslado_creado", validated.item_index, None, {
                 "traslado_id": traslado_id,
                 "origen": f"{validated.origen_centro}-{validated.origen_almacen}",
                 "destino": f"{validated.destino_centro}-{validated.destino_almacen}",
@@ -136,7 +178,8 @@ def update_traslado(traslado_id):
             """, (validated.status, validated.referencia, traslado_id))
 
             if validated.status == "recibido":
-                _log(con, row["solicitud_id"], user["uid"], "traslado_recibido", row["item_index"], None, {
+                con.execute("UPDATE traslados SET recibido_at = COALESCE(recibido_at, CURRENT_TIMESTAMP) WHERE id = ?", (traslado_id,))
+                _log(con, row["solicitud_id"], user["id_spm"], "traslado_recibido", row["item_index"], None, {
                     "traslado_id": traslado_id,
                     "referencia": validated.referencia
                 })
@@ -168,10 +211,10 @@ def create_solped():
                 ) VALUES (?, ?, ?, ?, ?, ?, ?)
             """, (
                 validated.solicitud_id, validated.item_index, validated.material.upper(),
-                validated.um, validated.cantidad, validated.precio_unitario_est or 0, user["uid"]
+                validated.um, validated.cantidad, validated.precio_unitario_est or 0, user["id_spm"]
             ))
             solped_id = cursor.lastrowid
-            _log(con, validated.solicitud_id, user["uid"], "solped_creada", validated.item_index, None, {
+            _log(con, validated.solicitud_id, user["id_spm"], "solped_creada", validated.item_index, None, {
                 "solped_id": solped_id,
                 "numero": validated.numero
             })
@@ -205,7 +248,7 @@ def update_solped(solped_id):
             """, (validated.status, validated.numero, solped_id))
 
             if validated.status == "liberada":
-                _log(con, row["solicitud_id"], user["uid"], "solped_liberada", row["item_index"], None, {
+                _log(con, row["solicitud_id"], user["id_spm"], "solped_liberada", row["item_index"], None, {
                     "solped_id": solped_id,
                     "numero": validated.numero
                 })
@@ -238,10 +281,11 @@ def create_po():
             """, (
                 validated.solped_id, validated.solicitud_id, validated.proveedor_email,
                 validated.proveedor_nombre, validated.numero, validated.subtotal or 0,
-                validated.moneda or "USD", user["uid"]
+                validated.moneda or "USD", user["id_spm"]
             ))
             po_id = cursor.lastrowid
-            _log(con, validated.solicitud_id, user["uid"], "po_emitida", None, None, {
+            refresh_for_pos(con, [po_id])
+            _log(con, validated.solicitud_id, user["id_spm"], "po_emitida", None, None, {
                 "po_id": po_id,
                 "solped_id": validated.solped_id,
                 "numero": validated.numero,
@@ -253,6 +297,148 @@ def create_po():
             con.rollback()
             return jsonify({"ok": False, "error": {"code": "db_error", "message": str(e)}}), 500
 
+@bp.post("/po/bulk")
+def create_po_bulk():
+    """Emite las OC de varias solpeds agrupadas por proveedor, con un único correo por proveedor."""
+    user, err = _require_planner()
+    if err:
+        return err
+    data = request.get_json() or {}
+    try:
+        validated = PurchaseOrderBulkCreate(**data)
+    except Exception as e:
+        return jsonify({"ok": False, "error": {"code": "validation_error", "message": str(e)}}), 400
+
+    lineas = {linea.solped_id: linea for linea in validated.lineas}
+    ids = list(lineas)
+    marks = ",".join("?" * len(ids))
+    moneda = validated.moneda or "USD"
+    status = "enviada" if validated.enviar else "emitida"
+
+    with get_connection() as con:
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            solpeds = {
+                r["id"]: r
+                for r in con.execute(f"""
+                    SELECT sol.id, sol.solicitud_id, sol.material, sol.cantidad, sol.precio_unitario_est,
+                           s.centro, s.sector
+                    FROM solpeds sol
+                    JOIN solicitudes s ON sol.solicitud_id = s.id
+                    WHERE sol.id IN ({marks})
+                """, ids)
+            }
+            faltantes = [i for i in ids if i not in solpeds]
+            if faltantes:
+                con.rollback()
+                return jsonify({"ok": False, "error": {"code": "not_found", "message": f"Solpeds inexistentes: {faltantes}"}}), 404
+            con_oc = [
+                r["solped_id"]
+                for r in con.execute(f"""
+                    SELECT DISTINCT solped_id FROM purchase_orders
+                    WHERE solped_id IN ({marks}) AND status != 'cancelada'
+                """, ids)
+            ]
+            if con_oc:
+                con.rollback()
+                return jsonify({"ok": False, "error": {"code": "conflict", "message": f"Solpeds con OC vigente: {con_oc}"}}), 409
+
+            grupos = {}
+            for solped_id in ids:
+                grupos.setdefault(lineas[solped_id].proveedor_email, []).append(solped_id)
+
+            # Under BEGIN IMMEDIATE nobody else can insert, so the new rows are exactly those above this id.
+            last_id = con.execute("SELECT COALESCE(MAX(id), 0) AS m FROM purchase_orders").fetchone()["m"]
+            con.executemany("""
+                INSERT INTO purchase_orders (
+                    solped_id, solicitud_id, proveedor_email, proveedor_nombre,
+                    status, subtotal, moneda, created_by
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, [
+                (
+                    solped_id,
+                    solpeds[solped_id]["solicitud_id"],
+                    email,
+                    lineas[solped_id].proveedor_nombre,
+                    status,
+                    lineas[solped_id].subtotal if lineas[solped_id].subtotal is not None
+                    else float(solpeds[solped_id]["cantidad"]) * float(solpeds[solped_id]["precio_unitario_est"] or 0),
+                    moneda,
+                    user["id_spm"],
+                )
+                for email, grupo in grupos.items()
+                for solped_id in grupo
+            ])
+            po_ids = {
+                r["solped_id"]: r["id"]
+                for r in con.execute("SELECT id, solped_id FROM purchase_orders WHERE id > ?", (last_id,))
+            }
+
+            refresh_for_pos(con, po_ids.values())
+
+            fecha = datetime.utcnow().strftime("%Y%m%d")
+            numeros = {email: f"OC-{fecha}-{po_ids[grupo[0]]}" for email, grupo in grupos.items()}
+            con.executemany(
+                "UPDATE purchase_orders SET numero = ? WHERE id = ?",
+                [(numeros[email], po_ids[solped_id]) for email, grupo in grupos.items() for solped_id in grupo],
+            )
+
+            tipos_log = ["po_emitida", "po_enviada"] if validated.enviar else ["po_emitida"]
+            con.executemany("""
+                INSERT INTO solicitud_tratamiento_log (solicitud_id, item_index, actor_id, tipo, estado, payload_json)
+                VALUES (?, NULL, ?, ?, NULL, ?)
+            """, [
+                (
+                    solpeds[solped_id]["solicitud_id"],
+                    user["id_spm"].lower(),
+                    tipo,
+                    json.dumps({
+                        "po_id": po_ids[solped_id],
+                        "solped_id": solped_id,
+                        "numero": numeros[email],
+                        "proveedor": email,
+                    }, ensure_ascii=False),
+                )
+                for email, grupo in grupos.items()
+                for solped_id in grupo
+                for tipo in tipos_log
+            ])
+
+            if validated.enviar:
+                con.executemany("""
+                    INSERT INTO outbox_emails (to_email, subject, body)
+                    VALUES (?, ?, ?)
+                """, [
+                    (
+                        email,
+                        f"Pedido de Compra #{numeros[email]}",
+                        _po_email_body(
+                            numeros[email],
+                            lineas[grupo[0]].proveedor_nombre,
+                            [solpeds[solped_id] for solped_id in grupo],
+                        ),
+                    )
+                    for email, grupo in grupos.items()
+                ])
+
+            con.commit()
+        except Exception as e:
+            con.rollback()
+            return jsonify({"ok": False, "error": {"code": "db_error", "message": str(e)}}), 500
+
+    return jsonify({
+        "ok": True,
+        "proveedores": [
+            {
+                "proveedor_email": email,
+                "numero": numeros[email],
+                "po_ids": [po_ids[solped_id] for solped_id in grupo],
+            }
+            for email, grupo in grupos.items()
+        ],
+        "emails_encolados": len(grupos) if validated.enviar else 0,
+    })
+
 @bp.post("/po/<int:po_id>/enviar")
 def send_po(po_id):
     user, err = _require_planner()
@@ -273,25 +459,8 @@ def send_po(po_id):
             if not row:
                 return jsonify({"ok": False, "error": {"code": "not_found", "message": "PO no encontrada"}}), 404
 
-            # Crear email HTML simple
             subject = f"Pedido de Compra #{row['numero']}"
-            body = f"""
-            <html><body>
-            <h2>Pedido de Compra #{row['numero']}</h2>
-            <p>Proveedor: {row['proveedor_nombre']}</p>
-            <p>Centro: {row['centro']} | Sector: {row['sector']}</p>
-            <table border="1">
-            <tr><th>Material</th><th>Cantidad</th><th>Precio Unit.</th><th>Total</th></tr>
-            <tr>
-                <td>{row['material']}</td>
-                <td>{row['cantidad']}</td>
-                <td>${row['precio_unitario_est']:.2f}</td>
-                <td>${(row['cantidad'] * row['precio_unitario_est']):.2f}</td>
-            </tr>
-            </table>
-            <p>Por favor confirme recepción y términos de entrega.</p>
-            </body></html>
-            """
+            body = _po_email_body(row['numero'], row['proveedor_nombre'], [row])
 
             con.execute("""
                 INSERT INTO outbox_emails (to_email, subject, body)
@@ -300,7 +469,7 @@ def send_po(po_id):
 
             con.execute("UPDATE purchase_orders SET status = 'enviada' WHERE id = ?", (po_id,))
 
-            _log(con, row['solicitud_id'], user["uid"], "po_enviada", None, None, {
+            _log(con, row['solicitud_id'], user["id_spm"], "po_enviada", None, None, {
                 "po_id": po_id,
                 "numero": row['numero']
             })
@@ -330,9 +499,13 @@ def update_po(po_id):
                 return jsonify({"ok": False, "error": {"code": "not_found", "message": "PO no encontrada"}}), 404
 
             con.execute("UPDATE purchase_orders SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?", (validated.status, po_id))
+            if validated.status in ("entregada_total", "cerrada"):
+                # Fin del lead time: la primera entrega total (o cierre) queda fija
+                con.execute("UPDATE purchase_orders SET entregada_at = COALESCE(entregada_at, CURRENT_TIMESTAMP) WHERE id = ?", (po_id,))
+            refresh_for_pos(con, [po_id])
 
             tipo_log = f"po_{validated.status.replace('_', '')}"
-            _log(con, row['solicitud_id'], user["uid"], tipo_log, None, None, {
+            _log(con, row['solicitud_id'], user["id_spm"], tipo_log, None, None, {
                 "po_id": po_id
             })
 
@@ -348,13 +521,45 @@ def send_all_emails():
     if err:
         return err
 
+    # Acotado para no exceder el timeout de gunicorn/nginx; lo pendiente lo envía el dispatcher de fondo
+    # (hilo del worker web con SPM_BACKGROUND_JOBS=1 o el servicio outbox).
+    try:
+        stats = outbox_dispatcher.dispatch(max_batches=max(1, Settings.OUTBOX_REQUEST_MAX_BATCHES))
+    except Exception as e:
+        return jsonify({"ok": False, "error": {"code": "outbox_error", "message": str(e)}}), 500
     with get_connection() as con:
-        try:
-            con.execute("""
-                UPDATE outbox_emails SET status = 'sent', sent_at = CURRENT_TIMESTAMP
-                WHERE status = 'queued'
-            """)
-            con.commit()
-            return jsonify({"ok": True})
-        except Exception as e:
-            return jsonify({"ok": False, "error": {"code": "db_error", "message": str(e)}}), 500
\ No newline at end of file
+        pendientes = con.execute(
+            "SELECT COUNT(*) AS total FROM outbox_emails WHERE status = ?", (STATUS_QUEUED,)
+        ).fetchone()["total"]
+    return jsonify({"ok": True, **stats, "pendientes": pendientes})
+
+@bp.get("/admin/outbox")
+def outbox_status():
+    user, err = _require_admin()
+    if err:
+        return err
+
+    with get_connection() as con:
+        counts = {
+            r["status"]: r["total"]
+            for r in con.execute("SELECT status, COUNT(*) AS total FROM outbox_emails GROUP BY status")
+        }
+        dead = con.execute("""
+            SELECT id, to_email, subject, attempts, error, last_attempt_at
+            FROM outbox_emails WHERE status = 'dead'
+            ORDER BY id DESC LIMIT 50
+        """).fetchall()
+    return jsonify({"ok": True, "estados": counts, "fallidos": dead})
+
+@bp.post("/admin/outbox/requeue")
+def outbox_requeue():
+    user, err = _require_admin()
+    if err:
+        return err
+    data = request.get_json(silent=True) or {}
+    ids = [int(i) for i in data.get("ids") or [] if str(i).isdigit()]
+
+    with get_connection() as con:
+        reencolados = requeue_dead(con, ids or None)
+        con.commit()
+    return jsonify({"ok": True, "reencolados": reencolados})
@@ -1,17 +1,21 @@
 from __future__ import annotations
-import csv
-import os
+import re
 import sqlite3
 import json
 from flask import Blueprint, request
 from typing import Any, Dict, List, Optional
+from ..attachment_gc import start_background
+from ..catalog_cache import ALL_SCOPE, MATERIALES_VERSION_KEY, CatalogCache, bump_catalog_version
+from ..chat_cache import chat_cache
 from ..config import Settings
+from ..csv_sync import CatalogCsvWriter
 from ..db import get_connection
-from ..security import verify_access_token, hash_password
+from ..llm_lane import llm_lane
+from ..security import current_user, current_user_id, hash_password
+from ..stock import import_stock_snapshot, iter_stock_rows
 from ..routes.solicitudes import STATUS_PENDING, STATUS_CANCEL_PENDING, STATUS_CANCEL_REJECTED
 
 bp = Blueprint("admin", __name__, url_prefix="/api/admin")
-COOKIE_NAME = "spm_token"
 
 CATALOG_RESOURCES: Dict[str, Dict[str, Any]] = {
     "centros": {
@@ -61,30 +65,14 @@ CATALOG_RESOURCES: Dict[str, Dict[str, Any]] = {
     },
 }
 
-
-def _extract_uid() -> str | None:
-    token = request.cookies.get(COOKIE_NAME)
-    if not token:
-        header = request.headers.get("Authorization", "")
-        if header.startswith("Bearer "):
-            token = header.split(" ", 1)[1].strip()
-    if not token:
-        return None
-    try:
-        payload = verify_access_token(token)
-    except Exception:
-        return None
-    return payload.get("sub")
+catalog_cache = CatalogCache(CATALOG_RESOURCES)
+catalog_csv_writer = CatalogCsvWriter(Settings.CATALOG_CSV_SYNC_INTERVAL)
 
 
 def _require_admin(con) -> tuple[Dict[str, Any] | None, Dict[str, Any] | None]:
-    uid = _extract_uid()
-    if not uid:
+    if not current_user_id():
         return None, {"status": 401, "body": {"ok": False, "error": {"code": "NOAUTH", "message": "No autenticado"}}}
-    row = con.execute(
-        "SELECT id_spm, nombre, apellido, rol FROM usuarios WHERE lower(id_spm)=?",
-        (uid.lower(),),
-    ).fetchone()
+    row = current_user(con)
     if not row:
         return None, {"status": 401, "body": {"ok": False, "error": {"code": "NOUSER", "message": "Usuario no encontrado"}}}
     role = (row.get("rol") or "").lower()
@@ -196,33 +184,6 @@ def _row_to_catalog_item(meta: Dict[str, Any], row: Dict[str, Any]) -> Dict[str,
     return data
 
 
-def _sync_catalog_csv(con: sqlite3.Connection, meta: Dict[str, Any]) -> None:
-    csv_meta = meta.get("csv")
-    if not csv_meta:
-        return
-    filename = csv_meta.get("filename")
-    columns = csv_meta.get("columns") or meta.get("fields") or ()
-    if not filename or not columns:
-        return
-    path = os.path.join(Settings.DATA_DIR, filename)
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    table = meta["table"]
-    order_by = meta.get("order_by") or columns[0]
-    column_clause = ", ".join(columns)
-    rows = con.execute(f"SELECT {column_clause} FROM {table} ORDER BY {order_by}").fetchall()
-    with open(path, "w", encoding="utf-8", newline="") as handle:
-        writer = csv.writer(handle)
-        writer.writerow(columns)
-        bool_columns = set(meta.get("bools", ()))  # type: ignore[arg-type]
-        for row in rows:
-            writer.writerow(
-                [
-                    "" if row[col] is None else (1 if col in bool_columns and bool(row[col]) else row[col])
-                    for col in columns
-                ]
-            )
-
-
 @bp.get("/summary")
 def resumen():
     with get_connection() as con:
@@ -295,6 +256,179 @@ def _safe_limit(raw_value: str | None, default: int = 100, maximum: int = 200) -
     return value
 
 
+USER_SEARCH_COUNT_CAP = 1000
+
+
+def _fts_user_query(q: str) -> str | None:
+    tokens = re.findall(r"\w+", q)
+    if not tokens:
+        return None
+    return " ".join(f'"{token}"*' for token in tokens)
+
+
+def _search_usuarios_fts(con, q: str, limit: int) -> tuple[int, bool, list[Dict[str, Any]]] | None:
+    """Ranked prefix search over usuarios_fts; the count is capped so it stays cheap."""
+    match = _fts_user_query(q)
+    if not match:
+        return None
+    counted = con.execute(
+        "SELECT COUNT(*) AS total FROM (SELECT 1 FROM usuarios_fts WHERE usuarios_fts MATCH ? LIMIT ?)",
+        (match, USER_SEARCH_COUNT_CAP),
+    ).fetchone()["total"]
+    rows = con.execute(
+        """
+        SELECT u.id_spm, u.nombre, u.apellido, u.rol, u.mail, u.sector, u.posicion, u.centros,
+               u.jefe, u.gerente1, u.gerente2
+          FROM usuarios_fts f
+          JOIN usuarios u ON u.id_spm = f.id_spm
+         WHERE usuarios_fts MATCH ?
+      ORDER BY bm25(usuarios_fts, 4.0, 3.0, 3.0, 1.0, 1.0), u.nombre COLLATE NOCASE, u.apellido COLLATE NOCASE
+         LIMIT ?
+        """,
+        (match, limit),
+    ).fetchall()
+    return counted, counted >= USER_SEARCH_COUNT_CAP, rows
+
+
+@bp.get("/archivos/uso")
+def uso_archivos():
+    limit = _safe_limit(request.args.get("limit"), default=20, maximum=100)
+    with get_connection() as con:
+        _, error = _require_admin(con)
+        if error:
+            return error["body"], error["status"]
+        totales = con.execute(
+            """
+            SELECT COALESCE(SUM(archivos), 0) AS archivos, COALESCE(SUM(bytes), 0) AS bytes
+              FROM archivos_uso WHERE ambito='usuario'
+            """
+        ).fetchone()
+        fisico = con.execute(
+            """
+            SELECT COUNT(*) AS blobs, COALESCE(SUM(tamano), 0) AS bytes
+              FROM (SELECT MAX(tamano_bytes) AS tamano FROM archivos_adjuntos WHERE sha256 IS NOT NULL GROUP BY sha256)
+            """
+        ).fetchone()
+        usuarios = con.execute(
+            """
+            SELECT a.clave AS id_spm, u.nombre, u.apellido, a.archivos, a.bytes
+              FROM archivos_uso a
+              LEFT JOIN usuarios u ON lower(u.id_spm) = a.clave
+             WHERE a.ambito='usuario' AND a.archivos > 0
+          ORDER BY a.bytes DESC
+             LIMIT ?
+            """,
+            (limit,),
+        ).fetchall()
+        solicitudes = con.execute(
+            """
+            SELECT CAST(clave AS INTEGER) AS solicitud_id, archivos, bytes
+              FROM archivos_uso
+             WHERE ambito='solicitud' AND archivos > 0
+          ORDER BY bytes DESC
+             LIMIT ?
+            """,
+            (limit,),
+        ).fetchall()
+        ultimo_gc = con.execute(
+            "SELECT * FROM archivos_gc_ejecuciones ORDER BY id DESC LIMIT 1"
+        ).fetchone()
+    return {
+        "ok": True,
+        "totales": {
+            "archivos": totales["archivos"],
+            "bytes": totales["bytes"],
+            "blobs": fisico["blobs"],
+            "bytes_deduplicados": fisico["bytes"],
+            "cuota_por_usuario": Settings.UPLOAD_QUOTA_BYTES or None,
+        },
+        "usuarios": usuarios,
+        "solicitudes": solicitudes,
+        "ultimo_gc": ultimo_gc,
+    }
+
+
+@bp.route("/archivos/gc", methods=["POST", "OPTIONS"])
+def ejecutar_gc_archivos():
+    if request.method == "OPTIONS":
+        return "", 204
+    with get_connection() as con:
+        _, error = _require_admin(con)
+        if error:
+            return error["body"], error["status"]
+    dry_run = request.args.get("dry_run", "0").lower() in {"1", "true", "si", "sí"}
+    # El barrido recorre todo el directorio de uploads: corre fuera de la petición
+    # y su resultado queda en ultimo_gc de /archivos/uso.
+    if not start_background(dry_run=dry_run):
+        return {"ok": False, "error": {"code": "GC_RUNNING", "message": "Ya hay una limpieza de adjuntos en curso"}}, 409
+    return {"ok": True, "gc": {"estado": "iniciado", "dry_run": dry_run}}, 202
+
+
+@bp.route("/stock/import", methods=["POST", "OPTIONS"])
+def importar_stock():
+    if request.method == "OPTIONS":
+        return "", 204
+    with get_connection() as con:
+        _, error = _require_admin(con)
+        if error:
+            return error["body"], error["status"]
+    archivo = request.files.get("archivo")
+    if not archivo or not archivo.filename:
+        return {"ok": False, "error": {"code": "BAD_REQUEST", "message": "Falta el archivo de stock"}}, 400
+    if not archivo.filename.lower().endswith((".csv", ".txt", ".xlsx", ".xlsm")):
+        return {"ok": False, "error": {"code": "BAD_REQUEST", "message": "Formato no soportado (CSV o XLSX)"}}, 400
+    try:
+        stats = import_stock_snapshot(
+            iter_stock_rows(archivo.stream, archivo.filename),
+            origen=archivo.filename,
+            snapshot_at=request.form.get("snapshot_at") or None,
+        )
+    except ValueError as exc:
+        return {"ok": False, "error": {"code": "BAD_REQUEST", "message": str(exc)}}, 400
+    return {"ok": True, "stock": stats}
+
+
+@bp.get("/stock/snapshots")
+def listar_snapshots_stock():
+    with get_connection() as con:
+        _, error = _require_admin(con)
+        if error:
+            return error["body"], error["status"]
+        rows = con.execute(
+            """
+            SELECT id, origen, estado, filas, error, snapshot_at, created_at, finished_at
+              FROM stock_snapshots
+          ORDER BY id DESC
+             LIMIT 20
+            """
+        ).fetchall()
+    return {"ok": True, "snapshots": rows}
+
+
+@bp.get("/llm/metrics")
+def metricas_llm():
+    """Carril LLM y caché de respuestas del worker que atiende la consulta (cada worker lleva los suyos)."""
+    with get_connection() as con:
+        _, error = _require_admin(con)
+        if error:
+            return error["body"], error["status"]
+    return {"ok": True, "llm": llm_lane.metrics(), "cache": chat_cache.metrics()}
+
+
+@bp.route("/chatbot/cache", methods=["DELETE", "OPTIONS"])
+def invalidar_cache_chatbot():
+    """Vacía la caché de respuestas del chatbot en todos los workers."""
+    if request.method == "OPTIONS":
+        return "", 204
+    with get_connection() as con:
+        _, error = _require_admin(con)
+        if error:
+            return error["body"], error["status"]
+        chat_cache.invalidate(con)
+        con.commit()
+    return {"ok": True}
+
+
 @bp.get("/usuarios")
 def administrar_usuarios():
     q = (request.args.get("q") or "").strip().lower()
@@ -303,6 +437,16 @@ def administrar_usuarios():
         _, error = _require_admin(con)
         if error:
             return error["body"], error["status"]
+        if q:
+            try:
+                found = _search_usuarios_fts(con, q, limit)
+            except sqlite3.OperationalError:
+                # Índice FTS ausente (base sin migrar): caemos al LIKE clásico.
+                found = None
+            if found is not None:
+                total, aproximado, rows = found
+                items = [_row_to_user(row) for row in rows]
+                return {"ok": True, "total": total, "total_aproximado": aproximado, "items": items}
         filters: list[str] = []
         params: list[Any] = []
         if q:
@@ -328,7 +472,7 @@ def administrar_usuarios():
             (*params, limit),
         ).fetchall()
     items = [_row_to_user(row) for row in rows]
-    return {"ok": True, "total": total, "items": items}
+    return {"ok": True, "total": total, "total_aproximado": False, "items": items}
 
 
 @bp.route("/usuarios/<user_id>", methods=["PUT", "OPTIONS"])
@@ -519,6 +663,7 @@ def actualizar_material(codigo: str):
             """,
             (descripcion, descripcion_larga, unidad, precio_value, codigo),
         )
+        bump_catalog_version(con, MATERIALES_VERSION_KEY)
         con.commit()
         row = con.execute(
             "SELECT codigo, descripcion, descripcion_larga, unidad, precio_usd, centro, sector FROM materiales WHERE codigo=?",
@@ -558,13 +703,7 @@ def obtener_configuracion_general():
         _, error = _require_admin(con)
         if error:
             return error["body"], error["status"]
-        data: Dict[str, Any] = {}
-        for resource, meta in CATALOG_RESOURCES.items():
-            table = meta["table"]
-            order_by = meta.get("order_by") or "id"
-            rows = con.execute(f"SELECT * FROM {table} ORDER BY {order_by}").fetchall()
-            data[resource] = [_row_to_catalog_item(meta, row) for row in rows]
-    return {"ok": True, "data": data}
+        return catalog_cache.response(con, ALL_SCOPE, include_inactive=True)
 
 
 @bp.get("/config/<resource>")
@@ -576,11 +715,7 @@ def obtener_configuracion_recurso(resource: str):
         _, error = _require_admin(con)
         if error:
             return error["body"], error["status"]
-        table = meta["table"]
-        order_by = meta.get("order_by") or "id"
-        rows = con.execute(f"SELECT * FROM {table} ORDER BY {order_by}").fetchall()
-        items = [_row_to_catalog_item(meta, row) for row in rows]
-    return {"ok": True, "items": items}
+        return catalog_cache.response(con, resource, include_inactive=True)
 
 
 @bp.route("/config/<resource>", methods=["POST", "OPTIONS"])
@@ -608,6 +743,7 @@ def crear_configuracion(resource: str):
                 f"INSERT INTO {table} ({','.join(columns)}) VALUES ({placeholders})",
                 values,
             )
+            bump_catalog_version(con)
             con.commit()
         except sqlite3.IntegrityError:
             return {
@@ -615,14 +751,7 @@ def crear_configuracion(resource: str):
                 "error": {"code": "DUPLICATED", "message": "Ya existe un registro con los mismos datos"},
             }, 409
         row = con.execute(f"SELECT * FROM {table} WHERE id=?", (cur.lastrowid,)).fetchone()
-        if meta.get("csv"):
-            try:
-                _sync_catalog_csv(con, meta)
-            except Exception as err:
-                return {
-                    "ok": False,
-                    "error": {"code": "SYNC_FAILED", "message": f"No se pudo sincronizar el CSV: {err}"},
-                }, 500
+    catalog_csv_writer.mark_dirty(meta)
     return {"ok": True, "item": _row_to_catalog_item(meta, row)}
 
 
@@ -657,6 +786,7 @@ def actualizar_configuracion(resource: str, item_id: int):
                 f"UPDATE {table} SET {', '.join(updates)} WHERE id=?",
                 params,
             )
+            bump_catalog_version(con)
             con.commit()
         except sqlite3.IntegrityError:
             return {
@@ -664,14 +794,7 @@ def actualizar_configuracion(resource: str, item_id: int):
                 "error": {"code": "DUPLICATED", "message": "Los valores generan un duplicado"},
             }, 409
         row = con.execute(f"SELECT * FROM {table} WHERE id=?", (item_id,)).fetchone()
-        if meta.get("csv"):
-            try:
-                _sync_catalog_csv(con, meta)
-            except Exception as err:
-                return {
-                    "ok": False,
-                    "error": {"code": "SYNC_FAILED", "message": f"No se pudo sincronizar el CSV: {err}"},
-                }, 500
+    catalog_csv_writer.mark_dirty(meta)
     return {"ok": True, "item": _row_to_catalog_item(meta, row)}
 
 
@@ -688,15 +811,9 @@ def eliminar_configuracion(resource: str, item_id: int):
         cursor = con.execute(f"DELETE FROM {table} WHERE id=?", (item_id,))
         if cursor.rowcount == 0:
             return {"ok": False, "error": {"code": "NOTFOUND", "message": "Registro no encontrado"}}, 404
+        bump_catalog_version(con)
         con.commit()
-        if meta.get("csv"):
-            try:
-                _sync_catalog_csv(con, meta)
-            except Exception as err:
-                return {
-                    "ok": False,
-                    "error": {"code": "SYNC_FAILED", "message": f"No se pudo sincronizar el CSV: {err}"},
-                }, 500
+    catalog_csv_writer.mark_dirty(meta)
     return {"ok": True}
 
 
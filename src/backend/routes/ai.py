@@ -2,41 +2,50 @@ from __future__ import annotations
 
 from flask import Blueprint, jsonify, request
 
-from ..ai_service import AIService
-from ..security import verify_access_token
+from ..ai_service import ai_service
+from ..db import get_connection
+from ..schemas import AISuggestionBatch
+from ..security import current_user
 from ..roles import has_role
 
 bp = Blueprint("ai", __name__, url_prefix="/api/ai")
 
-ai_service = AIService()
+
+def _json_error(code: str, message: str, status: int):
+    return jsonify({"ok": False, "error": {"code": code, "message": message}}), status
+
+
+def _require_planner():
+    with get_connection() as con:
+        user = current_user(con)
+    if not user:
+        return None, _json_error("unauthorized", "Unauthorized", 401)
+    if not has_role(user, "planner", "planificador", "admin", "administrador"):
+        return None, _json_error("forbidden", "Forbidden", 403)
+    return user, None
 
 @bp.route("/suggest/solicitud/<int:sol_id>", methods=["GET"])
 def get_suggestions(sol_id: int):
     """Obtiene sugerencias IA para una solicitud."""
-    user = verify_access_token(request)
-    if not user:
-        return jsonify({"error": "Unauthorized"}), 401
-    if not has_role(user, "planner", "planificador", "admin", "administrador"):
-        return jsonify({"error": "Forbidden"}), 403
-    
-    if not AIService().get_suggestions_for_solicitud(sol_id):
-        return jsonify({"error": "Solicitud no encontrada"}), 404
+    user, err = _require_planner()
+    if err:
+        return err
 
-    suggestions = ai_service.get_suggestions_for_solicitud(sol_id)
-    return jsonify({"suggestions": suggestions})
+    result = ai_service.get_cached_suggestions(sol_id)
+    if result is None:
+        return _json_error("not_found", "Solicitud no encontrada", 404)
+    return jsonify(result)
 
 @bp.route("/suggest/accept", methods=["POST"])
 def accept_suggestion():
     """Acepta una sugerencia IA."""
-    user = verify_access_token(request)
-    if not user:
-        return jsonify({"ok": False, "error": "Unauthorized"}), 401
-    if not has_role(user, "planner", "planificador", "admin", "administrador"):
-        return jsonify({"ok": False, "error": "Forbidden"}), 403
-    
+    user, err = _require_planner()
+    if err:
+        return err
+
     data = request.get_json()
     if not data:
-        return jsonify({"ok": False, "error": "Datos requeridos"}), 400
+        return _json_error("invalid_data", "Datos requeridos", 400)
 
     sol_id = data.get("solicitud_id")
     item_index = data.get("item_index")
@@ -44,36 +53,60 @@ def accept_suggestion():
     payload = data.get("payload", {})
 
     if not all([sol_id, item_index is not None, sug_type]):
-        return jsonify({"ok": False, "error": "Campos requeridos: solicitud_id, item_index, type"}), 400
+        return _json_error("invalid_data", "Campos requeridos: solicitud_id, item_index, type", 400)
 
     success = ai_service.apply_suggestion(sol_id, item_index, sug_type, payload, user["id_spm"])
     if success:
         return jsonify({"ok": True})
     else:
-        return jsonify({"ok": False, "error": "Error aplicando sugerencia"}), 500
+        return _json_error("db_error", "Error aplicando sugerencia", 500)
 
 @bp.route("/suggest/reject", methods=["POST"])
 def reject_suggestion():
     """Rechaza una sugerencia IA."""
-    user = verify_access_token(request)
-    if not user:
-        return jsonify({"ok": False, "error": "Unauthorized"}), 401
-    if not has_role(user, "planner", "planificador", "admin", "administrador"):
-        return jsonify({"ok": False, "error": "Forbidden"}), 403
-    
+    user, err = _require_planner()
+    if err:
+        return err
+
     data = request.get_json()
     if not data:
-        return jsonify({"ok": False, "error": "Datos requeridos"}), 400
+        return _json_error("invalid_data", "Datos requeridos", 400)
 
     sol_id = data.get("solicitud_id")
     item_index = data.get("item_index")
     sug_type = data.get("type")
 
     if not all([sol_id, item_index is not None, sug_type]):
-        return jsonify({"ok": False, "error": "Campos requeridos: solicitud_id, item_index, type"}), 400
+        return _json_error("invalid_data", "Campos requeridos: solicitud_id, item_index, type", 400)
 
     success = ai_service.reject_suggestion(sol_id, item_index, sug_type, user["id_spm"])
     if success:
         return jsonify({"ok": True})
     else:
-        return jsonify({"ok": False, "error": "Error rechazando sugerencia"}), 500
\ No newline at end of file
+        return _json_error("db_error", "Error rechazando sugerencia", 500)
+
+@bp.route("/suggest/batch", methods=["POST"])
+def decide_suggestions():
+    """Acepta y/o rechaza varias sugerencias IA de una solicitud en una sola transacción."""
+    user, err = _require_planner()
+    if err:
+        return err
+
+    try:
+        validated = AISuggestionBatch(**(request.get_json() or {}))
+    except Exception as e:
+        return _json_error("validation_error", str(e), 400)
+
+    try:
+        stats = ai_service.apply_decisions(
+            validated.solicitud_id,
+            [d.model_dump() for d in validated.decisiones],
+            user["id_spm"],
+        )
+    except LookupError as e:
+        return _json_error("not_found", str(e), 404)
+    except ValueError as e:
+        return _json_error("invalid_data", str(e), 400)
+    except Exception as e:
+        return _json_error("db_error", str(e), 500)
+    return jsonify({"ok": True, **stats})
@@ -1,40 +1,38 @@
 from __future__ import annotations
 
 import os
+import shutil
 import uuid
-from datetime import datetime
+from datetime import datetime, timezone
 from typing import Any
+from urllib.parse import quote
+from werkzeug.http import is_resource_modified
 from werkzeug.utils import secure_filename
-from flask import Blueprint, jsonify, request, send_file
-
+from flask import Blueprint, current_app, jsonify, request, send_file
+
+from ..attachment_store import (
+    blob_path,
+    chunked_upload_path,
+    discard_temp,
+    hash_file,
+    quota_exceeded,
+    release_blob,
+    store_blob,
+    stream_to_temp,
+    write_chunk,
+)
 from ..db import get_connection
 from ..config import Settings
-from ..security import verify_access_token
+from ..security import current_user_id
+from ..thumbnails import ThumbnailWorker, supports_thumbnail, thumb_path
 
 bp = Blueprint("archivos", __name__, url_prefix="/api")
 
-COOKIE_NAME = "spm_token"
-
-
-def _get_auth_token() -> str | None:
-    token = request.cookies.get(COOKIE_NAME)
-    if not token:
-        header = request.headers.get("Authorization", "")
-        if header.startswith("Bearer "):
-            token = header.split(" ", 1)[1].strip()
-    return token or None
 
+thumbnail_worker = ThumbnailWorker(Settings.THUMBNAIL_WORKERS, Settings.THUMBNAIL_MAX_PX)
 
-def _require_auth() -> str | None:
-    token = _get_auth_token()
-    if not token:
-        return None
-    try:
-        payload = verify_access_token(token)
-    except Exception:
-        return None
-    sub = payload.get("sub")
-    return str(sub).strip() if sub else None
+# Una escritura reclamada y abandonada (proceso caído) se libera pasado este tiempo
+_WRITE_CLAIM_SECONDS = 300
 
 
 def _json_error(code: str, message: str, status: int = 400):
@@ -53,10 +51,87 @@ def _utcnow_iso() -> str:
     return datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
 
 
+def _parse_iso(value: str | None) -> datetime | None:
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00").replace(" ", "T"))
+    except ValueError:
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def _accel_redirect_path(file_path: str) -> str | None:
+    """Ruta interna de nginx para el archivo, o None si la descarga la sirve Flask."""
+    prefix = Settings.ATTACHMENTS_ACCEL_PREFIX
+    if not prefix:
+        return None
+    relative = os.path.relpath(os.path.abspath(file_path), os.path.abspath(Settings.UPLOADS_DIR))
+    if relative.startswith(os.pardir):
+        return None
+    return prefix.rstrip("/") + "/" + quote(relative.replace(os.sep, "/"))
+
+
+def _nginx_validators(file_path: str) -> tuple[str, datetime]:
+    """ETag y Last-Modified tal como los calcula nginx para un archivo estático.
+
+    Con X-Accel-Redirect nginx responde con sus propios validadores (mtime y
+    tamaño) y resuelve If-Range con ellos; Flask usa los mismos para que el 304
+    y el Range coincidan.
+    """
+    info = os.stat(file_path)
+    mtime = int(info.st_mtime)
+    return f"{mtime:x}-{info.st_size:x}", datetime.fromtimestamp(mtime, tz=timezone.utc)
+
+
+def _download_headers(response, etag: str | None, last_modified: datetime | None):
+    if etag:
+        response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+def _register_attachment(
+    con,
+    *,
+    solicitud_id: int,
+    user_id: str,
+    original_filename: str,
+    tipo_mime: str | None,
+    size: int,
+    sha256: str,
+    tmp_path: str,
+) -> tuple[int, str]:
+    """Inserta la referencia y mueve el temporal al almacén; el llamador confirma la transacción."""
+    created_at = _utcnow_iso()
+    cursor = con.execute(
+        """
+        INSERT INTO archivos_adjuntos 
+        (solicitud_id, nombre_archivo, nombre_original, tipo_mime, tamano_bytes, ruta_archivo, usuario_id, created_at, sha256)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (
+            solicitud_id,
+            sha256,
+            original_filename,
+            tipo_mime or 'application/octet-stream',
+            size,
+            blob_path(sha256),
+            user_id,
+            created_at,
+            sha256,
+        )
+    )
+    store_blob(tmp_path, sha256)
+    return cursor.lastrowid, created_at
+
+
 @bp.route("/archivos/upload/<int:solicitud_id>", methods=["POST"])
 def upload_archivo(solicitud_id: int):
     """Subir un archivo adjunto a una solicitud."""
-    user_id = _require_auth()
+    user_id = current_user_id()
     if not user_id:
         return _json_error("auth_required", "Autenticación requerida", 401)
 
@@ -70,6 +145,7 @@ def upload_archivo(solicitud_id: int):
     if not _allowed_file(file.filename):
         return _json_error("invalid_file", f"Tipo de archivo no permitido. Extensiones permitidas: {', '.join(Settings.ALLOWED_EXTENSIONS)}")
 
+    tmp_path = None
     try:
         with get_connection() as con:
             # Verificar que la solicitud existe y pertenece al usuario
@@ -84,42 +160,28 @@ def upload_archivo(solicitud_id: int):
             if solicitud['id_usuario'].lower() != user_id.lower():
                 return _json_error("forbidden", "No tienes permisos para adjuntar archivos a esta solicitud", 403)
 
-            # Generar nombre único para el archivo
             original_filename = secure_filename(file.filename)
-            file_extension = original_filename.rsplit('.', 1)[1].lower() if '.' in original_filename else ''
-            unique_filename = f"{uuid.uuid4().hex}.{file_extension}" if file_extension else uuid.uuid4().hex
-            
-            # Guardar archivo
-            os.makedirs(Settings.UPLOADS_DIR, exist_ok=True)
-            file_path = os.path.join(Settings.UPLOADS_DIR, unique_filename)
-            file.save(file_path)
-            
-            # Obtener tamaño del archivo
-            file_size = os.path.getsize(file_path)
 
-            created_at = _utcnow_iso()
-            
-            # Guardar en base de datos
-            cursor = con.execute(
-                """
-                INSERT INTO archivos_adjuntos 
-                (solicitud_id, nombre_archivo, nombre_original, tipo_mime, tamano_bytes, ruta_archivo, usuario_id, created_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """,
-                (
-                    solicitud_id,
-                    unique_filename,
-                    original_filename,
-                    file.content_type or 'application/octet-stream',
-                    file_size,
-                    file_path,
-                    user_id,
-                    created_at,
-                )
+            # Copiar a disco calculando el SHA-256 en el mismo paso; el contenido
+            # repetido se guarda una sola vez y cada fila es una referencia.
+            tmp_path, sha256, file_size = stream_to_temp(file.stream)
+            if quota_exceeded(con, user_id, file_size):
+                discard_temp(tmp_path)
+                return _json_error("quota_exceeded", "Se superó la cuota de almacenamiento de adjuntos", 413)
+
+            archivo_id, created_at = _register_attachment(
+                con,
+                solicitud_id=solicitud_id,
+                user_id=user_id,
+                original_filename=original_filename,
+                tipo_mime=file.content_type,
+                size=file_size,
+                sha256=sha256,
+                tmp_path=tmp_path,
             )
-            
-            archivo_id = cursor.lastrowid
+            tmp_path = None
             con.commit()
+            thumbnail_worker.submit(sha256, file.content_type)
             
             return jsonify({
                 "ok": True,
@@ -133,19 +195,275 @@ def upload_archivo(solicitud_id: int):
             })
             
     except Exception as e:
-        # Si hay error, eliminar el archivo físico si fue creado
-        try:
-            if 'file_path' in locals() and os.path.exists(file_path):
-                os.unlink(file_path)
-        except:
-            pass
+        # Si hay error, eliminar el temporal; el blob solo existe si la fila se confirmó
+        discard_temp(tmp_path)
         return _json_error("upload_error", f"Error al subir archivo: {str(e)}", 500)
 
 
+def _serialize_upload(row: dict[str, Any]) -> dict[str, Any]:
+    return {
+        "upload_id": row["id"],
+        "solicitud_id": row["solicitud_id"],
+        "nombre_original": row["nombre_original"],
+        "tamano_total": row["tamano_total"],
+        "recibido_bytes": row["recibido_bytes"],
+        "chunk_size": Settings.UPLOAD_CHUNK_SIZE,
+    }
+
+
+def _load_upload(con, upload_id: str, user_id: str):
+    row = con.execute("SELECT * FROM archivos_uploads WHERE id = ?", (upload_id,)).fetchone()
+    if not row or row["usuario_id"].lower() != user_id.lower():
+        return None
+    return row
+
+
+@bp.route("/archivos/uploads/<int:solicitud_id>", methods=["POST"])
+def iniciar_subida(solicitud_id: int):
+    """Iniciar una subida por partes reanudable."""
+    user_id = current_user_id()
+    if not user_id:
+        return _json_error("auth_required", "Autenticación requerida", 401)
+
+    payload = request.get_json(silent=True) or {}
+    original_filename = secure_filename(str(payload.get("nombre") or ""))
+    if not _allowed_file(original_filename):
+        return _json_error("invalid_file", f"Tipo de archivo no permitido. Extensiones permitidas: {', '.join(Settings.ALLOWED_EXTENSIONS)}")
+    try:
+        total = int(payload.get("tamano"))
+    except (TypeError, ValueError):
+        return _json_error("invalid_size", "Tamaño de archivo inválido")
+    if total <= 0 or total > Settings.MAX_UPLOAD_SIZE:
+        return _json_error("invalid_size", f"El archivo debe pesar entre 1 byte y {Settings.MAX_UPLOAD_SIZE} bytes")
+    expected = str(payload.get("sha256") or "").strip().lower() or None
+    if expected and (len(expected) != 64 or any(ch not in "0123456789abcdef" for ch in expected)):
+        return _json_error("invalid_checksum", "El SHA-256 debe tener 64 caracteres hexadecimales")
+
+    with get_connection() as con:
+        solicitud = con.execute(
+            "SELECT id, id_usuario FROM solicitudes WHERE id = ?",
+            (solicitud_id,)
+        ).fetchone()
+        if not solicitud:
+            return _json_error("not_found", "Solicitud no encontrada", 404)
+        if solicitud['id_usuario'].lower() != user_id.lower():
+            return _json_error("forbidden", "No tienes permisos para adjuntar archivos a esta solicitud", 403)
+        if quota_exceeded(con, user_id, total):
+            return _json_error("quota_exceeded", "Se superó la cuota de almacenamiento de adjuntos", 413)
+
+        upload_id = uuid.uuid4().hex
+        con.execute(
+            """
+            INSERT INTO archivos_uploads
+            (id, solicitud_id, usuario_id, nombre_original, tipo_mime, tamano_total, sha256_esperado)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                upload_id,
+                solicitud_id,
+                user_id,
+                original_filename,
+                str(payload.get("tipo_mime") or "") or None,
+                total,
+                expected,
+            ),
+        )
+        con.commit()
+        row = con.execute("SELECT * FROM archivos_uploads WHERE id = ?", (upload_id,)).fetchone()
+    return jsonify({"ok": True, "upload": _serialize_upload(row)}), 201
+
+
+@bp.route("/archivos/uploads/<upload_id>", methods=["GET"])
+def estado_subida(upload_id: str):
+    """Consultar cuántos bytes se recibieron para reanudar desde ahí."""
+    user_id = current_user_id()
+    if not user_id:
+        return _json_error("auth_required", "Autenticación requerida", 401)
+    with get_connection() as con:
+        row = _load_upload(con, upload_id, user_id)
+    if not row:
+        return _json_error("not_found", "Subida no encontrada", 404)
+    return jsonify({"ok": True, "upload": _serialize_upload(row)})
+
+
+@bp.route("/archivos/uploads/<upload_id>", methods=["PUT"])
+def subir_parte(upload_id: str):
+    """Recibir una parte en el offset indicado; el cuerpo es binario crudo."""
+    user_id = current_user_id()
+    if not user_id:
+        return _json_error("auth_required", "Autenticación requerida", 401)
+    try:
+        offset = int(request.args.get("offset", ""))
+    except ValueError:
+        return _json_error("invalid_offset", "Offset inválido")
+
+    with get_connection() as con:
+        row = _load_upload(con, upload_id, user_id)
+    if not row:
+        return _json_error("not_found", "Subida no encontrada", 404)
+    if offset != row["recibido_bytes"]:
+        # El cliente reanuda desde recibido_bytes
+        return jsonify({
+            "ok": False,
+            "error": {"code": "offset_mismatch", "message": "El offset no coincide con lo recibido"},
+            "upload": _serialize_upload(row),
+        }), 409
+    limit = min(Settings.UPLOAD_CHUNK_SIZE, row["tamano_total"] - offset)
+    if request.content_length is not None and request.content_length > limit:
+        return _json_error("chunk_too_large", f"La parte excede el máximo de {limit} bytes", 413)
+
+    # Reclamar la escritura: dos PUT al mismo offset (reintento del cliente) no pueden
+    # escribir a la vez, porque el perdedor truncaría lo que el ganador ya confirmó.
+    claim = uuid.uuid4().hex
+    with get_connection() as con:
+        cur = con.execute(
+            """
+            UPDATE archivos_uploads
+               SET escritura_token = ?, escritura_at = CURRENT_TIMESTAMP
+             WHERE id = ? AND recibido_bytes = ?
+               AND (escritura_token IS NULL OR escritura_at < datetime('now', ?))
+            """,
+            (claim, upload_id, offset, f"-{_WRITE_CLAIM_SECONDS} seconds"),
+        )
+        con.commit()
+        if cur.rowcount == 0:
+            row = con.execute("SELECT * FROM archivos_uploads WHERE id = ?", (upload_id,)).fetchone()
+            if not row:
+                return _json_error("not_found", "Subida no encontrada", 404)
+            return jsonify({
+                "ok": False,
+                "error": {"code": "upload_busy", "message": "Otra parte se está escribiendo en este offset"},
+                "upload": _serialize_upload(row),
+            }), 409
+
+    written = 0
+    try:
+        written = write_chunk(chunked_upload_path(upload_id), offset, request.stream, limit=limit)
+    finally:
+        with get_connection() as con:
+            # Avanza y libera el reclamo solo si sigue siendo nuestro
+            con.execute(
+                """
+                UPDATE archivos_uploads
+                   SET recibido_bytes = ?, escritura_token = NULL, escritura_at = NULL,
+                       updated_at = CURRENT_TIMESTAMP
+                 WHERE id = ? AND recibido_bytes = ? AND escritura_token = ?
+                """,
+                (offset + written, upload_id, offset, claim),
+            )
+            con.commit()
+            row = con.execute("SELECT * FROM archivos_uploads WHERE id = ?", (upload_id,)).fetchone()
+    if not row:
+        return _json_error("not_found", "Subida no encontrada", 404)
+    return jsonify({"ok": True, "upload": _serialize_upload(row)})
+
+
+@bp.route("/archivos/uploads/<upload_id>/complete", methods=["POST"])
+def completar_subida(upload_id: str):
+    """Verificar el checksum y mover el archivo ensamblado al almacén."""
+    user_id = current_user_id()
+    if not user_id:
+        return _json_error("auth_required", "Autenticación requerida", 401)
+
+    with get_connection() as con:
+        row = _load_upload(con, upload_id, user_id)
+    if not row:
+        return _json_error("not_found", "Subida no encontrada", 404)
+    if row["recibido_bytes"] != row["tamano_total"]:
+        return jsonify({
+            "ok": False,
+            "error": {"code": "incomplete", "message": "Faltan partes por subir"},
+            "upload": _serialize_upload(row),
+        }), 409
+
+    if row["escritura_token"]:
+        return jsonify({
+            "ok": False,
+            "error": {"code": "upload_busy", "message": "Todavía se está escribiendo una parte"},
+            "upload": _serialize_upload(row),
+        }), 409
+
+    tmp_path = chunked_upload_path(upload_id)
+    try:
+        size = os.stat(tmp_path).st_size
+    except FileNotFoundError:
+        return _json_error("file_not_found", "No se encontraron las partes subidas", 404)
+    if size != row["tamano_total"]:
+        # El contador y el archivo no coinciden: el cliente reanuda desde lo que hay en disco
+        with get_connection() as con:
+            con.execute(
+                "UPDATE archivos_uploads SET recibido_bytes = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                (min(size, row["tamano_total"]), upload_id),
+            )
+            con.commit()
+            row = con.execute("SELECT * FROM archivos_uploads WHERE id = ?", (upload_id,)).fetchone()
+        return jsonify({
+            "ok": False,
+            "error": {"code": "incomplete", "message": "El archivo ensamblado no tiene el tamaño declarado"},
+            "upload": _serialize_upload(row),
+        }), 409
+    try:
+        sha256 = hash_file(tmp_path)
+    except FileNotFoundError:
+        return _json_error("file_not_found", "No se encontraron las partes subidas", 404)
+    expected = row["sha256_esperado"]
+    if expected and expected != sha256:
+        # Las partes no se conservan: el contenido está corrupto
+        with get_connection() as con:
+            con.execute("DELETE FROM archivos_uploads WHERE id = ?", (upload_id,))
+            con.commit()
+        discard_temp(tmp_path)
+        return _json_error("checksum_mismatch", "El SHA-256 del archivo no coincide", 422)
+
+    # El almacén recibe un enlace al archivo ensamblado; las partes se borran recién
+    # después del commit, así un fallo deja la subida intacta para reintentar.
+    stored_path = f"{tmp_path}.{uuid.uuid4().hex[:8]}.store"
+    try:
+        try:
+            os.link(tmp_path, stored_path)
+        except OSError:
+            # Sistemas de archivos sin enlaces duros
+            shutil.copyfile(tmp_path, stored_path)
+        with get_connection() as con:
+            cur = con.execute("DELETE FROM archivos_uploads WHERE id = ?", (upload_id,))
+            if cur.rowcount == 0:
+                discard_temp(stored_path)
+                return _json_error("not_found", "Subida no encontrada", 404)
+            archivo_id, created_at = _register_attachment(
+                con,
+                solicitud_id=row["solicitud_id"],
+                user_id=user_id,
+                original_filename=row["nombre_original"],
+                tipo_mime=row["tipo_mime"],
+                size=size,
+                sha256=sha256,
+                tmp_path=stored_path,
+            )
+            con.commit()
+    except Exception as e:
+        # Si el enlace ya llegó al almacén sin referencia, el GC de adjuntos lo recoge
+        discard_temp(stored_path)
+        return _json_error("upload_error", f"Error al completar la subida: {str(e)}", 500)
+    discard_temp(tmp_path)
+    thumbnail_worker.submit(sha256, row["tipo_mime"])
+
+    return jsonify({
+        "ok": True,
+        "archivo": {
+            "id": archivo_id,
+            "nombre_original": row["nombre_original"],
+            "tamano_bytes": size,
+            "tipo_mime": row["tipo_mime"],
+            "sha256": sha256,
+            "created_at": created_at,
+        }
+    })
+
+
 @bp.route("/archivos/solicitud/<int:solicitud_id>", methods=["GET"])
 def listar_archivos(solicitud_id: int):
     """Listar archivos adjuntos de una solicitud."""
-    user_id = _require_auth()
+    user_id = current_user_id()
     if not user_id:
         return _json_error("auth_required", "Autenticación requerida", 401)
 
@@ -167,17 +485,28 @@ def listar_archivos(solicitud_id: int):
             # Obtener archivos
             archivos = con.execute(
                 """
-                SELECT id, nombre_original, tipo_mime, tamano_bytes, created_at
+                SELECT id, nombre_original, tipo_mime, tamano_bytes, created_at, sha256
                 FROM archivos_adjuntos 
                 WHERE solicitud_id = ?
                 ORDER BY created_at DESC
                 """,
                 (solicitud_id,)
             ).fetchall()
+
+            items = []
+            for archivo in archivos:
+                item = dict(archivo)
+                sha256 = item.pop("sha256", None)
+                item["thumb_url"] = (
+                    f"/api/archivos/{item['id']}/thumb"
+                    if sha256 and supports_thumbnail(item.get("tipo_mime"))
+                    else None
+                )
+                items.append(item)
             
             return jsonify({
                 "ok": True,
-                "archivos": [dict(archivo) for archivo in archivos]
+                "archivos": items
             })
             
     except Exception as e:
@@ -187,7 +516,7 @@ def listar_archivos(solicitud_id: int):
 @bp.route("/archivos/download/<int:archivo_id>", methods=["GET"])
 def descargar_archivo(archivo_id: int):
     """Descargar un archivo adjunto."""
-    user_id = _require_auth()
+    user_id = current_user_id()
     if not user_id:
         return _json_error("auth_required", "Autenticación requerida", 401)
 
@@ -211,25 +540,102 @@ def descargar_archivo(archivo_id: int):
             if archivo['solicitud_usuario'].lower() != user_id.lower():
                 return _json_error("forbidden", "No tienes permisos para descargar este archivo", 403)
             
-            # Verificar que el archivo físico existe
-            if not os.path.exists(archivo['ruta_archivo']):
-                return _json_error("file_not_found", "Archivo físico no encontrado", 404)
-            
-            return send_file(
-                archivo['ruta_archivo'],
-                as_attachment=True,
-                download_name=archivo['nombre_original'],
-                mimetype=archivo['tipo_mime']
-            )
+        # Verificar que el archivo físico existe
+        if not os.path.exists(archivo['ruta_archivo']):
+            return _json_error("file_not_found", "Archivo físico no encontrado", 404)
+
+        accel_path = _accel_redirect_path(archivo['ruta_archivo'])
+        if accel_path:
+            # nginx entrega los bytes (incluido Range) con sus validadores; el worker solo autoriza
+            etag, last_modified = _nginx_validators(archivo['ruta_archivo'])
+            if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                return _download_headers(current_app.response_class(status=304), etag, last_modified)
+            response = current_app.response_class(mimetype=archivo['tipo_mime'])
+            response.headers['X-Accel-Redirect'] = accel_path
+            response.headers.set('Content-Disposition', 'attachment', filename=archivo['nombre_original'])
+            return _download_headers(response, etag, last_modified)
+
+        # El hash del contenido es un validador fuerte
+        etag = archivo.get('sha256')
+        last_modified = _parse_iso(archivo.get('created_at')) if etag else None
+        if etag and not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            return _download_headers(current_app.response_class(status=304), etag, last_modified)
+
+        # send_file responde Range (206) y condicionales; los archivos sin hash usan su ETag por defecto
+        response = send_file(
+            archivo['ruta_archivo'],
+            as_attachment=True,
+            download_name=archivo['nombre_original'],
+            mimetype=archivo['tipo_mime'],
+            conditional=True,
+            etag=etag or True,
+            last_modified=last_modified,
+        )
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
             
     except Exception as e:
         return _json_error("download_error", f"Error al descargar archivo: {str(e)}", 500)
 
 
+@bp.route("/archivos/<int:archivo_id>/thumb", methods=["GET"])
+def miniatura_archivo(archivo_id: int):
+    """Vista previa reducida de una imagen o de la primera página de un PDF."""
+    user_id = current_user_id()
+    if not user_id:
+        return _json_error("auth_required", "Autenticación requerida", 401)
+
+    with get_connection() as con:
+        archivo = con.execute(
+            """
+            SELECT a.id, a.tipo_mime, a.sha256, a.created_at, s.id_usuario as solicitud_usuario
+            FROM archivos_adjuntos a
+            JOIN solicitudes s ON a.solicitud_id = s.id
+            WHERE a.id = ?
+            """,
+            (archivo_id,)
+        ).fetchone()
+    if not archivo:
+        return _json_error("not_found", "Archivo no encontrado", 404)
+    if archivo['solicitud_usuario'].lower() != user_id.lower():
+        return _json_error("forbidden", "No tienes permisos para ver este archivo", 403)
+    sha256 = archivo.get('sha256')
+    if not sha256 or not supports_thumbnail(archivo.get('tipo_mime')):
+        return _json_error("no_preview", "El archivo no admite vista previa", 404)
+
+    path = thumb_path(sha256)
+    accel_path = _accel_redirect_path(path)
+    # La miniatura depende solo del contenido: el hash sirve como ETag (con X-Accel valen los de nginx)
+    etag = f"{sha256}-thumb"
+    last_modified = _parse_iso(archivo.get('created_at'))
+    if not accel_path and not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return _download_headers(current_app.response_class(status=304), etag, last_modified)
+
+    if not os.path.exists(path):
+        # Se genera en segundo plano; el cliente reintenta más tarde
+        if thumbnail_worker.submit(sha256, archivo.get('tipo_mime')):
+            response = jsonify({"ok": True, "pendiente": True})
+            response.status_code = 202
+            response.headers["Retry-After"] = "2"
+            return response
+        return _json_error("no_preview", "No se pudo generar la vista previa", 404)
+
+    if accel_path:
+        etag, last_modified = _nginx_validators(path)
+        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            return _download_headers(current_app.response_class(status=304), etag, last_modified)
+        response = current_app.response_class(mimetype="image/jpeg")
+        response.headers['X-Accel-Redirect'] = accel_path
+        return _download_headers(response, etag, last_modified)
+    response = send_file(path, mimetype="image/jpeg", conditional=True, etag=etag, last_modified=last_modified)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
 @bp.route("/archivos/delete/<int:archivo_id>", methods=["DELETE"])
 def eliminar_archivo(archivo_id: int):
     """Eliminar un archivo adjunto."""
-    user_id = _require_auth()
+    user_id = current_user_id()
     if not user_id:
         return _json_error("auth_required", "Autenticación requerida", 401)
 
@@ -253,17 +659,11 @@ def eliminar_archivo(archivo_id: int):
             if archivo['solicitud_usuario'].lower() != user_id.lower():
                 return _json_error("forbidden", "No tienes permisos para eliminar este archivo", 403)
             
-            # Eliminar registro de la base de datos
+            # Eliminar la referencia; el archivo físico solo se borra con la última
             con.execute("DELETE FROM archivos_adjuntos WHERE id = ?", (archivo_id,))
+            release_blob(con, archivo.get('sha256'), archivo['ruta_archivo'])
             con.commit()
             
-            # Eliminar archivo físico
-            try:
-                if os.path.exists(archivo['ruta_archivo']):
-                    os.unlink(archivo['ruta_archivo'])
-            except Exception:
-                pass  # No fallar si no se puede eliminar el archivo físico
-            
             return jsonify({"ok": True, "message": "Archivo eliminado correctamente"})
             
     except Exception as e:
@@ -9,10 +9,9 @@ from ..schemas import (
     AdditionalCentersRequest,
     UpdateMailRequest,
 )
-from ..security import verify_password, hash_password, create_access_token, verify_access_token
+from ..security import COOKIE_NAME, verify_password, hash_password, create_access_token, request_token, verify_access_token
 
 bp = Blueprint("auth", __name__, url_prefix="/api")
-COOKIE_NAME = "spm_token"
 
 def _cookie_args():
     return dict(httponly=True, samesite="Lax", secure=False)
@@ -98,7 +97,7 @@ def register():
 
 @bp.get("/me")
 def me():
-    token = request.cookies.get(COOKIE_NAME)
+    token = request_token()
     if not token:
         return {"ok": False, "error": {"code": "NOAUTH", "message": "No autenticado"}}, 401
     try:
@@ -142,7 +141,7 @@ def me():
 
 
 def _require_user_id():
-    token = request.cookies.get(COOKIE_NAME)
+    token = request_token()
     if not token:
         return None, ("NOAUTH", "No autenticado", 401)
     try:
@@ -1,14 +1,17 @@
 from __future__ import annotations
 import json
-from typing import List, Dict
-from urllib.parse import urljoin
-import requests
-from flask import Blueprint, request
+from itertools import chain
+from typing import Any, List, Dict
+from flask import Blueprint, Response, request
+from ..ai_service import material_index
+from ..chat_cache import chat_cache
 from ..config import Settings
-from ..security import verify_access_token
+from ..db import get_connection
+from ..llm_lane import LaneRejected, llm_lane
+from ..ollama_client import OllamaClient, OllamaError
+from ..security import current_user_id
 
 bp = Blueprint("chatbot", __name__, url_prefix="/api")
-_COOKIE_NAME = "spm_token"
 _ALLOWED_ROLES = {"user", "assistant", "system"}
 _SYSTEM_PROMPT = (
     "Actuás como especialista de SPM, enfocado en la aplicacion web y los flujos de "
@@ -16,21 +19,13 @@ _SYSTEM_PROMPT = (
     "del sitio, procesos de catalogo y buenas practicas con materiales criticos. "
     "Responde siempre en español y mantente dentro del dominio Oil & Gas y la aplicacion."
 )
+_EMPTY_ANSWER = "No obtuve una respuesta del modelo."
+_CATALOG_PROMPT = (
+    "Materiales del catálogo SPM relacionados con la consulta (código: descripción [unidad]). "
+    "Si la respuesta menciona materiales, citá solo códigos de esta lista y no inventes otros:"
+)
 
-
-def _require_user() -> str | None:
-    token = request.cookies.get(_COOKIE_NAME)
-    if not token:
-        header = request.headers.get("Authorization", "")
-        if header.startswith("Bearer "):
-            token = header.split(" ", 1)[1].strip()
-    if not token:
-        return None
-    try:
-        payload = verify_access_token(token)
-    except Exception:
-        return None
-    return payload.get("sub")
+ollama_client = OllamaClient()
 
 
 def _sanitize_history(raw: List[Dict[str, str]]) -> List[Dict[str, str]]:
@@ -47,85 +42,143 @@ def _sanitize_history(raw: List[Dict[str, str]]) -> List[Dict[str, str]]:
     return safe_messages
 
 
-def _resolve_ollama_url() -> str:
-    base = (Settings.OLLAMA_ENDPOINT or "").strip() or "http://127.0.0.1:11434"
-    if "://" not in base:
-        base = f"http://{base}"
-    base = base.rstrip("/") + "/"
-    return urljoin(base, "api/chat")
-
-
-def _resolve_ollama_model() -> str:
-    model = (Settings.OLLAMA_MODEL or "").strip()
-    if not model:
-        return "llama3.1"
-    return model
-
-
-@bp.route("/chatbot", methods=["POST", "OPTIONS"])
-def invoke_chatbot():
-    if request.method == "OPTIONS":
-        return "", 204
-    user_sub = _require_user()
+def _parse_chat_request() -> tuple[List[Dict[str, str]] | None, tuple[Dict[str, Any], int] | None]:
+    user_sub = current_user_id()
     if not user_sub:
-        return {"ok": False, "error": {"code": "NOAUTH", "message": "No autenticado"}}, 401
+        return None, ({"ok": False, "error": {"code": "NOAUTH", "message": "No autenticado"}}, 401)
 
     payload = request.get_json(silent=True) or {}
     message = str(payload.get("message", "")).strip()
     history_raw = payload.get("history") or []
 
     if not message:
-        return {"ok": False, "error": {"code": "EMPTY", "message": "Ingresa un mensaje"}}, 400
+        return None, ({"ok": False, "error": {"code": "EMPTY", "message": "Ingresa un mensaje"}}, 400)
 
     if len(message) > 4000:
-        return {"ok": False, "error": {"code": "TOO_LONG", "message": "El mensaje es demasiado largo"}}, 400
+        return None, ({"ok": False, "error": {"code": "TOO_LONG", "message": "El mensaje es demasiado largo"}}, 400)
 
     history = _sanitize_history(history_raw)
     history.append({"role": "user", "content": message})
+    return history, None
 
-    target = _resolve_ollama_url()
-    body = {
-        "model": _resolve_ollama_model(),
-        "messages": history,
-        "stream": False,
-    }
 
-    try:
-        upstream = requests.post(target, json=body, timeout=(5, 120))
-    except requests.RequestException as exc:
-        bp.logger.warning("Ollama unreachable at %s: %s", target, exc)
-        return {
-            "ok": False,
-            "error": {"code": "OLLAMA_UNREACHABLE", "message": "No se pudo conectar con Ollama"},
-        }, 502
-
-    if upstream.status_code >= 400:
-        try:
-            detail = upstream.json()
-            message_error = detail.get("error") or detail.get("message") or "Error de Ollama"
-        except Exception:
-            message_error = "Error de Ollama"
-        return {
-            "ok": False,
-            "error": {"code": "OLLAMA_ERROR", "message": str(message_error)},
-        }, 502
+def _llm_error(exc: OllamaError):
+    body = {"ok": False, "error": {"code": exc.code, "message": exc.message}}
+    if isinstance(exc, LaneRejected):
+        return body, exc.status, {"Retry-After": str(exc.retry_after)}
+    return body, 502
 
-    try:
-        response_json = upstream.json()
-    except json.JSONDecodeError:
-        return {
-            "ok": False,
-            "error": {"code": "INVALID_RESP", "message": "Respuesta invalida de Ollama"},
-        }, 502
 
-    content = str(response_json.get("message", {}).get("content", "")).strip()
-    if not content:
-        content = "No obtuve una respuesta del modelo."
+def _catalog_context(con, question: str) -> Dict[str, str] | None:
+    """Mensaje de sistema con los materiales más parecidos a la pregunta, o None si no hay."""
+    if Settings.CHATBOT_RAG_TOP_K <= 0:
+        return None
+    # Índice TF-IDF en memoria del worker; solo se reconstruye cuando cambia el catálogo.
+    index = material_index.get(con)
+    matches = index.search(question, Settings.CHATBOT_RAG_TOP_K, min_score=Settings.CHATBOT_RAG_MIN_SCORE)
+    if not matches:
+        return None
+    lines = []
+    for row, _score in matches:
+        unidad = index.unidades[row]
+        lines.append(f"- {index.codigos[row]}: {index.descripciones[row]}" + (f" [{unidad}]" if unidad else ""))
+    return {"role": "system", "content": _CATALOG_PROMPT + "\n" + "\n".join(lines)}
+
+
+def _prepare_messages(history: List[Dict[str, str]]) -> tuple[List[Dict[str, str]], str, str | None]:
+    """Agrega el contexto de catálogo antes de la pregunta y busca la respuesta en caché."""
+    with get_connection() as con:
+        context = _catalog_context(con, history[-1]["content"])
+        messages = history[:-1] + [context, history[-1]] if context else history
+        key = chat_cache.key(ollama_client.model, messages)
+        return messages, key, chat_cache.get(con, key)
+
+
+def _sse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@bp.route("/chatbot", methods=["POST", "OPTIONS"])
+def invoke_chatbot():
+    if request.method == "OPTIONS":
+        return "", 204
+    history, err = _parse_chat_request()
+    if err:
+        return err
+
+    history, key, cached = _prepare_messages(history)
+    if cached is None:
+        try:
+            with llm_lane.slot():
+                content = ollama_client.chat(history)
+        except OllamaError as exc:
+            return _llm_error(exc)
+        chat_cache.put(key, content)
 
     return {
         "ok": True,
         "message": {
             "role": "assistant",
-            "content": content,
+            "content": (content if cached is None else cached) or _EMPTY_ANSWER,
         },
+        "cached": cached is not None,
     }
+
+
+@bp.route("/chatbot/stream", methods=["POST", "OPTIONS"])
+def stream_chatbot():
+    """Respuesta del modelo como Server-Sent Events: ``token`` por fragmento, luego ``done`` o ``error``."""
+    if request.method == "OPTIONS":
+        return "", 204
+    history, err = _parse_chat_request()
+    if err:
+        return err
+
+    sse_headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    history, key, cached = _prepare_messages(history)
+    if cached is not None:
+        # Respuesta ya generada: se entrega completa sin pasar por el carril LLM.
+        return Response(
+            [
+                _sse("token", {"content": cached}),
+                _sse("done", {"role": "assistant", "content": cached, "cached": True}),
+            ],
+            mimetype="text/event-stream",
+            headers=sse_headers,
+        )
+
+    try:
+        slot = llm_lane.acquire()
+    except LaneRejected as exc:
+        return _llm_error(exc)
+    chunks = ollama_client.stream_chat(history)
+    try:
+        # Errores de conexión antes del primer token se responden como JSON normal.
+        first = next(chunks, None)
+    except OllamaError as exc:
+        slot.release(False)
+        return _llm_error(exc)
+
+    def events():
+        answer: List[str] = []
+        outcome = None
+        try:
+            for chunk in chain([first] if first else [], chunks):
+                token = str((chunk.get("message") or {}).get("content") or "")
+                if token:
+                    answer.append(token)
+                    yield _sse("token", {"content": token})
+            outcome = True
+            content = "".join(answer).strip()
+            chat_cache.put(key, content)
+            yield _sse("done", {"role": "assistant", "content": content or _EMPTY_ANSWER, "cached": False})
+        except OllamaError as exc:
+            outcome = False
+            yield _sse("error", {"code": exc.code, "message": exc.message})
+        finally:
+            # Si el navegador se desconectó, el servidor WSGI cierra este generador
+            # y cerrar el de Ollama corta la generación en curso.
+            chunks.close()
+            slot.release(outcome)
+
+    return Response(events(), mimetype="text/event-stream", headers=sse_headers)
@@ -4,12 +4,11 @@ from datetime import datetime
 from flask import Blueprint, request
 from ..db import get_connection
 from ..schemas import CentroRequestDecision
-from ..security import verify_access_token
+from ..security import current_user_id
 from .solicitudes import STATUS_PENDING
 
 bp = Blueprint("notificaciones", __name__, url_prefix="/api")
 
-COOKIE_NAME = "spm_token"
 
 
 def _parse_centros_value(raw) -> list[str]:
@@ -40,24 +39,9 @@ def _parse_centros_value(raw) -> list[str]:
     return cleaned
 
 
-def _require_auth() -> str | None:
-    token = request.cookies.get(COOKIE_NAME)
-    if not token:
-        header = request.headers.get("Authorization", "")
-        if header.startswith("Bearer "):
-            token = header.split(" ", 1)[1].strip()
-    if not token:
-        return None
-    try:
-        payload = verify_access_token(token)
-    except Exception:
-        return None
-    return payload.get("sub")
-
-
 @bp.get("/notificaciones")
 def listar_notificaciones():
-    uid = _require_auth()
+    uid = current_user_id()
     if not uid:
         return {"ok": False, "error": {"code": "NOAUTH", "message": "No autenticado"}}, 401
     with get_connection() as con:
@@ -191,7 +175,7 @@ def decidir_solicitud_centros(request_id: int):
     if request.method == "OPTIONS":
         # Permite preflight CORS
         return "", 204
-    uid = _require_auth()
+    uid = current_user_id()
     if not uid:
         return {"ok": False, "error": {"code": "NOAUTH", "message": "No autenticado"}}, 401
     decision = CentroRequestDecision(**(request.get_json(force=True) or {}))
@@ -318,7 +302,7 @@ def decidir_solicitud_centros(request_id: int):
 def marcar_notificaciones():
     if request.method == "OPTIONS":
         return "", 204
-    uid = _require_auth()
+    uid = current_user_id()
     if not uid:
         return {"ok": False, "error": {"code": "NOAUTH", "message": "No autenticado"}}, 401
     payload = request.get_json(silent=True) or {}
@@ -3,27 +3,23 @@ from __future__ import annotations
 import json
 from flask import Blueprint, request
 
+from ..ai_service import suggestion_precomputer
+from ..budget_ledger import release_budget
+from ..price_stats import get_price_stats
 from ..db import get_connection
-from ..security import verify_access_token
+from ..security import current_user
+from ..roles import has_role
 
 bp = Blueprint("spm_planner_blueprint", __name__, url_prefix="/api/planificador")
-COOKIE_NAME = "spm_token"
 
 def _require_planner():
-    user = verify_access_token(request)
-    if not user:
-        return None, ({"ok": False, "error": {"code":"unauthorized","message":"Unauthorized"}}, 401)
-    uid = user.get("sub")
-    if not uid:
-        return None, ({"ok": False, "error": {"code":"unauthorized","message":"Unauthorized"}}, 401)
     with get_connection() as con:
-        row = con.execute("SELECT rol FROM usuarios WHERE lower(id_spm)=?", (uid.lower(),)).fetchone()
-        if not row:
-            return None, ({"ok": False, "error": {"code":"forbidden","message":"Forbidden"}}, 403)
-        role = (row["rol"] or "").lower()
-        if not any(r in role for r in ["planner", "planificador", "admin", "administrador"]):
-            return None, ({"ok": False, "error": {"code":"forbidden","message":"Forbidden"}}, 403)
-    return uid, None
+        row = current_user(con)
+    if not row:
+        return None, ({"ok": False, "error": {"code":"unauthorized","message":"Unauthorized"}}, 401)
+    if not has_role(row, "planner", "planificador", "admin", "administrador"):
+        return None, ({"ok": False, "error": {"code":"forbidden","message":"Forbidden"}}, 403)
+    return row["id_spm"], None
 
 def _log_event(con, solicitud_id, planner_id, tipo, payload: dict | None = None):
     pj = json.dumps(payload or {}, ensure_ascii=False)
@@ -175,6 +171,7 @@ def tomar_solicitud(solicitud_id):
                 INSERT INTO notificaciones (destinatario_id, solicitud_id, mensaje)
                 VALUES (?, ?, ?)
             """, (sol_row["id_usuario"], solicitud_id, f"Solicitud #{solicitud_id} tomada por planificador"))
+    suggestion_precomputer.submit(solicitud_id)
     return {"ok": True}
 
 @bp.route("/solicitudes/<int:solicitud_id>/liberar", methods=["PATCH"])
@@ -206,7 +203,11 @@ def get_tratamiento(solicitud_id):
             SELECT item_index, decision, cantidad_aprobada, codigo_equivalente, proveedor_sugerido, precio_unitario_estimado, comentario, updated_at
             FROM solicitud_items_tratamiento WHERE solicitud_id = ?
         """, (solicitud_id,)).fetchall()
-    return {"ok": True, "solicitud": dict(sol), "tratamiento": [dict(r) for r in trat]}
+        items = json.loads(sol["data_json"] or "{}").get("items") or []
+        codigos = [it.get("codigo") for it in items if isinstance(it, dict)]
+        codigos += [r["codigo_equivalente"] for r in trat]
+        precios = get_price_stats(con, codigos)
+    return {"ok": True, "solicitud": dict(sol), "tratamiento": [dict(r) for r in trat], "precios": precios}
 
 @bp.route("/solicitudes/<int:solicitud_id>/tratamiento/items", methods=["PATCH"])
 def update_items(solicitud_id):
@@ -284,6 +285,7 @@ def rechazar_solicitud(solicitud_id):
         if not sol or sol["status"] != "en_tratamiento" or sol["planner_id"].lower() != uid.lower():
             return {"ok": False, "error": {"code": "forbidden", "message": "No autorizado"}}, 403
         con.execute("UPDATE solicitudes SET status = 'rechazada' WHERE id = ?", (solicitud_id,))
+        release_budget(con, solicitud_id=solicitud_id, actor_id=uid, detalle=f"Rechazada por planificador: {motivo}")
         _log_event(con, solicitud_id, uid, "rechazar", {"motivo": motivo})
         # Notificar
         for dest in [sol["id_usuario"], sol["aprobador_id"]]:
@@ -292,6 +294,7 @@ def rechazar_solicitud(solicitud_id):
                     INSERT INTO notificaciones (destinatario_id, solicitud_id, mensaje)
                     VALUES (?, ?, ?)
                 """, (dest, solicitud_id, f"Solicitud #{solicitud_id} rechazada: {motivo}"))
+        con.commit()
     return {"ok": True}
 
 @bp.route("/estadisticas", methods=["GET"])
@@ -1,44 +1,14 @@
 from __future__ import annotations
 from collections import defaultdict
-from datetime import datetime, date
 import unicodedata
 from flask import Blueprint, request
+from ..budget_ledger import MOV_COMPROMISO, MOV_INCREMENTO, MOV_LIBERACION, increase_budget, serialize_movement
 from ..db import get_connection
-from ..security import verify_access_token
+from ..security import current_user_id
 from ..schemas import BudgetIncreaseCreate, BudgetIncreaseDecision
 
 bp = Blueprint("presupuestos", __name__, url_prefix="/api")
 
-COOKIE_NAME = "spm_token"
-
-
-def _require_auth() -> str | None:
-    token = request.cookies.get(COOKIE_NAME)
-    if not token:
-        header = request.headers.get("Authorization", "")
-        if header.startswith("Bearer "):
-            token = header.split(" ", 1)[1].strip()
-    if not token:
-        return None
-    try:
-        payload = verify_access_token(token)
-    except Exception:
-        return None
-    return payload.get("sub")
-
-
-def _parse_datetime(value: str | None) -> datetime | None:
-    if not value:
-        return None
-    value = value.strip()
-    if not value:
-        return None
-    for fmt in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d"):
-        try:
-            return datetime.strptime(value.replace("Z", ""), fmt)
-        except ValueError:
-            continue
-    return None
 
 
 def _normalize_text(value: object) -> str:
@@ -102,9 +72,23 @@ def _serialize_increase(row: dict[str, object] | None) -> dict[str, object] | No
     }
 
 
+def _serialize_history(row: dict[str, object]) -> dict[str, object]:
+    return {
+        "id": row["id"],
+        "centro": row["centro"],
+        "sector": row["sector"],
+        "status": row["status"],
+        "total_monto": float(row.get("total_monto") or 0.0),
+        "fecha_necesidad": row.get("fecha_necesidad"),
+        "created_at": row.get("created_at"),
+        "updated_at": row.get("updated_at"),
+        "justificacion": row.get("justificacion"),
+    }
+
+
 @bp.get("/presupuestos/mis")
 def obtener_presupuestos_propios():
-    uid = _require_auth()
+    uid = current_user_id()
     if not uid:
         return {"ok": False, "error": {"code": "NOAUTH", "message": "No autenticado"}}, 401
     inc_rows: list[dict[str, object]] = []
@@ -125,12 +109,14 @@ def obtener_presupuestos_propios():
                     "total_presupuestos": 0,
                     "monto_total": 0.0,
                     "utilizado_total": 0.0,
+                    "comprometido_total": 0.0,
                     "saldo_total": 0.0,
                     "ultima_actualizacion": None,
                 },
                 "presupuestos": [],
                 "historial": [],
                 "proximos_vencimientos": [],
+                "movimientos": [],
                 "incorporaciones": {
                     "puede_solicitar": _can_request_increase(user),
                     "puede_aprobar": _can_approve_increase(user),
@@ -141,24 +127,89 @@ def obtener_presupuestos_propios():
             }
             return empty_response
         placeholders = ",".join(["?"] * len(centros))
+        params = tuple(centros)
         presup_rows = con.execute(
             f"""
-            SELECT centro, sector, monto_usd, saldo_usd
-              FROM presupuestos
+            SELECT p.centro, p.sector, p.monto_usd, p.saldo_usd,
+                   COALESCE(m.comprometido, 0) AS comprometido,
+                   COALESCE(m.liberado, 0) AS liberado,
+                   COALESCE(m.incrementos, 0) AS incrementos,
+                   m.ultimo_movimiento
+              FROM presupuestos p
+              LEFT JOIN (
+                    SELECT centro, COALESCE(sector, '') AS sector_key,
+                           SUM(CASE WHEN tipo='{MOV_COMPROMISO}' THEN monto ELSE 0 END) AS comprometido,
+                           SUM(CASE WHEN tipo='{MOV_LIBERACION}' THEN monto ELSE 0 END) AS liberado,
+                           SUM(CASE WHEN tipo='{MOV_INCREMENTO}' THEN monto ELSE 0 END) AS incrementos,
+                           MAX(created_at) AS ultimo_movimiento
+                      FROM presupuesto_movimientos
+                     WHERE centro IN ({placeholders})
+                  GROUP BY centro, COALESCE(sector, '')
+              ) m ON m.centro = p.centro AND m.sector_key = COALESCE(p.sector, '')
+             WHERE p.centro IN ({placeholders})
+          ORDER BY p.centro, p.sector
+            """,
+            params + params,
+        ).fetchall()
+        # Timestamps are stored in mixed formats; datetime() normalizes them inside SQLite.
+        actividad_rows = con.execute(
+            f"""
+            SELECT centro, sector,
+                   strftime('%Y-%m-%dT%H:%M:%S', MAX(datetime(updated_at))) AS ultima
+              FROM solicitudes
              WHERE centro IN ({placeholders})
-          ORDER BY centro, sector
+          GROUP BY centro, sector
             """,
-            tuple(centros),
+            params,
         ).fetchall()
         history_rows = con.execute(
+            f"""
+            SELECT id, centro, sector, status, total_monto, fecha_necesidad, created_at, updated_at, justificacion, rn
+              FROM (
+                    SELECT id, centro, sector, status, total_monto, fecha_necesidad, created_at, updated_at, justificacion,
+                           ROW_NUMBER() OVER (
+                               PARTITION BY centro, sector ORDER BY datetime(created_at) DESC, id DESC
+                           ) AS rn
+                      FROM solicitudes
+                     WHERE centro IN ({placeholders})
+              )
+             WHERE rn <= 10
+          ORDER BY datetime(created_at) DESC, id DESC
+            """,
+            params,
+        ).fetchall()
+        global_rows = con.execute(
             f"""
             SELECT id, centro, sector, status, total_monto, fecha_necesidad, created_at, updated_at, justificacion
               FROM solicitudes
              WHERE centro IN ({placeholders})
           ORDER BY datetime(created_at) DESC, id DESC
-             LIMIT 200
+             LIMIT 50
             """,
-            tuple(centros),
+            params,
+        ).fetchall()
+        proximos_rows = con.execute(
+            f"""
+            SELECT id, centro, sector, fecha_necesidad AS fecha, status, total_monto AS monto
+              FROM solicitudes
+             WHERE centro IN ({placeholders})
+               AND fecha_necesidad IS NOT NULL AND fecha_necesidad <> ''
+               AND date(fecha_necesidad) >= date('now', 'localtime')
+               AND lower(COALESCE(status, '')) <> 'cancelada'
+          ORDER BY date(fecha_necesidad), id
+             LIMIT 20
+            """,
+            params,
+        ).fetchall()
+        movimientos_rows = con.execute(
+            f"""
+            SELECT id, centro, sector, tipo, monto, saldo_resultante, solicitud_id, incorporacion_id, actor_id, detalle, created_at
+              FROM presupuesto_movimientos
+             WHERE centro IN ({placeholders})
+          ORDER BY created_at DESC, id DESC
+             LIMIT 50
+            """,
+            params,
         ).fetchall()
 
         if centros:
@@ -176,52 +227,32 @@ def obtener_presupuestos_propios():
             inc_rows = []
 
     history_by_key: defaultdict[tuple[str, str], list[dict[str, object]]] = defaultdict(list)
-    proximos: list[dict[str, object]] = []
-    today = date.today()
-    ultima_global: datetime | None = None
-
-    historial: list[dict[str, object]] = []
     for row in history_rows:
-        entry = {
+        history_by_key[(row["centro"], row["sector"])].append(_serialize_history(row))
+    historial = [_serialize_history(row) for row in global_rows]
+    actividad = {(row["centro"], row["sector"]): row.get("ultima") for row in actividad_rows}
+    proximos = [
+        {
             "id": row["id"],
             "centro": row["centro"],
             "sector": row["sector"],
-            "status": row["status"],
-            "total_monto": float(row.get("total_monto") or 0.0),
-            "fecha_necesidad": row.get("fecha_necesidad"),
-            "created_at": row.get("created_at"),
-            "updated_at": row.get("updated_at"),
-            "justificacion": row.get("justificacion"),
+            "fecha": row.get("fecha"),
+            "status": row.get("status"),
+            "monto": float(row.get("monto") or 0.0),
         }
-        historial.append(entry)
-        history_by_key[(row["centro"], row["sector"])].append(entry)
-        updated_dt = _parse_datetime(row.get("updated_at"))
-        if updated_dt and (ultima_global is None or updated_dt > ultima_global):
-            ultima_global = updated_dt
-        fecha_necesidad = row.get("fecha_necesidad")
-        if fecha_necesidad:
-            fecha_dt = _parse_datetime(fecha_necesidad)
-            if fecha_dt and fecha_dt.date() >= today and (row.get("status") or "").lower() != "cancelada":
-                proximos.append(
-                    {
-                        "id": row["id"],
-                        "centro": row["centro"],
-                        "sector": row["sector"],
-                        "fecha": fecha_necesidad,
-                        "status": row.get("status"),
-                        "monto": float(row.get("total_monto") or 0.0),
-                    }
-                )
-
-    proximos.sort(key=lambda item: (_parse_datetime(item.get("fecha")) or datetime.max))
-    proximos = proximos[:20]
+        for row in proximos_rows
+    ]
 
+    # Both sources are normalized ISO strings, so max() orders them chronologically.
+    fechas_actividad = [value for value in actividad.values() if value]
+    fechas_actividad += [row.get("ultimo_movimiento") for row in presup_rows if row.get("ultimo_movimiento")]
     summary = {
         "total_presupuestos": len(presup_rows),
         "monto_total": 0.0,
         "utilizado_total": 0.0,
+        "comprometido_total": 0.0,
         "saldo_total": 0.0,
-        "ultima_actualizacion": ultima_global.isoformat() if ultima_global else None,
+        "ultima_actualizacion": max(fechas_actividad) if fechas_actividad else None,
     }
 
     presupuestos: list[dict[str, object]] = []
@@ -229,31 +260,28 @@ def obtener_presupuestos_propios():
         monto = float(row.get("monto_usd") or 0.0)
         saldo = float(row.get("saldo_usd") or 0.0)
         utilizado = max(0.0, monto - saldo)
+        comprometido = float(row.get("comprometido") or 0.0) - float(row.get("liberado") or 0.0)
         avance = round(utilizado / monto * 100, 2) if monto else 0.0
         key = (row["centro"], row["sector"])
-        detalle_historial = history_by_key.get(key, [])
-        ultima_local: datetime | None = None
-        for item in detalle_historial:
-            parsed = _parse_datetime(item.get("updated_at"))
-            if parsed and (ultima_local is None or parsed > ultima_local):
-                ultima_local = parsed
+        fechas_locales = [value for value in (actividad.get(key), row.get("ultimo_movimiento")) if value]
         entry = {
             "centro": row["centro"],
             "sector": row["sector"],
             "monto_total": monto,
             "saldo": saldo,
             "utilizado": utilizado,
+            "comprometido": comprometido,
+            "incrementos": float(row.get("incrementos") or 0.0),
             "avance": avance,
-            "ultima_actualizacion": ultima_local.isoformat() if ultima_local else None,
-            "historial": detalle_historial[:10],
+            "ultima_actualizacion": max(fechas_locales) if fechas_locales else None,
+            "historial": history_by_key.get(key, []),
         }
         presupuestos.append(entry)
         summary["monto_total"] += monto
         summary["utilizado_total"] += utilizado
+        summary["comprometido_total"] += comprometido
         summary["saldo_total"] += saldo
 
-    historial = historial[:50]
-
     increases_all = [_serialize_increase(row) for row in inc_rows]
     increases_all = [row for row in increases_all if row]
     increases_mine = [row for row in increases_all if row.get("solicitante_id", "").lower() == uid.lower()]
@@ -273,6 +301,7 @@ def obtener_presupuestos_propios():
         "presupuestos": presupuestos,
         "historial": historial,
         "proximos_vencimientos": proximos,
+        "movimientos": [serialize_movement(row) for row in movimientos_rows],
         "incorporaciones": response_increases,
     }
     return response
@@ -282,7 +311,7 @@ def obtener_presupuestos_propios():
 def crear_incorporacion_presupuesto():
     if request.method == "OPTIONS":
         return "", 204
-    uid = _require_auth()
+    uid = current_user_id()
     if not uid:
         return {"ok": False, "error": {"code": "NOAUTH", "message": "No autenticado"}}, 401
     data = BudgetIncreaseCreate(**request.get_json(force=True))
@@ -322,7 +351,7 @@ def crear_incorporacion_presupuesto():
 def resolver_incorporacion_presupuesto(inc_id: int):
     if request.method == "OPTIONS":
         return "", 204
-    uid = _require_auth()
+    uid = current_user_id()
     if not uid:
         return {"ok": False, "error": {"code": "NOAUTH", "message": "No autenticado"}}, 401
     payload = BudgetIncreaseDecision(**request.get_json(force=True))
@@ -356,55 +385,33 @@ def resolver_incorporacion_presupuesto(inc_id: int):
         if accion == "aprobar":
             if monto <= 0:
                 return {"ok": False, "error": {"code": "INVALID_AMOUNT", "message": "Monto inválido"}}, 400
-            con.execute(
-                """
-                UPDATE presupuesto_incorporaciones
-                   SET estado='aprobada', aprobador_id=?, comentario=?, resolved_at=CURRENT_TIMESTAMP, updated_at=CURRENT_TIMESTAMP
-                 WHERE id=?
-                """,
-                (uid.lower(), comentario, inc_id),
-            )
-            if sector:
-                existing = con.execute(
-                    "SELECT monto_usd, saldo_usd FROM presupuestos WHERE centro=? AND sector=?",
-                    (centro, sector),
-                ).fetchone()
-                if existing:
-                    con.execute(
-                        "UPDATE presupuestos SET monto_usd=monto_usd+?, saldo_usd=saldo_usd+? WHERE centro=? AND sector=?",
-                        (monto, monto, centro, sector),
-                    )
-                else:
-                    con.execute(
-                        "INSERT INTO presupuestos (centro, sector, monto_usd, saldo_usd) VALUES (?,?,?,?)",
-                        (centro, sector, monto, monto),
-                    )
-            else:
-                existing = con.execute(
-                    "SELECT monto_usd, saldo_usd FROM presupuestos WHERE centro=? AND (sector IS NULL OR sector='')",
-                    (centro,),
-                ).fetchone()
-                if existing:
-                    con.execute(
-                        "UPDATE presupuestos SET monto_usd=monto_usd+?, saldo_usd=saldo_usd+? WHERE centro=? AND (sector IS NULL OR sector='')",
-                        (monto, monto, centro),
-                    )
-                else:
-                    con.execute(
-                        "INSERT INTO presupuestos (centro, sector, monto_usd, saldo_usd) VALUES (?,?,?,?)",
-                        (centro, None, monto, monto),
-                    )
+            nuevo_estado = "aprobada"
         elif accion == "rechazar":
-            con.execute(
-                """
-                UPDATE presupuesto_incorporaciones
-                   SET estado='rechazada', aprobador_id=?, comentario=?, resolved_at=CURRENT_TIMESTAMP, updated_at=CURRENT_TIMESTAMP
-                 WHERE id=?
-                """,
-                (uid.lower(), comentario, inc_id),
-            )
+            nuevo_estado = "rechazada"
         else:
             return {"ok": False, "error": {"code": "BAD_ACTION", "message": "Acción no soportada"}}, 400
+        # The state guard makes a concurrent second resolution a no-op instead of a double increase.
+        cur = con.execute(
+            """
+            UPDATE presupuesto_incorporaciones
+               SET estado=?, aprobador_id=?, comentario=?, resolved_at=CURRENT_TIMESTAMP, updated_at=CURRENT_TIMESTAMP
+             WHERE id=? AND estado='pendiente'
+            """,
+            (nuevo_estado, uid.lower(), comentario, inc_id),
+        )
+        if cur.rowcount == 0:
+            con.rollback()
+            return {"ok": False, "error": {"code": "ALREADY_PROCESSED", "message": "La solicitud ya fue procesada"}}, 400
+        if nuevo_estado == "aprobada":
+            increase_budget(
+                con,
+                centro=centro,
+                sector=sector,
+                monto=monto,
+                incorporacion_id=inc_id,
+                actor_id=uid,
+                detalle=comentario,
+            )
         con.commit()
         updated = con.execute(
             """
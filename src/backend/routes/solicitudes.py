@@ -7,9 +7,11 @@ from io import BytesIO
 
 from flask import Blueprint, jsonify, request, send_file
 
+from ..ai_service import suggestion_precomputer
+from ..budget_ledger import release_budget, reserve_budget
 from ..db import get_connection
 from ..schemas import BudgetIncreaseDecision, SolicitudCreate, SolicitudDraft
-from ..security import verify_access_token
+from ..security import current_user_id
 from ..roles import has_role
 
 from openpyxl import Workbook
@@ -22,7 +24,6 @@ from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, Tabl
 
 bp = Blueprint("solicitudes", __name__, url_prefix="/api")
 
-COOKIE_NAME = "spm_token"
 STATUS_PENDING = "pendiente_de_aprobacion"
 STATUS_APPROVED = "aprobada"
 STATUS_REJECTED = "rechazada"
@@ -38,27 +39,6 @@ def _utcnow_iso() -> str:
     return datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
 
 
-def _get_auth_token() -> str | None:
-    token = request.cookies.get(COOKIE_NAME)
-    if not token:
-        header = request.headers.get("Authorization", "")
-        if header.startswith("Bearer "):
-            token = header.split(" ", 1)[1].strip()
-    return token or None
-
-
-def _require_auth() -> str | None:
-    token = _get_auth_token()
-    if not token:
-        return None
-    try:
-        payload = verify_access_token(token)
-    except Exception:
-        return None
-    sub = payload.get("sub")
-    return str(sub).strip() if sub else None
-
-
 def _json_error(code: str, message: str, status: int = 400):
     return jsonify({"ok": False, "error": {"code": code, "message": message}}), status
 
@@ -445,7 +425,7 @@ def _can_resolve(user: dict[str, Any] | None, row: dict[str, Any]) -> bool:
 
 @bp.get("/solicitudes")
 def listar_solicitudes():
-    uid = _require_auth()
+    uid = current_user_id()
     if not uid:
         return _json_error("NOAUTH", "No autenticado", 401)
     with get_connection() as con:
@@ -467,7 +447,7 @@ def listar_solicitudes():
 
 @bp.get("/solicitudes/<int:sol_id>")
 def obtener_solicitud(sol_id: int):
-    uid = _require_auth()
+    uid = current_user_id()
     if not uid:
         return _json_error("NOAUTH", "No autenticado", 401)
     with get_connection() as con:
@@ -511,7 +491,7 @@ def _sync_columns_from_payload(payload: dict[str, Any]) -> tuple[str, str, str,
 def crear_borrador():
     if request.method == "OPTIONS":
         return "", 204
-    uid = _require_auth()
+    uid = current_user_id()
     if not uid:
         return _json_error("NOAUTH", "No autenticado", 401)
     payload = request.get_json(force=True, silent=False) or {}
@@ -577,7 +557,7 @@ def crear_borrador():
 def actualizar_borrador(sol_id: int):
     if request.method == "OPTIONS":
         return "", 204
-    uid = _require_auth()
+    uid = current_user_id()
     if not uid:
         return _json_error("NOAUTH", "No autenticado", 401)
     payload = request.get_json(force=True, silent=False) or {}
@@ -727,7 +707,7 @@ def _finalizar_solicitud(con, row: dict[str, Any], final_data: dict[str, Any], u
 def finalizar_solicitud(sol_id: int):
     if request.method == "OPTIONS":
         return "", 204
-    uid = _require_auth()
+    uid = current_user_id()
     if not uid:
         return _json_error("NOAUTH", "No autenticado", 401)
     payload = request.get_json(force=True, silent=False) or {}
@@ -760,7 +740,7 @@ def finalizar_solicitud(sol_id: int):
 def crear_solicitud():
     if request.method == "OPTIONS":
         return "", 204
-    uid = _require_auth()
+    uid = current_user_id()
     if not uid:
         return _json_error("NOAUTH", "No autenticado", 401)
     payload = request.get_json(force=True, silent=False) or {}
@@ -819,7 +799,7 @@ def _create_cancel_request(row: dict[str, Any], reason: str | None, uid: str) ->
 def decidir_solicitud(sol_id: int):
     if request.method == "OPTIONS":
         return "", 204
-    uid = _require_auth()
+    uid = current_user_id()
     if not uid:
         return _json_error("NOAUTH", "No autenticado", 401)
     payload = request.get_json(silent=True) or {}
@@ -878,16 +858,33 @@ def decidir_solicitud(sol_id: int):
 
         try:
             data_json = json.dumps(data, ensure_ascii=False)
-            con.execute(
+            cur = con.execute(
                 """
                 UPDATE solicitudes
                    SET status=?, data_json=?, updated_at=CURRENT_TIMESTAMP,
                        notificado_at=?, aprobador_id=?, planner_id=?
-                 WHERE id=?
+                 WHERE id=? AND status=?
                 """,
                 (status_final, data_json, decision_at, uid.lower(), 
-                 assigned_planner_id, sol_id),
+                 assigned_planner_id, sol_id, STATUS_PENDING),
             )
+            if cur.rowcount == 0:
+                con.rollback()
+                return _json_error("INVALID_STATE", "La solicitud no está pendiente de aprobación", 409)
+            if accion == "aprobar":
+                reservado = reserve_budget(
+                    con,
+                    centro=row.get("centro"),
+                    sector=row.get("sector"),
+                    monto=float(row.get("total_monto") or 0.0),
+                    solicitud_id=sol_id,
+                    actor_id=uid,
+                )
+                if not reservado:
+                    con.rollback()
+                    return _json_error("SALDO_INSUFICIENTE", "El presupuesto del centro/sector no tiene saldo suficiente", 409)
+            else:
+                release_budget(con, solicitud_id=sol_id, actor_id=uid, detalle="Solicitud rechazada")
             owner = row.get("id_usuario")
             planner = assigned_planner_id  # Usar el planificador asignado, no el anterior
             assigned_planner = data.get("assigned_planner")
@@ -900,6 +897,9 @@ def decidir_solicitud(sol_id: int):
             con.rollback()
             return _json_error("DB_ERROR", f"No se pudo registrar la decisión: {exc}", 500)
 
+    if status_final == STATUS_IN_TREATMENT:
+        # Que el planificador encuentre las sugerencias ya calculadas al abrir el tratamiento
+        suggestion_precomputer.submit(sol_id)
     return {"ok": True, "status": status_final, "decision": decision_payload}
 
 
@@ -907,7 +907,7 @@ def decidir_solicitud(sol_id: int):
 def cancelar_solicitud(sol_id: int):
     if request.method == "OPTIONS":
         return "", 204
-    uid = _require_auth()
+    uid = current_user_id()
     if not uid:
         return _json_error("NOAUTH", "No autenticado", 401)
     payload = request.get_json(silent=True) or {}
@@ -924,6 +924,7 @@ def cancelar_solicitud(sol_id: int):
         try:
             if status in (STATUS_DRAFT, STATUS_CANCEL_REJECTED):
                 data = _handle_direct_cancel(con, row, reason)
+                release_budget(con, solicitud_id=sol_id, actor_id=uid, detalle="Solicitud cancelada")
                 con.commit()
                 return {"ok": True, "status": STATUS_CANCELLED, "cancel_reason": data.get("cancel_reason")}
             if status == STATUS_CANCELLED:
@@ -955,7 +956,7 @@ def cancelar_solicitud(sol_id: int):
 def decidir_cancelacion(sol_id: int):
     if request.method == "OPTIONS":
         return "", 204
-    uid = _require_auth()
+    uid = current_user_id()
     if not uid:
         return _json_error("NOAUTH", "No autenticado", 401)
     payload = request.get_json(force=True, silent=False) or {}
@@ -988,14 +989,18 @@ def decidir_cancelacion(sol_id: int):
                 data["cancel_request"] = cancel_request
                 data["cancelled_at"] = cancel_request["decision_at"]
                 data_json = json.dumps(data, ensure_ascii=False)
-                con.execute(
+                cur = con.execute(
                     """
                     UPDATE solicitudes
                        SET status=?, data_json=?, updated_at=CURRENT_TIMESTAMP
-                     WHERE id=?
+                     WHERE id=? AND status=?
                     """,
-                    (STATUS_CANCELLED, data_json, sol_id),
+                    (STATUS_CANCELLED, data_json, sol_id, STATUS_CANCEL_PENDING),
                 )
+                if cur.rowcount == 0:
+                    con.rollback()
+                    return _json_error("INVALID_STATE", "La solicitud no está en cancelación pendiente", 409)
+                release_budget(con, solicitud_id=sol_id, actor_id=uid, detalle="Cancelación aprobada")
                 _create_notification(con, owner, sol_id, f"Solicitud #{sol_id} cancelada")
                 result_status = STATUS_CANCELLED
             else:
@@ -1022,7 +1027,7 @@ def decidir_cancelacion(sol_id: int):
 @bp.get("/solicitudes/export/excel")
 def export_solicitudes_excel():
     """Exportar todas las solicitudes del usuario autenticado a Excel"""
-    user_id = _require_auth()
+    user_id = current_user_id()
     if not user_id:
         return _json_error("UNAUTHORIZED", "Autenticación requerida", 401)
 
@@ -1173,7 +1178,7 @@ def export_solicitudes_excel():
 @bp.get("/solicitudes/export/pdf")
 def export_solicitudes_pdf():
     """Exportar todas las solicitudes del usuario autenticado a PDF"""
-    user_id = _require_auth()
+    user_id = current_user_id()
     if not user_id:
         return _json_error("UNAUTHORIZED", "Autenticación requerida", 401)
 
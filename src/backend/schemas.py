@@ -1,5 +1,5 @@
 from __future__ import annotations
-from typing import Optional, List, Literal
+from typing import Any, Dict, Optional, List, Literal
 from datetime import date
 from pydantic import BaseModel, Field, constr, conint, confloat, model_validator, EmailStr
 
@@ -148,10 +148,61 @@ class PurchaseOrderCreate(BaseModel):
     moneda: Optional[constr(strip_whitespace=True)] = "USD"
 
 
+class PurchaseOrderBulkLine(BaseModel):
+    solped_id: conint(ge=1)
+    proveedor_email: constr(min_length=3, strip_whitespace=True, to_lower=True)
+    proveedor_nombre: constr(min_length=1, strip_whitespace=True)
+    subtotal: Optional[confloat(ge=0)] = None
+
+
+class PurchaseOrderBulkCreate(BaseModel):
+    lineas: List[PurchaseOrderBulkLine] = Field(min_length=1, max_length=500)
+    moneda: Optional[constr(strip_whitespace=True)] = "USD"
+    enviar: bool = True
+
+    @model_validator(mode="after")
+    def _solpeds_unicas(self):
+        ids = [linea.solped_id for linea in self.lineas]
+        if len(ids) != len(set(ids)):
+            raise ValueError("Cada solped puede aparecer una sola vez")
+        return self
+
+
 class PurchaseOrderUpdate(BaseModel):
     status: Literal["enviada", "entregada_parcial", "entregada_total", "cerrada", "cancelada"]
 
 
+SuggestionType = Literal["stock_split", "equivalente", "proveedor", "precio", "leadtime", "sla_risk", "texto_justif"]
+
+
+class AISuggestionDecision(BaseModel):
+    item_index: conint(ge=0)
+    type: SuggestionType
+    accepted: bool = True
+    payload: Dict[str, Any] = Field(default_factory=dict)
+    confidence: Optional[confloat(ge=0, le=1)] = None
+
+    @model_validator(mode="after")
+    def _payload_requerido(self):
+        required = {"equivalente": "material", "precio": "precio_unitario_est", "proveedor": "proveedor_nombre"}
+        field = required.get(self.type)
+        if self.accepted and field and self.payload.get(field) in (None, ""):
+            raise ValueError(f"payload.{field} es obligatorio para aceptar una sugerencia '{self.type}'")
+        return self
+
+
+class AISuggestionBatch(BaseModel):
+    solicitud_id: conint(ge=1)
+    decisiones: List[AISuggestionDecision] = Field(min_length=1, max_length=1000)
+
+    @model_validator(mode="after")
+    def _decisiones_unicas(self):
+        keys = [(d.item_index, d.type) for d in self.decisiones]
+        if len(keys) != len(set(keys)):
+            raise ValueError("Cada par (item_index, type) puede aparecer una sola vez")
+        return self
+
+
 class NotaCreate(BaseModel):
     item_index: Optional[conint(ge=0)] = None
     texto: constr(min_length=1, strip_whitespace=True)
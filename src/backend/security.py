@@ -1,8 +1,9 @@
 from __future__ import annotations
 import base64, os, hmac, time
 from hashlib import pbkdf2_hmac
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 import jwt
+from flask import request
 from .config import Settings
 
 _ITER = 390_000
@@ -30,3 +31,38 @@ def create_access_token(sub: str) -> str:
 def verify_access_token(token: str) -> Dict[str, Any]:
     return jwt.decode(token, Settings.SECRET_KEY, algorithms=["HS256"])
 
+
+COOKIE_NAME = "spm_token"
+
+
+def request_token() -> Optional[str]:
+    """Access token of the current request: the ``spm_token`` cookie or an ``Authorization: Bearer`` header."""
+    token = request.cookies.get(COOKIE_NAME)
+    if not token:
+        header = request.headers.get("Authorization", "")
+        if header.startswith("Bearer "):
+            token = header.split(" ", 1)[1].strip()
+    return token or None
+
+
+def current_user_id() -> Optional[str]:
+    """``sub`` of the request's access token, or None when it is missing or invalid."""
+    token = request_token()
+    if not token:
+        return None
+    try:
+        sub = verify_access_token(token).get("sub")
+    except Exception:
+        return None
+    return str(sub).strip() if sub else None
+
+
+def current_user(con) -> Optional[Dict[str, Any]]:
+    """The authenticated user's ``usuarios`` row (id_spm, nombre, apellido, rol), or None."""
+    uid = current_user_id()
+    if not uid:
+        return None
+    return con.execute(
+        "SELECT id_spm, nombre, apellido, rol FROM usuarios WHERE lower(id_spm)=?",
+        (uid.lower(),),
+    ).fetchone()
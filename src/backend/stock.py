@@ -0,0 +1,266 @@
+from __future__ import annotations
+
+import argparse
+import csv
+import io
+import json
+import logging
+import os
+import unicodedata
+from datetime import datetime
+from itertools import chain, islice
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .db import get_connection
+
+logger = logging.getLogger(__name__)
+
+ESTADO_CARGANDO = "cargando"
+ESTADO_ACTIVO = "activo"
+ESTADO_REEMPLAZADO = "reemplazado"
+ESTADO_FALLIDO = "fallido"
+
+# Column names seen in ERP exports, normalized (lowercase, no accents, no spaces).
+_ALIASES = {
+    "material": ("material", "codigo", "codigomaterial", "matnr", "sku"),
+    "centro": ("centro", "planta", "plant", "werks"),
+    "almacen": ("almacen", "almacenvirtual", "deposito", "lgort", "storagelocation"),
+    "lote": ("lote", "batch", "charg"),
+    "cantidad": ("cantidad", "stock", "disponible", "libreutilizacion", "labst", "qty"),
+}
+
+StockRow = Tuple[str, str, str, Optional[str], float]
+
+
+def _normalize_header(value: Any) -> str:
+    text = unicodedata.normalize("NFKD", str(value or "")).encode("ascii", "ignore").decode()
+    return "".join(ch for ch in text.lower() if ch.isalnum())
+
+
+def _column_map(header: List[Any]) -> Dict[str, int]:
+    normalized = [_normalize_header(h) for h in header]
+    mapping: Dict[str, int] = {}
+    for field, aliases in _ALIASES.items():
+        for alias in aliases:
+            if alias in normalized:
+                mapping[field] = normalized.index(alias)
+                break
+    missing = [f for f in ("material", "centro", "cantidad") if f not in mapping]
+    if missing:
+        raise ValueError(f"Faltan columnas obligatorias: {', '.join(missing)}")
+    return mapping
+
+
+def _parse_quantity(value: Any) -> Optional[float]:
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).strip().replace(" ", "")
+    if not text:
+        return None
+    if "," in text and "." in text:
+        # 1.234,56 (ES) o 1,234.56 (EN): el último separador es el decimal
+        if text.rfind(",") > text.rfind("."):
+            text = text.replace(".", "").replace(",", ".")
+        else:
+            text = text.replace(",", "")
+    else:
+        text = text.replace(",", ".")
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def _rows_from_table(rows: Iterator[List[Any]]) -> Iterator[StockRow]:
+    header = next(rows, None)
+    if header is None:
+        return
+    mapping = _column_map(list(header))
+    for raw in rows:
+        def cell(field: str) -> Any:
+            idx = mapping.get(field)
+            return raw[idx] if idx is not None and idx < len(raw) else None
+
+        material = str(cell("material") or "").strip()
+        centro = str(cell("centro") or "").strip()
+        cantidad = _parse_quantity(cell("cantidad"))
+        if not material or not centro or cantidad is None or cantidad <= 0:
+            continue
+        almacen = str(cell("almacen") or "").strip()
+        lote = str(cell("lote") or "").strip() or None
+        yield material, centro, almacen, lote, cantidad
+
+
+def iter_stock_rows(source: Any, filename: str) -> Iterator[StockRow]:
+    """Stream ``(material, centro, almacen, lote, cantidad)`` from a CSV or XLSX export.
+
+    ``source`` is a path or a binary file object; rows are produced one at a
+    time so memory does not grow with the size of the snapshot.
+    """
+    if filename.lower().endswith((".xlsx", ".xlsm")):
+        from openpyxl import load_workbook
+
+        workbook = load_workbook(source, read_only=True, data_only=True)
+        try:
+            sheet = workbook.worksheets[0]
+            yield from _rows_from_table(list(r) for r in sheet.iter_rows(values_only=True))
+        finally:
+            workbook.close()
+        return
+
+    handle = open(source, "rb") if isinstance(source, (str, os.PathLike)) else source
+    try:
+        text = io.TextIOWrapper(handle, encoding="utf-8-sig", errors="replace", newline="")
+        # Sniff from a sample that ends on a line boundary, then replay it ahead of the rest.
+        sample = text.read(8192) + text.readline()
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=",;\t|")
+        except csv.Error:
+            dialect = csv.excel
+        yield from _rows_from_table(csv.reader(chain(io.StringIO(sample, newline=""), text), dialect))
+        text.detach()
+    finally:
+        if handle is not source:
+            handle.close()
+
+
+def _batches(rows: Iterable[StockRow], size: int) -> Iterator[List[StockRow]]:
+    iterator = iter(rows)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _purge_snapshot_rows(snapshot_id: int, batch_size: int) -> None:
+    while True:
+        with get_connection() as con:
+            cur = con.execute(
+                """
+                DELETE FROM stock_disponible WHERE rowid IN (
+                    SELECT rowid FROM stock_disponible WHERE snapshot_id = ? LIMIT ?
+                )
+                """,
+                (snapshot_id, batch_size),
+            )
+            con.commit()
+        if cur.rowcount < batch_size:
+            return
+
+
+def import_stock_snapshot(
+    rows: Iterable[StockRow],
+    *,
+    origen: str,
+    snapshot_at: Optional[str] = None,
+    batch_size: int = 5000,
+) -> Dict[str, Any]:
+    """Load a full stock snapshot and make it the active one.
+
+    Rows go into a new ``snapshot_id`` in committed batches, so readers keep
+    using the previous snapshot and no write lock is held for long. Activation
+    is a single short transaction; the replaced snapshot is purged afterwards.
+    """
+    snapshot_at = snapshot_at or datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    with get_connection() as con:
+        snapshot_id = con.execute(
+            "INSERT INTO stock_snapshots (origen, estado, snapshot_at) VALUES (?, ?, ?)",
+            (origen, ESTADO_CARGANDO, snapshot_at),
+        ).lastrowid
+        con.commit()
+
+    filas = 0
+    try:
+        for batch in _batches(rows, batch_size):
+            with get_connection() as con:
+                con.executemany(
+                    """
+                    INSERT INTO stock_disponible (snapshot_id, material, centro, almacen, lote, cantidad)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    """,
+                    [(snapshot_id, *row) for row in batch],
+                )
+                filas += len(batch)
+                con.execute("UPDATE stock_snapshots SET filas = ? WHERE id = ?", (filas, snapshot_id))
+                con.commit()
+    except Exception as exc:
+        with get_connection() as con:
+            con.execute(
+                "UPDATE stock_snapshots SET estado = ?, error = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?",
+                (ESTADO_FALLIDO, str(exc)[:500], snapshot_id),
+            )
+            con.commit()
+        _purge_snapshot_rows(snapshot_id, batch_size)
+        raise
+
+    with get_connection() as con:
+        con.execute("BEGIN IMMEDIATE")
+        previous = [
+            r["id"]
+            for r in con.execute("SELECT id FROM stock_snapshots WHERE estado = ?", (ESTADO_ACTIVO,))
+        ]
+        con.execute(
+            "UPDATE stock_snapshots SET estado = ? WHERE estado = ?",
+            (ESTADO_REEMPLAZADO, ESTADO_ACTIVO),
+        )
+        con.execute(
+            "UPDATE stock_snapshots SET estado = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?",
+            (ESTADO_ACTIVO, snapshot_id),
+        )
+        con.commit()
+    for old_id in previous:
+        _purge_snapshot_rows(old_id, batch_size)
+    return {"snapshot_id": snapshot_id, "filas": filas, "snapshot_at": snapshot_at, "reemplazados": previous}
+
+
+def active_snapshot(con) -> Optional[Dict[str, Any]]:
+    return con.execute(
+        "SELECT id, origen, filas, snapshot_at, finished_at FROM stock_snapshots WHERE estado = ? ORDER BY id DESC LIMIT 1",
+        (ESTADO_ACTIVO,),
+    ).fetchone()
+
+
+def availability_for(con, materiales: Iterable[str], centro: Optional[str]) -> Dict[str, List[Dict[str, Any]]]:
+    """Positive stock of the active snapshot for several materials, same ``centro`` first."""
+    codes = sorted({m for m in materiales if m})
+    snapshot = active_snapshot(con)
+    out: Dict[str, List[Dict[str, Any]]] = {code: [] for code in codes}
+    if not codes or not snapshot:
+        return out
+    for start in range(0, len(codes), 500):
+        chunk = codes[start:start + 500]
+        rows = con.execute(
+            f"""
+            SELECT material, centro, almacen, lote, cantidad
+            FROM stock_disponible
+            WHERE snapshot_id = ? AND material IN ({','.join('?' * len(chunk))}) AND cantidad > 0
+            ORDER BY material, (centro = ?) DESC, cantidad DESC
+            """,
+            [snapshot["id"], *chunk, centro or ""],
+        )
+        for row in rows:
+            out[row["material"]].append(row)
+    return out
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Importa una foto completa de stock desde CSV o XLSX")
+    parser.add_argument("archivo")
+    parser.add_argument("--snapshot-at", default=None, help="Fecha de la foto (YYYY-MM-DD HH:MM:SS)")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    stats = import_stock_snapshot(
+        iter_stock_rows(args.archivo, args.archivo),
+        origen=os.path.basename(args.archivo),
+        snapshot_at=args.snapshot_at,
+        batch_size=args.batch_size,
+    )
+    print(json.dumps(stats, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Set
+
+from .attachment_store import THUMB_SUFFIX, blob_path, discard_temp
+
+logger = logging.getLogger(__name__)
+
+IMAGE_MIME_TYPES = {"image/png", "image/jpeg", "image/gif"}
+PDF_MIME_TYPES = {"application/pdf"}
+# Failed hashes remembered per process; the oldest are forgotten (and retried) past this.
+FAILED_CACHE_SIZE = 1024
+
+
+def thumb_path(sha256: str) -> str:
+    """Thumbnails live next to their blob, so identical files share one preview."""
+    return blob_path(sha256) + THUMB_SUFFIX
+
+
+def supports_thumbnail(tipo_mime: Optional[str]) -> bool:
+    mime = (tipo_mime or "").lower()
+    return mime in IMAGE_MIME_TYPES or mime in PDF_MIME_TYPES
+
+
+def _open_image(source: str, tipo_mime: str, max_px: int):
+    # Imported lazily: the API must keep working where Pillow/pdfium are not installed.
+    from PIL import Image
+
+    if tipo_mime in PDF_MIME_TYPES:
+        import pypdfium2 as pdfium
+
+        pdf = pdfium.PdfDocument(source)
+        try:
+            page = pdf[0]
+            width, height = page.get_size()
+            scale = min(2.0, max_px / max(width, height, 1))
+            image = page.render(scale=scale).to_pil()
+            page.close()
+        finally:
+            pdf.close()
+        return image
+    image = Image.open(source)
+    # JPEG can decode straight to a reduced size, which avoids most of the work.
+    image.draft("RGB", (max_px, max_px))
+    return image
+
+
+def generate_thumbnail(sha256: str, tipo_mime: Optional[str], max_px: int) -> bool:
+    """Render the preview for a blob; returns False when it cannot be produced."""
+    from PIL import Image
+
+    mime = (tipo_mime or "").lower()
+    source = blob_path(sha256)
+    target = thumb_path(sha256)
+    if os.path.exists(target) or not os.path.exists(source) or not supports_thumbnail(mime):
+        return os.path.exists(target)
+    image = _open_image(source, mime, max_px)
+    try:
+        image.thumbnail((max_px, max_px))
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+        fd, tmp_path = tempfile.mkstemp(prefix=".thumb-", suffix=".jpg", dir=os.path.dirname(target))
+        try:
+            with os.fdopen(fd, "wb") as handle:
+                image.save(handle, format="JPEG", quality=80, optimize=True)
+            os.replace(tmp_path, target)
+        except BaseException:
+            discard_temp(tmp_path)
+            raise
+    finally:
+        image.close()
+    return True
+
+
+class ThumbnailWorker:
+    """Small thread pool that renders previews after uploads, off the request path."""
+
+    def __init__(self, workers: int, max_px: int):
+        self._workers = max(1, int(workers))
+        self._max_px = max(16, int(max_px))
+        self._lock = threading.Lock()
+        self._executor: ThreadPoolExecutor | None = None
+        self._pid: int | None = None
+        self._in_flight: Set[str] = set()
+        self._failed: "OrderedDict[str, None]" = OrderedDict()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # Created lazily and per process so forked gunicorn workers get their own threads.
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="thumbnail")
+            self._pid = os.getpid()
+            self._in_flight = set()
+            self._failed = OrderedDict()
+        return self._executor
+
+    def submit(self, sha256: Optional[str], tipo_mime: Optional[str]) -> bool:
+        if not sha256 or not supports_thumbnail(tipo_mime):
+            return False
+        with self._lock:
+            executor = self._get_executor()
+            if sha256 in self._failed:
+                self._failed.move_to_end(sha256)
+                return False
+            if sha256 in self._in_flight:
+                return True
+            self._in_flight.add(sha256)
+            executor.submit(self._run, sha256, tipo_mime)
+        return True
+
+    def _run(self, sha256: str, tipo_mime: Optional[str]) -> None:
+        ok = False
+        try:
+            ok = generate_thumbnail(sha256, tipo_mime, self._max_px)
+        except Exception:
+            logger.exception("No se pudo generar la vista previa de %s", sha256)
+        finally:
+            with self._lock:
+                if not ok:
+                    # Not retried in this process; a corrupt or unsupported file stays without preview.
+                    self._failed[sha256] = None
+                    self._failed.move_to_end(sha256)
+                    while len(self._failed) > FAILED_CACHE_SIZE:
+                        self._failed.popitem(last=False)
+                self._in_flight.discard(sha256)
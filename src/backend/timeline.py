@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+import base64
+import heapq
+import json
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+FUENTE_LOG = "log"
+FUENTE_EVENTOS = "eventos"
+FUENTE_IA = "ia"
+
+# Each source reads one table through its (solicitud_id, created_at) index and
+# exposes the same columns. The rank breaks ties between sources on equal timestamps.
+_SOURCES: Dict[str, Tuple[int, str]] = {
+    FUENTE_LOG: (
+        0,
+        # AI decisions are also written here for the treatment audit trail;
+        # the IA source already reports them, so they are skipped to avoid duplicates.
+        """
+        SELECT id, created_at, tipo, estado, item_index, actor_id AS actor, payload_json
+        FROM solicitud_tratamiento_log
+        WHERE solicitud_id = ? AND tipo NOT IN ('ia_aceptada', 'ia_rechazada')
+        """,
+    ),
+    FUENTE_EVENTOS: (
+        1,
+        """
+        SELECT id, created_at, tipo, NULL AS estado, NULL AS item_index, planner_id AS actor, payload_json
+        FROM solicitud_tratamiento_eventos
+        WHERE solicitud_id = ?
+        """,
+    ),
+    FUENTE_IA: (
+        2,
+        # Wrapped so the filters appended below see the computed tipo.
+        """
+        SELECT * FROM (
+            SELECT id, created_at,
+                   CASE accepted WHEN 1 THEN 'ia_aceptada' WHEN 0 THEN 'ia_rechazada' ELSE 'ia_sugerida' END AS tipo,
+                   suggestion_type AS estado, item_index, actor_id AS actor, payload_json
+            FROM ai_suggestions_log
+            WHERE solicitud_id = ?
+        ) WHERE 1 = 1
+        """,
+    ),
+}
+
+FUENTES = tuple(_SOURCES)
+MAX_LIMIT = 200
+
+# (created_at, rank, id)
+Position = Tuple[str, int, int]
+
+
+def encode_cursor(position: Position) -> str:
+    raw = json.dumps(list(position), separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Position:
+    """Raises ValueError on anything that is not a cursor we produced."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, rank, row_id = json.loads(base64.urlsafe_b64decode(padded))
+        return str(created_at), int(rank), int(row_id)
+    except Exception as exc:
+        raise ValueError("Cursor inválido") from exc
+
+
+def _source_rows(
+    con,
+    fuente: str,
+    solicitud_id: int,
+    *,
+    after: Optional[Position],
+    descending: bool,
+    tipos: Sequence[str],
+    limit: int,
+) -> Iterator[Dict[str, Any]]:
+    rank, sql = _SOURCES[fuente]
+    params: List[Any] = [solicitud_id]
+    if after is not None:
+        created_at, cursor_rank, cursor_id = after
+        op = "<" if descending else ">"
+        if rank == cursor_rank:
+            sql += f" AND (created_at, id) {op} (?, ?)"
+            params.extend([created_at, cursor_id])
+        elif (rank > cursor_rank) != descending:
+            sql += f" AND created_at {op}= ?"
+            params.append(created_at)
+        else:
+            sql += f" AND created_at {op} ?"
+            params.append(created_at)
+    if tipos:
+        sql += f" AND tipo IN ({','.join('?' * len(tipos))})"
+        params.extend(tipos)
+    direction = "DESC" if descending else "ASC"
+    sql += f" ORDER BY created_at {direction}, id {direction} LIMIT ?"
+    params.append(limit)
+    for row in con.execute(sql, params):
+        row["fuente"] = fuente
+        row["_rank"] = rank
+        yield row
+
+
+def _serialize(row: Dict[str, Any], include_payload: bool) -> Dict[str, Any]:
+    item = {
+        "id": row["id"],
+        "fuente": row["fuente"],
+        "item_index": row["item_index"],
+        "actor": row["actor"],
+        "tipo": row["tipo"],
+        "estado": row["estado"],
+        "ts": row["created_at"],
+    }
+    if include_payload:
+        try:
+            item["payload"] = json.loads(row["payload_json"] or "{}")
+        except (TypeError, ValueError):
+            item["payload"] = {}
+    return item
+
+
+def fetch_timeline(
+    con,
+    solicitud_id: int,
+    *,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    fuentes: Optional[Iterable[str]] = None,
+    tipos: Optional[Iterable[str]] = None,
+    descending: bool = False,
+    include_payload: bool = True,
+) -> Dict[str, Any]:
+    """One page of the merged treatment history of a solicitud.
+
+    Every source contributes at most ``limit + 1`` rows already sorted by its
+    index, and ``heapq.merge`` interleaves them; only the rows that end up on
+    the page get their ``payload_json`` decoded.
+    """
+    limit = max(1, min(int(limit), MAX_LIMIT))
+    after = decode_cursor(cursor) if cursor else None
+    selected = [f for f in (fuentes or FUENTES) if f in _SOURCES]
+    tipo_list = [t for t in (tipos or []) if t]
+    streams = [
+        _source_rows(
+            con,
+            fuente,
+            solicitud_id,
+            after=after,
+            descending=descending,
+            tipos=tipo_list,
+            limit=limit + 1,
+        )
+        for fuente in selected
+    ]
+    merged = heapq.merge(
+        *streams,
+        key=lambda row: (row["created_at"], row["_rank"], row["id"]),
+        reverse=descending,
+    )
+    page: List[Dict[str, Any]] = []
+    next_cursor = None
+    for row in merged:
+        if len(page) == limit:
+            last = page[-1]
+            next_cursor = encode_cursor((last["created_at"], last["_rank"], last["id"]))
+            break
+        page.append(row)
+    return {
+        "timeline": [_serialize(row, include_payload) for row in page],
+        "next_cursor": next_cursor,
+    }
@@ -765,6 +765,9 @@ function toggleChatbotPanel(forceState) {
   }
   const nextState = typeof forceState === "boolean" ? forceState : !state.chat.isOpen;
   state.chat.isOpen = nextState;
+  if (!nextState && state.chat.controller) {
+    state.chat.controller.abort();
+  }
   panel.classList.toggle("chatbot-panel--open", nextState);
   panel.setAttribute("aria-hidden", nextState ? "false" : "true");
   fab.classList.toggle("chatbot-fab--hidden", nextState);
@@ -794,21 +797,26 @@ async function processChatbotPrompt(rawText) {
   state.chat.isSending = true;
   updateChatbotControls();
 
+  const reply = { role: "assistant", content: "" };
+  const controller = new AbortController();
+  state.chat.controller = controller;
   try {
-    const resp = await api("/chatbot", {
-      method: "POST",
-      body: JSON.stringify({ message: text, history: historyPayload }),
+    state.chat.messages.push(reply);
+    await streamChat({ message: text, history: historyPayload }, controller.signal, (token) => {
+      reply.content += token;
+      renderChatMessages();
     });
-    if (!resp?.ok) {
-      throw new Error(resp?.error?.message || "No se obtuvo respuesta");
-    }
-    const reply = String(resp.message?.content || "No recibimos respuesta del asistente.").trim();
-    state.chat.messages.push({ role: "assistant", content: reply });
+    reply.content = reply.content.trim() || "No recibimos respuesta del asistente.";
   } catch (err) {
-    const detail = err?.message || "No se pudo contactar al asistente";
-    state.chat.messages.push({ role: "assistant", content: `Hubo un problema: ${detail}` });
-    toast(detail);
+    if (err?.name === "AbortError") {
+      reply.content = reply.content.trim() || "Consulta cancelada.";
+    } else {
+      const detail = err?.message || "No se pudo contactar al asistente";
+      reply.content = `Hubo un problema: ${detail}`;
+      toast(detail);
+    }
   } finally {
+    state.chat.controller = null;
     trimChatHistory();
     state.chat.isSending = false;
     renderChatMessages();
@@ -816,6 +824,59 @@ async function processChatbotPrompt(rawText) {
   }
 }
 
+// POST /chatbot/stream devuelve Server-Sent Events: "token" por fragmento y
+// luego "done" o "error". Abortar la señal corta también la generación en el servidor.
+async function streamChat(body, signal, onToken) {
+  const res = await fetch(`${API}/chatbot/stream`, {
+    method: "POST",
+    credentials: "include",
+    headers: { "Content-Type": "application/json", Accept: "text/event-stream" },
+    body: JSON.stringify(body),
+    signal,
+  });
+  if (!res.ok || !res.body) {
+    let err = "No se obtuvo respuesta";
+    try {
+      const json = await res.json();
+      err = json.error?.message || err;
+    } catch (_ignored) {}
+    throw new Error(err);
+  }
+  const reader = res.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  for (;;) {
+    const { value, done } = await reader.read();
+    if (done) {
+      return;
+    }
+    buffer += decoder.decode(value, { stream: true });
+    let sep;
+    while ((sep = buffer.indexOf("\n\n")) >= 0) {
+      const raw = buffer.slice(0, sep);
+      buffer = buffer.slice(sep + 2);
+      let event = "message";
+      let data = "";
+      raw.split("\n").forEach((line) => {
+        if (line.startsWith("event:")) {
+          event = line.slice(6).trim();
+        } else if (line.startsWith("data:")) {
+          data += line.slice(5).trim();
+        }
+      });
+      const payload = data ? JSON.parse(data) : {};
+      if (event === "token") {
+        onToken(String(payload.content || ""));
+      } else if (event === "error") {
+        throw new Error(payload.message || "Error del asistente");
+      } else if (event === "done") {
+        await reader.cancel();
+        return;
+      }
+    }
+  }
+}
+
 function ensureChatbotWidget() {
   if (document.getElementById("chatbotFab")) {
     return;
@@ -1810,6 +1871,7 @@ const state = {
   chat: {
     isOpen: false,
     isSending: false,
+    controller: null,
     messages: [],
   },
 };